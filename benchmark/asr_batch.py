@@ -0,0 +1,44 @@
+"""
+SenseVoice 批处理吞吐量
+
+对比不同 batch size 下每秒能够处理的音频时长, 用于选择 SENSE_MAX_BATCH。
+    python -m benchmark.asr_batch --wav model_pretrained/ssy_short.wav --batch 1,2,4,8,16
+"""
+import time
+import argparse
+import torch
+
+from core.model.sensor import asr_batch, decode
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wav", default = None, help = "测试音频, 不提供时使用随机噪声")
+    parser.add_argument("--seconds", type = float, default = 5, help = "随机噪声的时长")
+    parser.add_argument("--batch", default = "1,2,4,8,16")
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    if args.wav is not None:
+        with open(args.wav, "rb") as f:
+            array, fs = decode(f.read())
+    else:
+        fs = 16000
+        array = torch.randn(int(args.seconds * fs)) * 0.1
+    # 预热
+    asr_batch([array], fs)
+
+    print("batch\tlatency(s)\titems/s\taudio s/s")
+    for batch in map(int, args.batch.split(",")):
+        # 长度略有差异, 模拟真实的 padding
+        arrays = [array[: array.shape[-1] * (32 - i % 16) // 32] for i in range(batch)]
+        audio_len = sum(a.shape[-1] for a in arrays) / fs
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            asr_batch(arrays, fs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        latency = (time.perf_counter() - start) / args.repeat
+        print("%d\t%.3f\t\t%.2f\t%.2f" % (batch, latency, batch / latency, audio_len / latency))
+
+if __name__ == "__main__":
+    main()
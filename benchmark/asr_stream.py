@@ -0,0 +1,97 @@
+"""
+端点到识别结果的延迟与准确率: 整句识别 (asr_array) 与流式识别 (StreamingASR)
+
+流式识别在说话过程中已经处理了大部分音频, 这里只统计最后一段音频送入并 is_final 的耗时。
+分块识别的 CER/WER 以 --text 给出的参考文本计算, 不提供时以整句识别的结果为参考;
+分块编码的准确率低于整句识别, 因此 /ws 只用它推送部分结果, 端点时仍对整句识别。
+同时按 /ws 的方式分段送入流式 VAD, 检查 cache["prev_samples"] 不会随录音增长。
+    python -m benchmark.asr_stream --wav model_pretrained/ssy_short.wav
+    python -m benchmark.asr_stream --wav test.wav --text "参考文本"
+"""
+import re
+import time
+import argparse
+import numpy as np
+import torch
+
+from core.model.sensor import asr_array, decode, StreamingASR, vad_stream, vad_block, SAMPLE_RATE
+
+def tokens(text: str, unit: str) -> list:
+    """cer 按字 (忽略空白与标点); wer 按词, 中文每个字算一个词"""
+    text = text.lower()
+    if unit == "cer":
+        return list(re.sub(r"[\W_]+", "", text))
+    return re.findall(r"[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+", text)
+
+def error_rate(ref: str, hyp: str, unit: str) -> float:
+    """编辑距离 / 参考文本长度, 参考为空时返回 nan"""
+    ref, hyp = tokens(ref, unit), tokens(hyp, unit)
+    if not len(ref):
+        return float("nan")
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, row[0] = row[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (r != h))
+    return row[-1] / len(ref)
+
+def vad_prev_samples(array: np.ndarray, fs: int, step: int) -> int:
+    """与 WebsocketClient.valid 一样只送入整块的音频, 返回 prev_samples 的最大长度"""
+    cache, fed, longest = {}, 0, 0
+    for i in range(step, array.shape[0] + step, step):
+        pending = array[fed: min(i, array.shape[0])]
+        pending = pending[: len(pending) - len(pending) % vad_block(fs)]
+        if len(pending):
+            vad_stream(pending, fs, cache)
+            fed += len(pending)
+            longest = max(longest, len(cache["prev_samples"]))
+    vad_stream(array[fed:], fs, cache, is_final = True)
+    return longest
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wav", default = None, help = "测试音频, 不提供时使用随机噪声")
+    parser.add_argument("--seconds", default = "2,5,10,20", help = "随机噪声的时长")
+    parser.add_argument("--record", type = float, default = 0.2, help = "客户端每次发送的音频时长 (秒)")
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--text", default = None, help = "--wav 的参考文本, 用于计算 CER/WER")
+    args = parser.parse_args()
+
+    if args.wav is not None:
+        with open(args.wav, "rb") as f:
+            array, fs = decode(f.read())
+        arrays = [array.numpy()]
+    else:
+        fs = 16000
+        arrays = [np.random.randn(int(float(s) * fs)).astype(np.float32) * 0.1 for s in args.seconds.split(",")]
+
+    # 预热
+    asr_array(arrays[0], fs)
+
+    print("audio(s)\toffline(ms)\tstream(ms)\tcer(full/stream)\twer(full/stream)\tvad_prev_samples")
+    step = int(args.record * fs)
+    for array in arrays:
+        offline, stream = 0.0, 0.0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            full = asr_array(array, fs).clean_text
+            offline += time.perf_counter() - start
+
+            session = StreamingASR()
+            last = max(array.shape[0] - step, 0)
+            for i in range(0, last, step):
+                session.accept(array[i: min(i + step, last)], fs)
+            start = time.perf_counter()
+            chunked = session.accept(array[last:], fs, is_final = True).clean_text
+            stream += time.perf_counter() - start
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        ref = args.text if args.text is not None else full
+        rates = ["%.3f/%.3f" % (error_rate(ref, full, unit), error_rate(ref, chunked, unit)) for unit in ("cer", "wer")]
+        prev = vad_prev_samples(array, fs, step)
+        print("%.1f\t\t%.1f\t\t%.1f\t\t%s\t%s\t%d" % (array.shape[0] / fs, offline * 1000 / args.repeat, stream * 1000 / args.repeat,
+                                                   rates[0], rates[1], prev))
+        assert prev < vad_block(SAMPLE_RATE), "prev_samples 随录音增长: %d" % prev
+
+if __name__ == "__main__":
+    main()
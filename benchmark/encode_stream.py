@@ -0,0 +1,73 @@
+"""
+流式响应的编码开销: 每个片段单独编码 (pack_audio) 与整个响应共用一个编码器 (stream_encoder)
+
+cpu 为每秒音频消耗的 CPU 时间 (包括 ffmpeg 子进程), streams 为单核可以实时编码的流数,
+chunk 为每个片段编码的平均耗时, first 为从写入第一个片段到拿到第一段编码数据的耗时。
+    python -m benchmark.encode_stream --media ogg,aac --chunk 300
+    python -m benchmark.encode_stream --media wav,opus --rate 24000 --bitrate 24k --frame 20
+"""
+import time
+import resource
+import argparse
+import numpy as np
+from io import BytesIO
+
+from core.utils.audio import pack_audio, stream_encoder
+
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def per_chunk(chunks, rate, media_type):
+    for chunk in chunks:
+        yield pack_audio(BytesIO(), chunk, rate, media_type).getvalue()
+
+def streaming(chunks, rate, media_type, **kwargs):
+    encoder = stream_encoder(media_type, rate, **kwargs)
+    try:
+        for chunk in chunks:
+            yield encoder.write(chunk)
+        yield encoder.close()
+    finally:
+        encoder.abort()
+
+def bench(fn, chunks, rate, media_type, **kwargs):
+    cpu, start = cpu_time(), time.perf_counter()
+    first, size = None, 0
+    for data in fn(chunks, rate, media_type, **kwargs):
+        if first is None and len(data):
+            first = time.perf_counter() - start
+        size += len(data)
+    wall = time.perf_counter() - start
+    return cpu_time() - cpu, wall, first or wall, size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", default = "wav,ogg,aac")
+    parser.add_argument("--rate", type = int, default = 32000)
+    parser.add_argument("--seconds", type = float, default = 10)
+    parser.add_argument("--chunk", type = float, default = 300, help = "每个片段的时长 (ms)")
+    parser.add_argument("--bitrate", default = "32k", help = "opus 码率")
+    parser.add_argument("--frame", type = float, default = 20, help = "opus 帧长 (ms)")
+    args = parser.parse_args()
+
+    n = int(args.rate * args.chunk / 1000)
+    t = np.arange(int(args.rate * args.seconds)) / args.rate
+    audio = (np.sin(2 * np.pi * 220 * t) * 8000 + np.random.randn(t.shape[0]) * 500).astype(np.int16)
+    chunks = [audio[i: i + n] for i in range(0, audio.shape[0], n)]
+
+    print("media\tmode\t\tcpu(ms/s)\tstreams\t\tchunk(ms)\tfirst(ms)\tkbit/s")
+    for media_type in args.media.split(","):
+        modes = [("per-chunk", per_chunk, {}), ("stream", streaming, {})]
+        if media_type == "opus":
+            # opus 只有流式编码
+            modes = [("stream", streaming, { "bitrate": args.bitrate, "frame": args.frame })]
+        for name, fn, kwargs in modes:
+            cpu, wall, first, size = bench(fn, chunks, args.rate, media_type, **kwargs)
+            cpu_per_second = cpu * 1000 / args.seconds
+            print("%s\t%s\t%.1f\t\t%.0f\t\t%.2f\t\t%.1f\t\t%.1f" % (
+                media_type, name.ljust(9), cpu_per_second, 1000 / max(cpu_per_second, 1e-3),
+                wall * 1000 / len(chunks), first * 1000, size * 8 / args.seconds / 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""
+引擎的离线基准测试, 使用 benchmark.tiny 搭建的随机权重模型, 在 CPU 上运行固定的场景
+
+    python -m benchmark.engine --out bench/base.json
+    python -m benchmark.engine --scenario cosy_stream sovits --compare bench/base.json
+
+每个场景在独立的子进程中构建模型并运行, 峰值内存互不影响。预热后重复 --repeat 次, 取中位数:
+    rtf         计算耗时 / 音频时长 (ASR 为输入音频时长)
+    throughput  每秒处理的音频秒数
+    ttfc_ms     第一个音频片段 (或识别结果) 的耗时
+    interval_ms 流式场景中相邻片段的间隔
+    peak_rss_mb 子进程的峰值常驻内存
+*_barge_in 场景模拟用户打断, 关注 wall_seconds: 打断之后引擎仍被占用的时间越短, 回收的算力越多。
+--out 把结果写成 JSON (附带提交与环境信息), --compare 与之前的 JSON 对比, 列出变化的百分比。
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import threading
+import statistics
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Generator, Tuple
+
+# 每次运行产出的 (采样率, 采样点数)
+Chunks = Generator[Tuple[int, int], None, None]
+
+SCENARIOS: dict[str, Callable[[], Callable[[], Chunks]]] = {}
+
+def scenario(name: str):
+    """注册场景, 被装饰的函数负责构建模型, 返回每次运行调用的函数"""
+    def wrapper(fn):
+        SCENARIOS[name] = fn
+        return fn
+    return wrapper
+
+
+@scenario("cosy_stream")
+def cosy_stream():
+    """CosyVoice2Model.tts 流式合成, 10 个文本 token, 固定生成 200 个语音 token (8 秒)"""
+    from . import tiny
+    model = tiny.build_cosyvoice2()
+    inputs = tiny.cosy_inputs()
+    def run():
+        for item in model.tts(stream = True, **inputs):
+            yield tiny.COSY_SAMPLE_RATE, item["tts_speech"].shape[-1]
+    return run
+
+@scenario("cosy_stream_stub")
+def cosy_stream_stub():
+    """同 cosy_stream, LLM 固定每个 token 5ms, token2wav 不计算 (tiny.build_cosyvoice2_stub),
+    ttfc_ms 与 interval_ms 只反映 tts() 等待与交接 token 的开销, 理想值为 token_hop_len + lookahead (53) 与 token_hop_len (50) 个 token 的 LLM 耗时"""
+    from . import tiny
+    model = tiny.build_cosyvoice2_stub(token_delay = 0.005)
+    inputs = tiny.cosy_inputs()
+    def run():
+        for item in model.tts(stream = True, **inputs):
+            yield tiny.COSY_SAMPLE_RATE, item["tts_speech"].shape[-1]
+    return run
+
+@scenario("cosy_offline")
+def cosy_offline():
+    """CosyVoice2Model.tts 非流式合成, 输入同 cosy_stream"""
+    from . import tiny
+    model = tiny.build_cosyvoice2()
+    inputs = tiny.cosy_inputs()
+    def run():
+        for item in model.tts(stream = False, **inputs):
+            yield tiny.COSY_SAMPLE_RATE, item["tts_speech"].shape[-1]
+    return run
+
+def _cosy_long(incremental: bool):
+    from . import tiny
+    model = tiny.build_cosyvoice2()
+    model.flow_incremental = incremental
+    inputs = tiny.cosy_inputs(text_len = 60)
+    def run():
+        for item in model.tts(stream = True, **inputs):
+            yield tiny.COSY_SAMPLE_RATE, item["tts_speech"].shape[-1]
+    return run
+
+@scenario("cosy_long")
+def cosy_long():
+    """长句流式合成, 60 个文本 token, 1200 个语音 token (48 秒), flow 增量推理, interval_ms 不随长度增长"""
+    return _cosy_long(True)
+
+@scenario("cosy_long_prefix")
+def cosy_long_prefix():
+    """同 cosy_long, flow 每段重算整个前缀"""
+    return _cosy_long(False)
+
+def _join_threads():
+    """等待运行中启动的线程 (例如 CosyVoice 的 LLM 线程) 结束, 计入引擎真正空闲的时间"""
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+@scenario("cosy_barge_in")
+def cosy_barge_in():
+    """同 cosy_stream, 收到第一个片段后用户打断 (关闭生成器), wall_seconds 为引擎直到完全空闲的耗时"""
+    from . import tiny
+    model = tiny.build_cosyvoice2()
+    inputs = tiny.cosy_inputs()
+    def run():
+        chunks = model.tts(stream = True, **inputs)
+        item = next(chunks)
+        chunks.close()
+        _join_threads()
+        yield tiny.COSY_SAMPLE_RATE, item["tts_speech"].shape[-1]
+    return run
+
+@scenario("cosy_llm")
+def cosy_llm():
+    """只运行 Qwen2LM.inference, 语音 token 为 25Hz, 按 token 数换算音频时长"""
+    import torch
+    from . import tiny
+    tiny.seed()
+    llm = tiny.build_cosy_llm()
+    inputs = tiny.cosy_inputs()
+    def run():
+        text, prompt_text, prompt_token = inputs["text"], inputs["prompt_text"], inputs["llm_prompt_speech_token"]
+        for _ in llm.inference(
+            text = text,
+            text_len = torch.tensor([text.shape[1]], dtype=torch.int32),
+            prompt_text = prompt_text,
+            prompt_text_len = torch.tensor([prompt_text.shape[1]], dtype=torch.int32),
+            prompt_speech_token = prompt_token,
+            prompt_speech_token_len = torch.tensor([prompt_token.shape[1]], dtype=torch.int32),
+            embedding = inputs["llm_embedding"],
+        ):
+            yield 25, 1
+    return run
+
+def _cosy_llm_concurrent(scheduler: bool, sessions: int = 8):
+    import queue
+    import torch
+    from . import tiny
+    from cosyvoice.llm.scheduler import DecodeScheduler, DecodeSession
+    tiny.seed()
+    llm = tiny.build_cosy_llm()
+    inputs = tiny.cosy_inputs()
+    text, prompt_text, prompt_token = inputs["text"], inputs["prompt_text"], inputs["llm_prompt_speech_token"]
+    args = dict(
+        text = text,
+        text_len = torch.tensor([text.shape[1]], dtype=torch.int32),
+        prompt_text = prompt_text,
+        prompt_text_len = torch.tensor([prompt_text.shape[1]], dtype=torch.int32),
+        prompt_speech_token = prompt_token,
+        prompt_speech_token_len = torch.tensor([prompt_token.shape[1]], dtype=torch.int32),
+    )
+    decoder = DecodeScheduler(llm, max_batch = sessions) if scheduler else None
+    def session(tokens: queue.Queue):
+        try:
+            if decoder is not None:
+                lm_input, min_len, max_len = llm.prepare_input(**args)
+                decoder.submit(DecodeSession(lm_input, prompt_text, min_len, max_len, tokens.put)).wait()
+            else:
+                for token in llm.inference(embedding = inputs["llm_embedding"], **args):
+                    tokens.put(token)
+        finally:
+            tokens.put(None)
+    def run():
+        tokens = queue.Queue()
+        for _ in range(sessions):
+            threading.Thread(target = session, args = (tokens,)).start()
+        ended = 0
+        while ended < sessions:
+            if tokens.get() is None:
+                ended += 1
+            else:
+                yield 25, 1
+    return run
+
+@scenario("cosy_llm_batch")
+def cosy_llm_batch():
+    """8 个会话同时解码语音 token, DecodeScheduler 每步一次批量前向, 对比 cosy_llm_threads 看 throughput"""
+    return _cosy_llm_concurrent(True)
+
+@scenario("cosy_llm_threads")
+def cosy_llm_threads():
+    """同 cosy_llm_batch, 每个会话在自己的线程中运行 Qwen2LM.inference"""
+    return _cosy_llm_concurrent(False)
+
+@scenario("cosy_hift")
+def cosy_hift():
+    """只运行 HiFTGenerator.inference, 200 帧 mel (4 秒)"""
+    import torch
+    from . import tiny
+    tiny.seed()
+    hift = tiny.build_cosy_hift()
+    mel = torch.randn(1, 80, 200, generator=torch.Generator().manual_seed(tiny.SEED))
+    def run():
+        with torch.inference_mode():
+            speech, _ = hift.inference(speech_feat = mel)
+        yield tiny.COSY_SAMPLE_RATE, speech.shape[-1]
+    return run
+
+def _sovits(batch: int, barge_in: int = 0):
+    import torch
+    from . import tiny
+    t2s, vits, data = tiny.build_sovits()
+    inputs = tiny.sovits_inputs(batch = batch)
+    upsample_rate = data["hop_length"] // 2
+    stop_event = threading.Event()
+    if barge_in:
+        # 第 barge_in 步解码时用户打断
+        steps = [0]
+        def hook(module, args, output):
+            steps[0] += 1
+            if steps[0] == barge_in:
+                stop_event.set()
+        t2s.ar_predict_layer.register_forward_hook(hook)
+    def run():
+        stop_event.clear()
+        if barge_in:
+            steps[0] = 0
+        # 与 TTS.run 的并行推理一致: t2s 批量解码, vits 拼接后一次解码再按长度切分
+        with torch.no_grad():
+            phones = inputs["phones"]
+            pred_semantic, idx_list = t2s.infer_panel_batch_infer(
+                phones,
+                torch.LongTensor([item.shape[0] for item in phones]),
+                inputs["prompt"],
+                inputs["bert_features"],
+                top_k = 5, top_p = 1, temperature = 1, repetition_penalty = 1.35,
+                # 50Hz, 3 秒
+                early_stop_num = 150,
+                max_len = max(item.shape[0] for item in phones),
+                stop_event = stop_event,
+            )
+            if stop_event.is_set():
+                # TTS.run 打断后不再进行 vits 解码
+                yield data["sampling_rate"], 0
+                return
+            pred_semantic = [item[-idx:] for item, idx in zip(pred_semantic, idx_list)]
+            audio = vits.decode(
+                torch.cat(pred_semantic).unsqueeze(0).unsqueeze(0),
+                torch.cat(phones).unsqueeze(0),
+                inputs["refer_spec"],
+            )
+        for item in pred_semantic:
+            yield data["sampling_rate"], item.shape[0] * 2 * upsample_rate
+    return run
+
+@scenario("sovits")
+def sovits():
+    """GPT-SoVITS t2s + vits, 一句 40 个音素, 固定生成 150 个语义 token (3 秒)"""
+    return _sovits(1)
+
+@scenario("sovits_batch")
+def sovits_batch():
+    """同 sovits, 4 句一批"""
+    return _sovits(4)
+
+@scenario("sovits_barge_in")
+def sovits_barge_in():
+    """同 sovits, 第 10 步解码时用户打断, wall_seconds 为打断后引擎空闲的耗时"""
+    return _sovits(1, barge_in = 10)
+
+def _sense(batch: int, seconds: float):
+    import torch
+    import numpy as np
+    from . import tiny
+    model, frontend, tokenizer = tiny.build_sensevoice()
+    rng = np.random.default_rng(tiny.SEED)
+    audio = [(rng.standard_normal(int(16000 * seconds)) * 0.1).astype(np.float32) for _ in range(batch)]
+    def run():
+        with torch.no_grad():
+            model.inference(
+                audio, key = ["bench%d" % i for i in range(batch)],
+                tokenizer = tokenizer, frontend = frontend, device = "cpu", language = "auto", use_itn = True,
+            )
+        for item in audio:
+            yield 16000, item.shape[0]
+    return run
+
+@scenario("sense")
+def sense():
+    """SenseVoiceSmall.inference, 一段 10 秒音频"""
+    return _sense(1, 10)
+
+@scenario("sense_batch")
+def sense_batch():
+    """SenseVoiceSmall.inference, 8 段 5 秒音频一批"""
+    return _sense(8, 5)
+
+
+def run_scenario(name: str, warmup: int, repeat: int, threads: int) -> dict:
+    """在子进程中执行, 返回中位数"""
+    import torch
+    torch.set_num_threads(threads)
+    start = time.perf_counter()
+    run = SCENARIOS[name]()
+    build = time.perf_counter() - start
+
+    walls, ttfcs, intervals, seconds = [], [], [], 0.0
+    for i in range(warmup + repeat):
+        first, last, gaps, seconds = None, None, [], 0.0
+        start = time.perf_counter()
+        for sr, samples in run():
+            now = time.perf_counter()
+            if first is None:
+                first = now - start
+            else:
+                gaps.append(now - last)
+            last = now
+            seconds += samples / sr
+        wall = time.perf_counter() - start
+        if i >= warmup:
+            walls.append(wall)
+            ttfcs.append(first)
+            intervals.extend(gaps)
+    wall = statistics.median(walls)
+    result = {
+        "audio_seconds": round(seconds, 3),
+        "wall_seconds": round(wall, 4),
+        "rtf": round(wall / seconds, 4) if seconds else None,
+        "throughput": round(seconds / wall, 3),
+        "ttfc_ms": round(statistics.median(ttfcs) * 1000, 1),
+        "interval_ms": round(statistics.median(intervals) * 1000, 1) if intervals else None,
+        "build_seconds": round(build, 2),
+        # linux 下 ru_maxrss 的单位为 KB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if torch.cuda.is_available():
+        result["peak_cuda_mb"] = round(torch.cuda.max_memory_allocated() / 2**20, 1)
+    return result
+
+def environment(threads: int) -> dict:
+    import torch
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "threads": threads,
+    }
+
+COLUMNS = ["wall_seconds", "rtf", "throughput", "ttfc_ms", "interval_ms", "peak_rss_mb"]
+
+def print_results(results: dict, baseline: dict = None):
+    print("scenario\t" + "\t".join(COLUMNS))
+    for name, result in results.items():
+        if "error" in result:
+            print("%s\terror: %s" % (name, result["error"]))
+            continue
+        cells = []
+        for column in COLUMNS:
+            cell = "%s" % result.get(column)
+            base = (baseline or {}).get(name, {}).get(column)
+            if base and result.get(column) is not None:
+                cell += " (%+.1f%%)" % ((result[column] - base) / base * 100)
+            cells.append(cell)
+        print(name + "\t" + "\t".join(cells))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", nargs = "+", choices = list(SCENARIOS), default = list(SCENARIOS))
+    parser.add_argument("--warmup", type = int, default = 1)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--threads", type = int, default = 4, help = "torch 的线程数, 对比时需保持一致")
+    parser.add_argument("--out", default = None, help = "结果写入的 JSON 文件")
+    parser.add_argument("--compare", default = None, help = "之前的结果 JSON, 列出变化")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        baseline = previous["results"]
+        print("compare with %s (%s)" % (args.compare, previous["env"].get("commit", "")))
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in args.scenario:
+        with ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+            try:
+                results[name] = pool.submit(run_scenario, name, args.warmup, args.repeat, args.threads).result()
+            except Exception as e:
+                results[name] = { "error": "%s: %s" % (type(e).__name__, e) }
+        print(name, results[name], file = sys.stderr)
+    print_results(results, baseline)
+
+    if args.out is not None:
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok = True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({ "env": environment(args.threads), "results": results }, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+对比 torch.load 与打包权重 (python -m core.convert 生成的 .mmap.pt) 在多个工作进程下的加载耗时与内存
+
+    python -m benchmark.load_weights --checkpoint model_pretrained/CosyVoice2-0.5B/flow.pt --workers 4
+    python -m benchmark.load_weights --synthetic 512 --workers 4
+
+每个工作进程加载一次权重并读完所有张量 (相当于推理前的状态), 然后等待其他进程也加载完,
+此时读取 /proc/self/smaps_rollup, 共享的页面会在 Pss 中按进程数分摊; private 即每多一个进程增加的内存。
+两种方式都在页面缓存已热的情况下测量。
+"""
+import os
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+def memory() -> dict[str, float]:
+    """单位 MB"""
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "private": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
+
+def worker(path: str, mmap: bool, barrier, results):
+    import torch
+    before = memory()
+    start = time.perf_counter()
+    if mmap:
+        state = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    else:
+        state = torch.load(path, map_location="cpu")
+    if "weight" in state and isinstance(state["weight"], dict):
+        state = state["weight"]
+    if mmap:
+        # 读一遍所有张量, mmap 的页面才会真正映射进来, 之后直接 assign 给模型
+        for tensor in state.values():
+            tensor.sum()
+    else:
+        # 相当于 load_state_dict 复制进 float32 的参数, 原来的字典随后释放
+        state = { k: v.float() for k, v in state.items() if isinstance(v, torch.Tensor) }
+    elapsed = time.perf_counter() - start
+    barrier.wait()
+    after = memory()
+    results.put({ "load": elapsed, **{ k: after[k] - before[k] for k in after } })
+    # 所有进程都测量完之后再退出, 共享页面的分摊才准确
+    barrier.wait()
+
+def run(path: str, mmap: bool, workers: int) -> list[dict]:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(path, mmap, barrier, results)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    items = [results.get() for _ in range(workers)]
+    for p in processes:
+        p.join()
+    return items
+
+def warm(path: str):
+    with open(path, "rb") as f:
+        while f.read(1 << 24):
+            pass
+
+def synthetic(size_mb: int, directory: str) -> str:
+    """size_mb 的 float32 权重, 每个张量 4MB; 原始文件为 fp16, 与 GPT-SoVITS 的权重一致"""
+    import torch
+    from core.convert import pack_tensors, save
+    count = max(size_mb // 4, 1)
+    state = { "layer%d.weight" % i: torch.randn(1024, 1024).half() for i in range(count) }
+    path = os.path.join(directory, "synthetic.pt")
+    torch.save(state, path)
+    save(pack_tensors(state), os.path.join(directory, "synthetic.mmap.pt"))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", default = None, help = "原始权重, 旁边需要有转换好的 .mmap.pt")
+    parser.add_argument("--synthetic", type = int, default = 256, help = "没有指定权重时, 生成的随机权重大小 (MB)")
+    parser.add_argument("--workers", type = int, default = 4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.checkpoint if args.checkpoint is not None else synthetic(args.synthetic, directory)
+        packed = os.path.splitext(path)[0] + ".mmap.pt"
+        print("original %s %.1fMB, packed %s %.1fMB, workers %d" % (
+            path, os.path.getsize(path) / 2**20, packed, os.path.getsize(packed) / 2**20, args.workers))
+
+        print("mode\tload_s\trss_mb\tpss_mb\tprivate_mb")
+        for mode, file, mmap in [("torch.load", path, False), ("mmap", packed, True)]:
+            warm(file)
+            items = run(file, mmap, args.workers)
+            print("%s\t%.3f\t%.1f\t%.1f\t%.1f" % (
+                mode,
+                statistics.median(item["load"] for item in items),
+                statistics.mean(item["rss"] for item in items),
+                statistics.mean(item["pss"] for item in items),
+                statistics.mean(item["private"] for item in items),
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+本地的 OpenAI 兼容 LLM 替身, 按设定的速率回放脚本中的回复, 用于离线压测整个语音对话链路
+
+    python -m benchmark.mock_llm --port 8001 --rate 30 --ttft 300
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=mock OPENAI_MODEL=mock python server.py
+
+--script 为文本文件, 每行一条回复, 按请求顺序轮流返回; 回复按字切分为增量。
+"""
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import fastapi
+import uvicorn
+
+REPLIES = [
+    "哈哈，你说的这个我也超有感觉的！最近我也在想类似的事情，你是怎么开始对这个感兴趣的呀？",
+    "真的假的？听起来好有意思，我之前去旅行的时候也遇到过差不多的情况，后来还挺难忘的。",
+    "嗯嗯，我懂你的意思。换作是我，可能也会犹豫一下，不过我觉得你已经做得很好啦。",
+]
+
+def create_app(replies: list[str], rate: float, ttft: float, chunk: int) -> fastapi.FastAPI:
+    """
+    :param rate: 每秒输出的字数
+    :param ttft: 首个增量之前的等待 (秒)
+    :param chunk: 每个增量包含的字数
+    """
+    app = fastapi.FastAPI()
+    script = itertools.cycle(replies)
+
+    def completion_chunk(cid: str, model: str, delta: dict, finish_reason: str = None):
+        return "data: %s\n\n" % json.dumps({
+            "id": cid,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{ "index": 0, "delta": delta, "finish_reason": finish_reason }]
+        }, ensure_ascii=False)
+
+    @app.get("/v1/models")
+    async def models():
+        return { "object": "list", "data": [{ "id": "mock", "object": "model", "owned_by": "mock" }] }
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: fastapi.Request):
+        body = await request.json()
+        model = body.get("model") or "mock"
+        reply = next(script)
+        cid = "chatcmpl-mock-%d" % time.time_ns()
+        if not body.get("stream", False):
+            await asyncio.sleep(ttft + len(reply) / rate)
+            return {
+                "id": cid,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": { "role": "assistant", "content": reply },
+                    "finish_reason": "stop"
+                }],
+                "usage": { "prompt_tokens": 0, "completion_tokens": len(reply), "total_tokens": len(reply) }
+            }
+
+        async def stream():
+            yield completion_chunk(cid, model, { "role": "assistant", "content": "" })
+            await asyncio.sleep(ttft)
+            start = time.perf_counter()
+            for i in range(0, len(reply), chunk):
+                # 按绝对时间对齐, 避免 sleep 的误差累积
+                await asyncio.sleep(max(start + i / rate - time.perf_counter(), 0))
+                yield completion_chunk(cid, model, { "content": reply[i: i + chunk] })
+            yield completion_chunk(cid, model, {}, "stop")
+            yield "data: [DONE]\n\n"
+        return fastapi.responses.StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8001)
+    parser.add_argument("--script", default = None, help = "回复脚本, 每行一条")
+    parser.add_argument("--rate", type = float, default = 30, help = "每秒输出的字数")
+    parser.add_argument("--ttft", type = float, default = 300, help = "首个增量之前的等待 (ms)")
+    parser.add_argument("--chunk", type = int, default = 1, help = "每个增量包含的字数")
+    args = parser.parse_args()
+
+    replies = REPLIES
+    if args.script is not None:
+        with open(args.script, "r", encoding="utf-8") as f:
+            replies = [line.strip() for line in f if len(line.strip())]
+    app = create_app(replies, args.rate, args.ttft / 1000, args.chunk)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+CosyVoice2 语音 token 采样的耗时, 对比逐元素循环的旧实现、向量化的 ras_sampling 与批量的 RasSampler
+
+    python -m benchmark.sampling
+    python -m benchmark.sampling --device cuda --batch 1 8 32
+
+每个 token 的采样包括把 token 取回主机 (.item() / .tolist()), 与 Qwen2LM.inference 和 DecodeScheduler 一致;
+批量采样的耗时按行数分摊到每个 token。logp 为随机的对数概率, 词表为 6561 个语音 token 加 3 个特殊 token。
+RasSampler 每步为所有行准备重复时的随机采样, 单行时比 ras_sampling 慢, 因此 DecodeScheduler 只有一个会话时使用 ras_sampling。
+"""
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.append("model")
+
+import torch
+
+VOCAB = 6561 + 3
+EOS = 6561
+PARAMS = dict(top_p = 0.8, top_k = 25, win_size = 10, tau_r = 0.1)
+
+def loop_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    """向量化之前的 nucleus_sampling"""
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    return indices[prob.multinomial(1, replacement=True)]
+
+def loop_ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    """向量化之前的 ras_sampling"""
+    from cosyvoice.utils.common import random_sampling
+    top_ids = loop_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+    return top_ids
+
+def logits(tokens: int, batch: int, device: str) -> torch.Tensor:
+    g = torch.Generator().manual_seed(0)
+    # 语音 token 的分布较尖锐, 放大随机 logit 使 top_p 在前几个 token 内截断
+    return (torch.randn(tokens, batch, VOCAB, generator=g) * 4).log_softmax(dim=-1).to(device)
+
+def per_row(sampling, tokens: int, device: str) -> float:
+    """逐行采样, 返回每个 token 的耗时 (us)"""
+    logp = logits(tokens, 1, device)
+    decoded = []
+    start = time.perf_counter()
+    for i in range(tokens):
+        top_ids = sampling(logp[i, 0], decoded, 25, **PARAMS).item()
+        if top_ids < EOS:
+            decoded.append(top_ids)
+    return (time.perf_counter() - start) / tokens * 1e6
+
+def batched(batch: int, tokens: int, device: str) -> float:
+    """RasSampler 一次采样 batch 行, 返回分摊到每个 token 的耗时 (us)"""
+    from cosyvoice.utils.common import RasSampler
+    logp = logits(tokens, batch, device)
+    ignore_eos = torch.zeros(batch, dtype=torch.bool, device=device)
+    sampler = RasSampler(EOS, torch.device(device))
+    for _ in range(batch):
+        sampler.add(**PARAMS)
+    start = time.perf_counter()
+    for i in range(tokens):
+        sampler.sample(logp[i], ignore_eos).tolist()
+    return (time.perf_counter() - start) / tokens / batch * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default = "cpu")
+    parser.add_argument("--tokens", type = int, default = 500, help = "每次测量采样的 token 数")
+    parser.add_argument("--batch", type = int, nargs = "+", default = [1, 8, 32], help = "RasSampler 的行数")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--threads", type = int, default = 1)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    from cosyvoice.utils.common import ras_sampling
+    cases = [("loop", lambda: per_row(loop_ras_sampling, args.tokens, args.device)),
+             ("ras_sampling", lambda: per_row(ras_sampling, args.tokens, args.device))]
+    cases += [("RasSampler x%d" % b, lambda b=b: batched(b, args.tokens, args.device)) for b in args.batch]
+
+    print("device %s, vocab %d, %d tokens x %d" % (args.device, VOCAB, args.tokens, args.repeat))
+    print("sampler\tus_per_token")
+    for name, fn in cases:
+        # 第一次运行作为预热
+        fn()
+        print("%s\t%.1f" % (name, statistics.median(fn() for _ in range(args.repeat))))
+
+if __name__ == "__main__":
+    main()
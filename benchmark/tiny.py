@@ -0,0 +1,254 @@
+"""
+按各引擎的结构搭建缩小的随机权重模型, 不需要预训练权重和 GPU
+
+层数和宽度缩小, 但保留会影响调度和流式切分的参数 (采样率、帧率、token 与 mel 的比例、词表等),
+因此调用路径、片段长度与线上一致, 只是每一步的计算量更小。随机权重下几乎不会生成 EOS,
+mask_tokens 屏蔽停止符, 让自回归部分固定跑满最大长度, 不同提交之间的工作量相同。
+"""
+from __future__ import annotations
+import sys
+sys.path.append("./model")
+sys.path.append("./model/GPT_SoVITS")
+import json
+import functools
+import torch
+import numpy as np
+
+SEED = 1234
+
+def seed(value: int = SEED):
+    torch.manual_seed(value)
+    np.random.seed(value)
+
+def mask_tokens(linear: torch.nn.Module, ids: list[int]):
+    """输出层的 forward hook, 这些 token 的 logit 固定为 -inf"""
+    def hook(module, args, output):
+        output[..., ids] = -float("inf")
+        return output
+    return linear.register_forward_hook(hook)
+
+
+# CosyVoice2, 对应 CosyVoice2-0.5B/cosyvoice.yaml
+COSY_SPEECH_TOKEN_SIZE = 6561
+COSY_TEXT_VOCAB = 1000
+COSY_SAMPLE_RATE = 24000
+
+def build_qwen2_encoder():
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    from cosyvoice.llm.llm import Qwen2Encoder
+
+    encoder = Qwen2Encoder.__new__(Qwen2Encoder)
+    torch.nn.Module.__init__(encoder)
+    # 原模型为 Qwen2.5-0.5B: 24 层, 896 维, 151936 的词表
+    encoder.model = Qwen2ForCausalLM(Qwen2Config(
+        vocab_size = COSY_TEXT_VOCAB,
+        hidden_size = 64,
+        intermediate_size = 128,
+        num_hidden_layers = 2,
+        num_attention_heads = 2,
+        num_key_value_heads = 1,
+        max_position_embeddings = 4096,
+    ))
+    return encoder
+
+def build_cosy_llm():
+    from cosyvoice.llm.llm import Qwen2LM
+    from cosyvoice.utils.common import ras_sampling
+
+    llm = Qwen2LM(
+        llm_input_size = 64,
+        llm_output_size = 64,
+        speech_token_size = COSY_SPEECH_TOKEN_SIZE,
+        llm = build_qwen2_encoder(),
+        sampling = functools.partial(ras_sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1),
+        length_normalized_loss = True,
+        lsm_weight = 0,
+    )
+    # eos 与 fill token 都不采样, 固定生成 max_token_text_ratio 倍文本长度的 token
+    mask_tokens(llm.llm_decoder, [COSY_SPEECH_TOKEN_SIZE, COSY_SPEECH_TOKEN_SIZE + 1, COSY_SPEECH_TOKEN_SIZE + 2])
+    return llm.eval()
+
+def build_cosy_flow():
+    from omegaconf import DictConfig
+    from cosyvoice.flow.flow import CausalMaskedDiffWithXvec
+    from cosyvoice.flow.decoder import ConditionalDecoder
+    from cosyvoice.flow.flow_matching import CausalConditionalCFM
+    from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder
+
+    # PreLookaheadLayer 固定为 512 通道, 编码器只减少层数
+    encoder = UpsampleConformerEncoder(
+        input_size = 512, output_size = 512, attention_heads = 4, linear_units = 512, num_blocks = 2,
+        dropout_rate = 0.1, positional_dropout_rate = 0.1, attention_dropout_rate = 0.1,
+        normalize_before = True, input_layer = "linear", pos_enc_layer_type = "rel_pos_espnet",
+        selfattention_layer_type = "rel_selfattn", use_cnn_module = False, macaron_style = False,
+    )
+    estimator = ConditionalDecoder(
+        in_channels = 320, out_channels = 80, causal = True, channels = [64], dropout = 0.0,
+        attention_head_dim = 32, n_blocks = 1, num_mid_blocks = 2, num_heads = 2, act_fn = "gelu",
+    )
+    decoder = CausalConditionalCFM(
+        in_channels = 240, n_spks = 1, spk_emb_dim = 80, estimator = estimator,
+        cfm_params = DictConfig({
+            "sigma_min": 1e-06, "solver": "euler", "t_scheduler": "cosine",
+            "training_cfg_rate": 0.2, "inference_cfg_rate": 0.7, "reg_loss_type": "l1",
+        }),
+    )
+    flow = CausalMaskedDiffWithXvec(
+        input_size = 512, output_size = 80, spk_embed_dim = 192, output_type = "mel",
+        vocab_size = COSY_SPEECH_TOKEN_SIZE, input_frame_rate = 25, only_mask_loss = True,
+        token_mel_ratio = 2, pre_lookahead_len = 3, encoder = encoder, decoder = decoder,
+    )
+    return flow.eval()
+
+def build_cosy_hift():
+    from cosyvoice.hifigan.generator import HiFTGenerator
+    from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+
+    # 上采样倍数不变 (每帧 mel 480 个采样点), 通道从 512 降到 64
+    hift = HiFTGenerator(
+        in_channels = 80, base_channels = 64, nb_harmonics = 8, sampling_rate = COSY_SAMPLE_RATE,
+        nsf_alpha = 0.1, nsf_sigma = 0.003, nsf_voiced_threshold = 10,
+        upsample_rates = [8, 5, 3], upsample_kernel_sizes = [16, 11, 7],
+        istft_params = {"n_fft": 16, "hop_len": 4},
+        resblock_kernel_sizes = [3], resblock_dilation_sizes = [[1, 3, 5]],
+        source_resblock_kernel_sizes = [7, 7, 11], source_resblock_dilation_sizes = [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        lrelu_slope = 0.1, audio_limit = 0.99,
+        f0_predictor = ConvRNNF0Predictor(num_class = 1, in_channels = 80, cond_channels = 64),
+    )
+    return hift.eval()
+
+def build_cosyvoice2():
+    from cosyvoice.cli.model import CosyVoice2Model
+
+    seed()
+    model = CosyVoice2Model(build_cosy_llm(), build_cosy_flow(), build_cosy_hift(), fp16 = False)
+    model.llm.to(model.device)
+    model.flow.to(model.device)
+    model.hift.to(model.device)
+    return model
+
+def build_cosyvoice2_stub(token_delay: float = 0.005, tokens: int = 200):
+    """只测量 CosyVoice2Model.tts 的调度与 token 交接: LLM 每 token_delay 秒产出一个语音 token,
+    token2wav 不计算, 直接返回对应长度的静音; 不需要 transformers 等依赖
+    """
+    import time
+    import types
+    from cosyvoice.cli.model import CosyVoice2Model
+
+    class StubLLM(torch.nn.Module):
+        def inference(self, **kwargs):
+            for i in range(tokens):
+                time.sleep(token_delay)
+                yield i % COSY_SPEECH_TOKEN_SIZE
+
+    class StubFlow(torch.nn.Module):
+        input_frame_rate = 25
+        token_mel_ratio = 2
+        pre_lookahead_len = 3
+        def __init__(self):
+            super().__init__()
+            self.encoder = types.SimpleNamespace()
+            self.decoder = types.SimpleNamespace(estimator = types.SimpleNamespace())
+
+    model = CosyVoice2Model(StubLLM(), StubFlow(), torch.nn.Module(), fp16 = False)
+    # 25Hz 的语音 token, 24kHz 下每个 token 对应 960 个采样点; 不是最后一段时末尾的 lookahead 留给下一段
+    def token2wav(token, token_offset, finalize = False, **kwargs):
+        return torch.zeros(1, (token.shape[1] - token_offset - (0 if finalize else StubFlow.pre_lookahead_len)) * 960)
+    model.token2wav = token2wav
+    return model
+
+def cosy_inputs(text_len: int = 10, prompt_text_len: int = 8, prompt_token_len: int = 50) -> dict:
+    """CosyVoice2Model.tts 的参数, 对应前端处理后的零样本输入"""
+    g = torch.Generator().manual_seed(SEED)
+    prompt_token = torch.randint(0, COSY_SPEECH_TOKEN_SIZE, (1, prompt_token_len), generator=g, dtype=torch.int32)
+    embedding = torch.randn(1, 192, generator=g)
+    return dict(
+        text = torch.randint(0, COSY_TEXT_VOCAB, (1, text_len), generator=g, dtype=torch.int32),
+        prompt_text = torch.randint(0, COSY_TEXT_VOCAB, (1, prompt_text_len), generator=g, dtype=torch.int32),
+        llm_prompt_speech_token = prompt_token,
+        flow_prompt_speech_token = prompt_token,
+        prompt_speech_feat = torch.randn(1, prompt_token_len * 2, 80, generator=g),
+        llm_embedding = embedding,
+        flow_embedding = embedding,
+    )
+
+
+# GPT-SoVITS v2, 对应 s1 的 yaml 与 configs/s2.json
+SOVITS_EOS = 1024
+
+def build_t2s():
+    from AR.models.t2s_model import Text2SemanticDecoder
+
+    # 原模型为 24 层, 512 维
+    config = {"model": {
+        "hidden_dim": 64, "embedding_dim": 64, "head": 2, "n_layer": 2,
+        "vocab_size": SOVITS_EOS + 1, "phoneme_vocab_size": 732, "dropout": 0, "EOS": SOVITS_EOS,
+    }}
+    t2s = Text2SemanticDecoder(config)
+    mask_tokens(t2s.ar_predict_layer, [SOVITS_EOS])
+    return t2s.eval()
+
+def build_vits():
+    from module.models import SynthesizerTrn
+
+    with open("model/GPT_SoVITS/configs/s2.json", "r", encoding="utf-8") as f:
+        hps = json.load(f)
+    kwargs = dict(hps["model"])
+    # MRTE 固定为 192 维内容与 512 维音色, 只减少层数和声码器的通道
+    kwargs.update(
+        filter_channels = 128, n_layers = 2,
+        resblock_kernel_sizes = [3], resblock_dilation_sizes = [[1, 3, 5]],
+        upsample_initial_channel = 64, version = "v2",
+    )
+    data = hps["data"]
+    vits = SynthesizerTrn(
+        data["filter_length"] // 2 + 1,
+        hps["train"]["segment_size"] // data["hop_length"],
+        n_speakers = data["n_speakers"],
+        **kwargs
+    )
+    if hasattr(vits, "enc_q"):
+        del vits.enc_q
+    return vits.eval(), data
+
+def build_sovits():
+    seed()
+    return build_t2s(), *build_vits()
+
+def sovits_inputs(phones: int = 40, prompt_semantic: int = 100, refer_frames: int = 150, batch: int = 1) -> dict:
+    """TTS.run 送入 t2s 与 vits 的参数, 对应文本前端和参考音频处理之后"""
+    g = torch.Generator().manual_seed(SEED)
+    return dict(
+        phones = [torch.randint(0, 732, (phones,), generator=g) for _ in range(batch)],
+        bert_features = [torch.randn(1024, phones, generator=g) for _ in range(batch)],
+        prompt = torch.randint(0, SOVITS_EOS, (1, prompt_semantic), generator=g).expand(batch, -1),
+        refer_spec = [torch.randn(1, 1025, refer_frames, generator=g)],
+    )
+
+
+# SenseVoiceSmall, 对应 SenseVoiceSmall/config.yaml
+SENSE_VOCAB = 25055
+
+class Tokenizer:
+    """只用于把 token id 拼成文本, 随机权重下输出本身没有意义"""
+    def decode(self, ids: list[int]) -> str:
+        return " ".join(map(str, ids))
+
+def build_sensevoice():
+    from funasr.frontends.wav_frontend import WavFrontend
+    from SensorVoice.model import SenseVoiceSmall
+
+    seed()
+    # 原模型为 50 + 20 层, 512 维
+    model = SenseVoiceSmall(
+        encoder = "SenseVoiceEncoderSmall",
+        encoder_conf = {
+            "output_size": 64, "attention_heads": 2, "linear_units": 128, "num_blocks": 3, "tp_blocks": 1,
+            "dropout_rate": 0.1, "positional_dropout_rate": 0.1, "attention_dropout_rate": 0.1,
+            "kernel_size": 11, "sanm_shfit": 0, "normalize_before": True,
+        },
+        input_size = 560,
+        vocab_size = SENSE_VOCAB,
+    )
+    frontend = WavFrontend(fs = 16000, window = "hamming", n_mels = 80, frame_length = 25, frame_shift = 10, lfr_m = 7, lfr_n = 6)
+    return model.eval(), frontend, Tokenizer()
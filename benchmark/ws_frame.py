@@ -0,0 +1,46 @@
+"""
+/ws 单帧音频的服务端 CPU 开销: json + base64 与二进制帧
+
+只统计从收到 websocket 消息到得到 float32 样本的部分, 不含 VAD / ASR;
+json 路径没有计入 pydantic 校验, 实际开销略高。
+    python -m benchmark.ws_frame --sampleRate 48000 --ms 333
+"""
+import time
+import json
+import base64
+import argparse
+import numpy as np
+
+from core.utils.audio import encode_frame, decode_frame
+
+def decode_json(text: str) -> np.ndarray:
+    data = json.loads(text)
+    blob = base64.b64decode(data["param"]["audio"])
+    return np.frombuffer(blob, dtype=np.int16).astype(np.float32)
+
+def bench(fn, data, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(data)
+    return (time.perf_counter() - start) * 1e6 / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sampleRate", type = int, default = 48000)
+    parser.add_argument("--ms", default = "20,100,333", help = "单帧音频时长")
+    parser.add_argument("--repeat", type = int, default = 2000)
+    args = parser.parse_args()
+
+    print("frame(ms)\tjson(bytes)\tbinary(bytes)\tjson(us)\tbinary(us)\tspeedup")
+    for ms in args.ms.split(","):
+        n = int(args.sampleRate * float(ms) / 1000)
+        array = (np.random.randn(n) * 3000).clip(-32768, 32767).astype(np.int16)
+        text = json.dumps({"action": "record", "param": {"audio": base64.b64encode(array.tobytes()).decode()}})
+        frame = encode_frame(array)
+        assert (decode_json(text) == decode_frame(frame)).all()
+        t_json = bench(decode_json, text, args.repeat)
+        t_binary = bench(decode_frame, frame, args.repeat)
+        print("%s\t\t%d\t\t%d\t\t%.1f\t\t%.1f\t\t%.1fx" % (ms, len(text), len(frame), t_json, t_binary, t_json / t_binary))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+把预训练权重转换为可以 mmap 加载的打包格式, 写在原文件旁边 (xxx.pt -> xxx.mmap.pt), 加载时自动优先使用
+
+    python -m core.convert cosy model_pretrained/CosyVoice2-0.5B
+    python -m core.convert sovits model_pretrained/GPT_SoVITS/s1.ckpt model_pretrained/GPT_SoVITS/s2G.pth
+
+打包时只保留推理需要的内容 (去掉 hift 的 generator. 前缀、sovits 的 enc_q 与优化器状态),
+浮点张量统一为 float32, 每个张量独立连续存储 (共享权重仍然共享), cpu 上可以直接 assign 到模型而不复制。
+"""
+from __future__ import annotations
+import os
+import sys
+import time
+import argparse
+import torch
+sys.path.append("./model")
+# 加载时 (CosyVoice 与 GPT-SoVITS 共用) 按同一个规则找到打包权重
+from cosyvoice.utils.file_utils import packed_checkpoint_path
+
+def pack_tensors(state: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    packed, seen = {}, {}
+    for name, tensor in state.items():
+        # 绑定的权重 (例如词嵌入与输出层) 只保存一份
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tuple(tensor.stride()))
+        if key not in seen:
+            value = tensor.detach().float() if tensor.is_floating_point() else tensor.detach()
+            seen[key] = value.contiguous().clone()
+        packed[name] = seen[key]
+    return packed
+
+def save(obj, path: str):
+    tmp = path + ".tmp"
+    torch.save(obj, tmp)
+    # 加载时使用 weights_only, 这里先确认能读回来, 例如 config 中不能有自定义类型
+    torch.load(tmp, map_location="cpu", mmap=True, weights_only=True)
+    os.replace(tmp, path)
+
+def convert(src: str, fn) -> str:
+    start = time.perf_counter()
+    dst = packed_checkpoint_path(src)
+    save(fn(torch.load(src, map_location="cpu")), dst)
+    print("%s -> %s, %.1fMB -> %.1fMB, %.2fs" % (
+        src, dst, os.path.getsize(src) / 2**20, os.path.getsize(dst) / 2**20, time.perf_counter() - start))
+    return dst
+
+def convert_cosy(model_dir: str):
+    convert(os.path.join(model_dir, "llm.pt"), pack_tensors)
+    convert(os.path.join(model_dir, "flow.pt"), pack_tensors)
+    convert(os.path.join(model_dir, "hift.pt"),
+            lambda state: pack_tensors({k.replace("generator.", ""): v for k, v in state.items()}))
+
+def convert_sovits(path: str):
+    """GPT (s1 的 .ckpt) 与 SoVITS (s2 的 .pth) 都是 {config, weight} 的结构"""
+    def fn(ckpt: dict):
+        # 推理时会删除 enc_q, 不需要保存
+        weight = { k: v for k, v in ckpt["weight"].items() if not k.startswith("enc_q.") }
+        return { "config": ckpt["config"], "weight": pack_tensors(weight) }
+    convert(path, fn)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("engine", choices = ["cosy", "sovits"])
+    parser.add_argument("paths", nargs = "+", help = "cosy 为模型目录, sovits 为 GPT / SoVITS 权重文件")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if args.engine == "cosy":
+            convert_cosy(path)
+        else:
+            convert_sovits(path)
+
+if __name__ == "__main__":
+    main()
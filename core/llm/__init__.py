@@ -3,7 +3,7 @@
 """
 from __future__ import annotations
 from pydantic import BaseModel
-from typing_extensions import Literal, List, Generator, Callable
+from typing_extensions import Literal, List, AsyncGenerator, Callable
 
 class ChatResponse(BaseModel):
     type: Literal[
@@ -21,7 +21,7 @@ class ChatMessage(BaseModel):
     ]
     content: str
 
-Chat = Callable[[List[ChatMessage]], Generator[ChatResponse]]
+AsyncChat = Callable[[List[ChatMessage]], AsyncGenerator[ChatResponse]]
 
 class ChatManager():
     # 定义保存数据的位置
@@ -85,40 +85,39 @@ reponse language should be Chinese."""
             })
         return messages
 
-    def check_llm_message(self, chat: Chat):
-        """检查llm消息是否达到上限
-        注意，该方法应该定时调用
-        """
+    def history(self) -> str:
         messages = ""
         for m in self.cache:
             if m.role == "user":
                 messages += "用户:'%s'\n" % m.content
             else:
                 messages += "研究者:'%s'\n" % m.content
-        if len(messages) < self.MAX_LEN:
-            return
-        self.summary_llm_message(chat)
+        return messages
 
-    def summary_llm_message(self, chat: Chat):
-        """
-        总结概括 llm 里面的消息队列
+    async def acheck_llm_message(self, chat: AsyncChat):
+        """检查llm消息是否达到上限, 达到时总结概括
+        注意，该方法应该定时调用
         """
-        messages = ""
-        for m in self.cache:
-            if m.role == "user":
-                messages += "用户:'%s'\n" % m.content
-            else:
-                messages += "研究者:'%s'\n" % m.content
+        if len(self.history()) < self.MAX_LEN:
+            return
+        await self.asummary_llm_message(chat)
 
-        for resp in chat([
+    def summary_messages(self):
+        return [
             { "role": "system", "content": self.PROMPT_ABSTRACT },
-            { "role": "user", "content": "下面是先前访谈的内容:\n%s" % messages}
-        ]):
-            continue
+            { "role": "user", "content": "下面是先前访谈的内容:\n%s" % self.history()}
+        ]
 
+    def set_summary(self, summary: str):
         self.cache = [
             ChatMessage(role="user", content="我会提供给你之前聊天的内容，请你在理解后继续聊天"),
-            ChatMessage(role="user", content=resp.content)
+            ChatMessage(role="user", content=summary)
         ]
 
-
+    async def asummary_llm_message(self, chat: AsyncChat):
+        """
+        总结概括 llm 里面的消息队列
+        """
+        async for resp in chat(self.summary_messages()):
+            continue
+        self.set_summary(resp.content)
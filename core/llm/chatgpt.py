@@ -1,60 +1,88 @@
 from __future__ import annotations
 import os
 import re
+import httpx
 import openai
-from typing import Generator
+from typing import AsyncGenerator
 
 from . import ChatResponse, ChatMessage
 
-client = openai.OpenAI(
+# 异步客户端, 所有请求共享同一个连接池
+aclient = openai.AsyncOpenAI(
     base_url = os.getenv("OPENAI_BASE_URL", None),
-    api_key  = os.getenv("OPENAI_API_KEY", None)
-)
-
-def chat(messages: list[ChatMessage]) -> Generator[ChatResponse]:
-    response = client.chat.completions.create(
-        model = os.getenv("OPENAI_MODEL", None),
-        messages = messages,
-        max_tokens = 8192,
-        temperature = 0.7,
-        stream = True
+    api_key  = os.getenv("OPENAI_API_KEY", None),
+    timeout  = httpx.Timeout(float(os.getenv("OPENAI_TIMEOUT", 30)), connect = 5.0),
+    max_retries = 1,
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits = httpx.Limits(
+            max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20)),
+        )
     )
+)
 
-    # 因为用流式处理，需要进行断句。当一句完成后再返回。
-    # 最后将整个句子保存
-    global_content = []
-    content = []
-    for resp in response:
-        c: str = resp.choices[0].delta.content
-        if c is None:
-            continue
-        global_content.append(c)
-        yield ChatResponse(type = "char", content = c)
+class SentenceSplitter:
+    """流式输出需要断句, 一句完成后再返回"""
+    def __init__(self) -> None:
+        self.content = []
 
+    def feed(self, c: str) -> str | None:
+        content = self.content
         pattern = re.search(r"[,\.!\?，。？！、]", c)
         if pattern and len("".join(content).strip()) > 10:
             [spos, epos] = pattern.span()
             if spos == 0:
                 # 分段的时候在开头
                 msg = "".join(content) + c[spos]
-                content = [c[spos:]] if len(c) > 1 else []
+                self.content = [c[spos:]] if len(c) > 1 else []
             elif epos == len(c):
                 # 分段的时候在结尾
                 msg = "".join(content + [c])
-                content = []
+                self.content = []
             else:
                 # 分段在中间
-                [stext, etext] = c.split(c[spos])
+                [stext, etext] = c.split(c[spos], 1)
                 msg = "".join(content + [f"{stext}{c[spos]}"])
-                content = [etext]
-            yield ChatResponse(type = "sentence", content = msg)
-        else:
-            content.append(c)
-    if len(content):
+                self.content = [etext]
+            return msg
+        content.append(c)
+        return None
+
+    def flush(self) -> str | None:
         # 还有剩下的内容
-        yield ChatResponse(type = "sentence", content = "".join(content))
+        msg = "".join(self.content)
+        self.content = []
+        return msg if len(msg) else None
 
-    yield ChatResponse(type = "finish", content = "".join(global_content))
 
+async def achat(messages: list[ChatMessage]) -> AsyncGenerator[ChatResponse]:
+    """流式对话, 断句后逐句返回, 不阻塞事件循环; 任务被取消时 (例如客户端断开) 会关闭上游连接"""
+    response = await aclient.chat.completions.create(
+        model = os.getenv("OPENAI_MODEL", None),
+        messages = messages,
+        max_tokens = 8192,
+        temperature = 0.7,
+        stream = True
+    )
 
+    # 因为用流式处理，需要进行断句。当一句完成后再返回。
+    # 最后将整个句子保存
+    global_content = []
+    splitter = SentenceSplitter()
+    async with response:
+        async for resp in response:
+            if not len(resp.choices):
+                continue
+            c: str = resp.choices[0].delta.content
+            if not c:
+                continue
+            global_content.append(c)
+            yield ChatResponse(type = "char", content = c)
+            msg = splitter.feed(c)
+            if msg is not None:
+                yield ChatResponse(type = "sentence", content = msg)
+    msg = splitter.flush()
+    if msg is not None:
+        yield ChatResponse(type = "sentence", content = msg)
 
+    yield ChatResponse(type = "finish", content = "".join(global_content))
@@ -1,43 +1,132 @@
 from __future__ import annotations
+import os
 import sys
 sys.path.append("./model")
+import hashlib
 import torch
 import numpy as np
 from typing import Generator
-from io import BytesIO
+from concurrent.futures import Future
 
 from model.cosyvoice.cli.cosyvoice import CosyVoice2
 from model.cosyvoice.utils.file_utils import load_wav
 
-from ..utils.audio import wave_header_chunk, pack_audio
+from ..utils.audio import stream_encoder
+from ..utils.executor import get_executor, CancelToken, blocking
+from ..utils.admission import get_admission, Ticket
+from ..utils.cache import audio_cache, AudioChunks
+from ..utils.metrics import Gauge, measure_rtf
+from ..utils.registry import register_model
 
+MODEL_DIR = 'model_pretrained/CosyVoice2-0.5B'
 def load():
-    return CosyVoice2('model_pretrained/CosyVoice2-0.5B', load_jit=False, load_trt=False, fp16=False)
-cosyvoice: CosyVoice2 = load()
+    model = CosyVoice2(MODEL_DIR, load_jit=False, load_trt=False, fp16=False)
+    # 流式合成时 flow 每段只编码/解码新的 token, 每段耗时不随句子长度增长; 设为 0 时每段重算整个前缀
+    model.model.flow_incremental = os.getenv("COSY_INCREMENTAL_FLOW", "1") == "1"
+    # LLM 的 [sos, instruct / prompt 文本] 前缀的 KV cache, 各句与各会话之间复用, 预填充只计算新的文本
+    model.model.llm.enable_prefix_cache(int(os.getenv("COSY_PREFIX_CACHE_MB", 256)) * 2**20)
+    # 并发会话的语音 token 在同一个批次中解码, 新会话在步与步之间加入; 设为 1 时每个会话各自解码
+    model.model.enable_llm_scheduler(int(os.getenv("COSY_LLM_BATCH", 8)))
+    # 参考音频的 token / mel / 音色向量只提取一次, 保存在 spk2info.pt 中, 之后每句只传 PROMPT_ID
+    model.add_zero_shot_spk("", prompt_speech_16k, PROMPT_ID, text_frontend=False)
+    return model
+def warmup(model: CosyVoice2):
+    for _ in model.inference_instruct2("你好。", INSTRUCT_TEXT, None, zero_shot_spk_id=PROMPT_ID, stream=True, text_frontend=False):
+        pass
+cosyvoice = register_model("cosy", load, warmup)
+executor = get_executor("cosy")
+admission = get_admission("cosy")
 
-def stream_io(tts_text: Generator[str]):
-    yield wave_header_chunk(sample_rate = cosyvoice.sample_rate)
+def _scheduler_stats(field: str):
+    scheduler = cosyvoice.get().model.llm_scheduler if cosyvoice.ready else None
+    return {} if scheduler is None else { ("cosy",): scheduler.stats()[field] }
+
+Gauge("speech_llm_batch_active", "Sessions decoded in the running LLM batch", ["engine"], lambda: _scheduler_stats("active"))
+Gauge("speech_llm_batch_pending", "Sessions waiting to join the LLM batch", ["engine"], lambda: _scheduler_stats("pending"))
+
+def stream_pcm(tts_text: Generator[str], bistream: bool = False, cancel: CancelToken = None,
+               ticket: Ticket = None) -> Generator[np.ndarray | Future]:
+    """合成并返回 int16 的 PCM 片段
+
+    等待 LLM 时不阻塞, 而是 yield 一个 Future (见 InferenceExecutor.stream), 引擎线程只用来合成。
+    :param tts_text: 默认每一项是一句完整的文本, 逐句合成; 可以是 iterate_async 返回的生成器
+    :param bistream: 每一项是 LLM 的增量文本, 整个生成器作为一次 bistream 会话送入 CosyVoice2,
+                     文本 token 与语音 token 交替解码, 不需要等待断句, 也只做一次 prefill;
+                     增量文本由 CosyVoice2 的 LLM 线程阻塞读取
+    :param cancel: 取消后 LLM 线程在下一个 token 停止, 不再合成后面的句子
+    :param ticket: admission.admit 的凭证, 降级时截短文本, 并测量实际的计算量
+    """
+    if ticket is not None:
+        tts_text = ticket.limit(tts_text)
+    if bistream:
+        # 文本事先未知, 无法使用缓存
+        chunks = measure_rtf("cosy", to_pcm(inference_instruct(blocking(tts_text), cancel, block = False)))
+        # 语音 token 在 LLM 线程中解码, 耗时中只有 flow / hift, 不计入准入控制的 rtf
+        for item in (chunks if ticket is None else ticket.measure(chunks, rtf = False)):
+            yield item if isinstance(item, Future) else item[1]
+        return
     for text in tts_text:
-        model_output = inference_instruct(text)
-        for item in model_output:
-            yield pack_audio(
-                BytesIO(),
-                (item["tts_speech"] * (2 ** 15)).numpy().astype(np.int16),
-                cosyvoice.sample_rate,
-                "raw"
-            ).getvalue()
+        if isinstance(text, Future):
+            # LLM 的下一句还没到
+            yield text
+            continue
+        if cancel is not None and cancel.is_set():
+            return
+        for _, pcm in synthesize(text, cancel, ticket):
+            yield pcm
+
+def to_pcm(model_output: ModelOutput) -> AudioChunks:
+    sample_rate = cosyvoice.get().sample_rate
+    for item in model_output:
+        if isinstance(item, Future):
+            yield item
+            continue
+        yield sample_rate, (item["tts_speech"] * (2 ** 15)).numpy().astype(np.int16).reshape(-1)
+
+def synthesize(text: str, cancel: CancelToken = None, ticket: Ticket = None) -> AudioChunks:
+    """合成一句文本, 相同的文本与音色直接从音频缓存中返回; 被取消的合成不写入缓存"""
+    key = audio_cache.key(text, engine = "cosyvoice2", model = MODEL_DIR,
+                          prompt = PROMPT_ID, instruct = INSTRUCT_TEXT)
+    def factory():
+        chunks = measure_rtf("cosy", to_pcm(inference_instruct(text, cancel)))
+        return chunks if ticket is None else ticket.measure(chunks, len(text))
+    return audio_cache.cached(key, factory, cancel = cancel)
+
+def stream_io(tts_text: Generator[str], bistream: bool = False, media_type: str = "wav",
+              cancel: CancelToken = None, ticket: Ticket = None):
+    """
+    :param media_type: wav / raw / ogg / aac / opus, 整个响应共用一个编码器
+    """
+    encoder = stream_encoder(media_type, cosyvoice.get().sample_rate)
+    try:
+        for pcm in stream_pcm(tts_text, bistream, cancel, ticket):
+            if isinstance(pcm, Future):
+                yield pcm
+                continue
+            data = encoder.write(pcm)
+            if len(data):
+                yield data
+        yield encoder.close()
+    finally:
+        encoder.abort()
 
 prompt_speech_16k = load_wav("model_pretrained/ssy_short.wav", 16000)
+# 参考音频的指纹, 作为音频缓存键的一部分, 也是它在 spk2info 中的 id
+PROMPT_ID = hashlib.sha256(prompt_speech_16k.numpy().tobytes()).hexdigest()
+INSTRUCT_TEXT = "用爱慕且温柔的语气说话"
 ModelOutput = Generator[dict[str, torch.Tensor], None, None]
-def inference_zero_shot(tts_text: str) -> ModelOutput:
-    return cosyvoice.inference_sft(
+def inference_zero_shot(tts_text: str, cancel: CancelToken = None) -> ModelOutput:
+    return cosyvoice.get().inference_sft(
         tts_text, spk_id = "中文女",
-        stream = True, text_frontend = False
+        stream = True, text_frontend = False, stop_event = cancel
     )
 
-def inference_instruct(tts_text: str) -> ModelOutput:
-    return cosyvoice.inference_instruct2(
-        tts_text, "用爱慕且温柔的语气说话", 
-        prompt_speech_16k, stream=True, text_frontend=False
+def inference_instruct(tts_text: str, cancel: CancelToken = None, block: bool = True) -> ModelOutput:
+    """
+    :param block: False 时等待语音 token 不阻塞, 而是 yield 一个 Future (见 InferenceExecutor.stream)
+    """
+    return cosyvoice.get().inference_instruct2(
+        tts_text, INSTRUCT_TEXT, None, zero_shot_spk_id=PROMPT_ID,
+        stream=True, text_frontend=False, stop_event=cancel, block=block
     )
 
@@ -1,10 +1,17 @@
 import re
+import math
+import time
+import threading
 import numpy as np
+import soundfile as sf
 import torch
 import torchaudio
+import torchaudio.compliance.kaldi as kaldi
 from io import BytesIO
 from funasr.utils.postprocess_utils import rich_transcription_postprocess
+from funasr.frontends.wav_frontend import apply_cmvn
 
+from typing import Tuple, List
 from enum import Enum
 class Language(str, Enum):
     auto = "auto"
@@ -23,6 +30,10 @@ class Response(BaseModel):
 
 import os
 from funasr import AutoModel
+from ..utils.executor import get_executor
+from ..utils.batcher import MicroBatcher
+from ..utils.metrics import RTF
+from ..utils.registry import register_model
 def load_model():
     return AutoModel(
         model=os.getenv("SENSE_MODEL", "model_pretrained/SenseVoiceSmall"),
@@ -32,64 +43,214 @@ def load_model():
         vad_kwargs={"max_single_segment_time": 30000},
         device=os.getenv("SENSE_DEVICE", "cuda"),
     )
-model: AutoModel = load_model()
+def warmup(instance: AutoModel):
+    silence = torch.zeros(SAMPLE_RATE)
+    instance.model.inference(data_in = [silence], key = ["warmup"], language = "auto", use_itn = False,
+                             fs = SAMPLE_RATE, **instance.kwargs)
+    instance.vad_model.inference(data_in = [silence], key = ["warmup"], fs = SAMPLE_RATE, **instance.vad_kwargs)
+model = register_model("sensor", load_model, warmup)
+# ASR 与 VAD 共用同一个模型实例, 因此共用一个执行器
+executor = get_executor("sensor")
+# 上传音频的解码和重采样只占用 CPU, 不与模型排队
+decode_executor = get_executor("decode")
 
-def asr(file_wav: bytes, lang: Language = "auto"):
-    file_io = BytesIO(file_wav)
-    data_or_path_or_list, audio_fs = torchaudio.load(file_io)
-    data_or_path_or_list = data_or_path_or_list.mean(0)
-    file_io.close()
+def _response(text: str) -> Response:
+    return Response(
+        raw_text = text,
+        text = rich_transcription_postprocess(text),
+        clean_text = re.sub(r"<\|.*\|>", "", text, 0, re.MULTILINE),
+    )
+
+SAMPLE_RATE = 16000
+_resamplers: dict[int, torchaudio.transforms.Resample] = {}
+_resamplers_lock = threading.Lock()
+
+def resample(array: torch.Tensor, sampleRate: int) -> torch.Tensor:
+    """重采样到 16k, 每个源采样率的卷积核只计算一次"""
+    if sampleRate == SAMPLE_RATE:
+        return array
+    with _resamplers_lock:
+        if sampleRate not in _resamplers:
+            _resamplers[sampleRate] = torchaudio.transforms.Resample(sampleRate, SAMPLE_RATE)
+        resampler = _resamplers[sampleRate]
+    return resampler(array.float())
+
+def decode(file_wav: bytes) -> Tuple[torch.Tensor, int]:
+    """把上传的音频直接在内存中解码为 16k 单声道 float32, 不启动子进程, 也不写临时文件
+
+    wav / flac / ogg / mp3 由 soundfile 解码, 其它容器 (例如浏览器录制的 webm) 交给 torchaudio 的 ffmpeg 后端。
+    """
+    try:
+        data, audio_fs = sf.read(BytesIO(file_wav), dtype="float32", always_2d=True)
+        array = torch.from_numpy(data.mean(1))
+    except RuntimeError:
+        array, audio_fs = torchaudio.load(BytesIO(file_wav))
+        array = array.mean(0)
+    return resample(array, audio_fs), SAMPLE_RATE
 
-    res = model.model.inference(data_in = [data_or_path_or_list],
+def asr_batch(arrays: List[torch.Tensor], sampleRate: int, lang: Language = "auto") -> List[Response]:
+    """一次编码器前向处理多条音频, fbank 提取时会自动 padding, 结果顺序与输入一致"""
+    start = time.perf_counter()
+    arrays = [resample(array, sampleRate) for array in arrays]
+    sampleRate = SAMPLE_RATE
+    sense = model.get()
+    res = sense.model.inference(data_in = arrays,
+                                key = [str(i) for i in range(len(arrays))],
                                 language = lang,
                                 use_itn = False,
                                 ban_emo_unk = False,
-                                fs = audio_fs,
-                                **model.kwargs)
+                                fs = sampleRate,
+                                **sense.kwargs)
     torch.cuda.empty_cache()
-    for item in res[0]:
-        return Response(
-            raw_text = item["text"],
-            text = rich_transcription_postprocess(item["text"]),
-            clean_text = re.sub(r"<\|.*\|>", "", item["text"], 0, re.MULTILINE),
-        )
-
-def asr_adv(file_path: str, lang: Language = "auto"):
-    if not os.path.exists(file_path):
-        return {}
-
-    res = model.generate([file_path], cache = {},
+    seconds = sum(array.shape[-1] for array in arrays) / SAMPLE_RATE
+    if seconds > 0:
+        RTF.observe((time.perf_counter() - start) / seconds, engine = "sensor")
+    return [_response(item["text"]) for item in res[0]]
+
+def asr(file_wav: bytes, lang: Language = "auto"):
+    data_or_path_or_list, audio_fs = decode(file_wav)
+    return asr_batch([data_or_path_or_list], audio_fs, lang)[0]
+
+def asr_adv(array: torch.Tensor, lang: Language = "auto"):
+    """长音频, 先用 VAD 切分再识别; array 为 decode 返回的 16k 音频"""
+    res = model.get().generate([array], cache = {}, fs = SAMPLE_RATE,
                          lanuage = lang, use_itn=True,
                          batch_size=1,
                          merge_vad=True, merge_length_s=15)
-    text = res[0]["text"]
-    return Response(
-        raw_text = text,
-        text = rich_transcription_postprocess(text),
-        clean_text = re.sub(r"<\|.*\|>", "", text, 0, re.MULTILINE)
-    )
+    return _response(res[0]["text"])
 
 def asr_array(array: np.ndarray, sampleRate: int, lang: Language = "auto"):
-    res = model.model.inference(data_in = torch.from_numpy(array),
-                                language = lang,
-                                fs = sampleRate,
-                                use_itn = False,
-                                ban_emo_unk = False,
-                                **model.kwargs)
-    torch.cuda.empty_cache()
-    for item in res[0]:
-        return Response(
-            raw_text = item["text"],
-            text = rich_transcription_postprocess(item["text"]),
-            clean_text = re.sub(r"<\|.*\|>", "", item["text"], 0, re.MULTILINE),
-        )
+    return asr_batch([torch.from_numpy(array)], sampleRate, lang)[0]
 
-from typing import Tuple, List
+# 跨请求合并: 并发的识别请求会在 SENSE_MAX_WAIT 毫秒内合并成一个批次
+batcher = MicroBatcher(
+    "sensor", executor, asr_batch,
+    max_batch = int(os.getenv("SENSE_MAX_BATCH", 8)),
+    max_wait = float(os.getenv("SENSE_MAX_WAIT", 10)) / 1000,
+    size = lambda array: array.shape[-1],
+)
+
+async def asr_async(array: torch.Tensor, sampleRate: int, lang: Language = "auto") -> Response:
+    return await batcher.run(array, sampleRate, lang)
+
+class StreamingASR:
+    """流式识别会话
+
+    新到的音频只做增量的 fbank / LFR / CMVN, 按固定块送入编码器 (缓存注意力与 FSMN 状态),
+    说话过程中即可得到部分识别结果。分块编码只看到 lookahead 帧之后的音频, 准确率低于整句识别,
+    因此端点时的最终结果仍由 asr_async 对整句音频识别得到。
+    """
+    # (left, stride, lookahead), 单位为 LFR 帧 (60ms)
+    CHUNK_SIZE = tuple(int(i) for i in os.getenv("SENSE_CHUNK", "0,10,5").split(","))
+
+    def __init__(self, lang: Language = "auto") -> None:
+        self.lang = lang
+        self.frontend = model.get().kwargs["frontend"]
+        self.samples = torch.zeros(0)                     # 还不够一帧 fbank 的样本
+        self.fbank = torch.zeros(0, self.frontend.n_mels) # 还不够一帧 LFR 的 fbank
+        self.fbank_total = 0
+        self.lfr_total = 0
+        self.cache = {}
+
+    def _fbank(self, waveform: torch.Tensor) -> torch.Tensor:
+        fe = self.frontend
+        frame_length = int(fe.fs * fe.frame_length / 1000)
+        frame_shift = int(fe.fs * fe.frame_shift / 1000)
+        samples = torch.cat((self.samples, waveform))
+        if samples.shape[0] < frame_length:
+            self.samples = samples
+            return torch.zeros(0, fe.n_mels)
+        n = (samples.shape[0] - frame_length) // frame_shift + 1
+        # fbank 的每一帧相互独立 (snip_edges), 分段计算与整段计算结果一致
+        mat = kaldi.fbank(samples[: (n - 1) * frame_shift + frame_length][None, :],
+                          num_mel_bins = fe.n_mels,
+                          frame_length = fe.frame_length,
+                          frame_shift = fe.frame_shift,
+                          dither = fe.dither,
+                          energy_floor = 0.0,
+                          window_type = fe.window,
+                          sample_frequency = fe.fs)
+        self.samples = samples[n * frame_shift:]
+        return mat
+
+    def _lfr(self, mat: torch.Tensor, is_final: bool) -> torch.Tensor:
+        # 与 apply_lfr 一致: 开头补 (lfr_m - 1) // 2 个首帧, 结尾不足的用最后一帧补齐
+        lfr_m, lfr_n = self.frontend.lfr_m, self.frontend.lfr_n
+        if self.fbank_total == 0 and mat.shape[0]:
+            mat = torch.cat((mat[0].repeat((lfr_m - 1) // 2, 1), mat))
+        self.fbank_total += mat.shape[0]
+        fbank = torch.cat((self.fbank, mat))
+        n = max((fbank.shape[0] - lfr_m) // lfr_n + 1, 0)
+        if is_final and self.fbank_total:
+            n = math.ceil((self.fbank_total - (lfr_m - 1) // 2) / lfr_n) - self.lfr_total
+            pad = n * lfr_n + lfr_m - lfr_n - fbank.shape[0]
+            if pad > 0:
+                fbank = torch.cat((fbank, fbank[-1].repeat(pad, 1)))
+        lfr = [fbank[i * lfr_n: i * lfr_n + lfr_m].reshape(1, -1) for i in range(n)]
+        self.lfr_total += n
+        self.fbank = fbank[n * lfr_n:]
+        if not len(lfr):
+            return torch.zeros(0, lfr_m * mat.shape[1])
+        lfr = torch.cat(lfr)
+        if self.frontend.cmvn is not None:
+            lfr = apply_cmvn(lfr, self.frontend.cmvn)
+        return lfr
+
+    def accept(self, array: np.ndarray, sampleRate: int, is_final: bool = False) -> Response:
+        """送入新的音频, 返回到目前为止的识别结果"""
+        waveform = resample(torch.from_numpy(array).float(), sampleRate)
+        if self.frontend.upsacle_samples:
+            waveform = waveform * (1 << 15)
+        feats = self._lfr(self._fbank(waveform), is_final)
+        sense = model.get()
+        text = sense.model.inference_chunk(feats, self.cache,
+                                           chunk_size = self.CHUNK_SIZE,
+                                           is_final = is_final,
+                                           language = self.lang,
+                                           use_itn = False,
+                                           ban_emo_unk = False,
+                                           **sense.kwargs)
+        if is_final:
+            torch.cuda.empty_cache()
+        return _response(text)
 
 VADItem = List[dict[str, List[List[int]]]]
 VADParam = dict[str, float]
 
 def vad_array(array: np.ndarray, sampleRate: int) -> Tuple[VADItem, VADParam]:
-    [items, param] = model.vad_model.inference(data_in = [array], key = ["temp"], fs = sampleRate, **model.vad_kwargs)
+    sense = model.get()
+    [items, param] = sense.vad_model.inference(data_in = [array], key = ["temp"], fs = sampleRate, **sense.vad_kwargs)
     torch.cuda.empty_cache()
     return items, param
+
+
+# 句尾静音超过这个时长 (ms) 即认为一句话结束, 与原先整段 VAD 后的判断一致; FSMN 默认的 800ms 会推迟每一轮的回复
+END_SILENCE_MS = int(os.getenv("VAD_END_SILENCE_MS", 200))
+
+# 流式 VAD 每次处理的音频块 (ms)
+VAD_CHUNK_MS = 200
+
+def vad_block(sampleRate: int) -> int:
+    """一个 VAD 块在 sampleRate 下的样本数, 送入 vad_stream 的音频除最后一次外都应是它的整数倍"""
+    return sampleRate * VAD_CHUNK_MS // 1000
+
+def vad_stream(array: np.ndarray, sampleRate: int, cache: dict, is_final: bool = False) -> List[List[int]]:
+    """流式 VAD, 每次只处理新增的音频, 模型状态 (fbank 缓存、FSMN 记忆等) 保存在 cache 中
+
+    返回本次新检测到的事件 [[beg, end], ...], 单位 ms, 从 cache 创建时开始计时;
+    尚未确定的一端为 -1, 例如 [[1200, -1]] 表示开始说话, [[-1, 3400]] 表示说话结束。
+    非 is_final 时 array 的长度须是 vad_block 的整数倍: 不足一块的余数 funasr 会把前面已处理的音频
+    留在 cache["prev_samples"] 中, 下次重复送入且越积越多, 因此余数由调用方保留到下一次。
+    """
+    array = resample(torch.from_numpy(array), sampleRate)
+    sense = model.get()
+    vad = sense.vad_model
+    # max_end_silence_time 作为参数传入时 init_cache 会改写共享的 vad_opts, 影响 vad_array 与 asr_adv;
+    # 这里只改本会话 cache 中的阈值, is_final 后 funasr 会重建 stats, 因此每次都设置
+    if not len(cache):
+        vad.init_cache(cache)
+    cache["stats"].max_end_sil_frame_cnt_thresh = END_SILENCE_MS - vad.vad_opts.speech_to_sil_time_thres
+    [items, _] = vad.inference(data_in = [array], key = ["stream"], fs = SAMPLE_RATE,
+                               cache = cache, is_final = is_final, chunk_size = VAD_CHUNK_MS,
+                               **sense.vad_kwargs)
+    return items[0]["value"] if len(items) else []
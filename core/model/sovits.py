@@ -1,23 +1,37 @@
 import os
 import sys
 import json
+import asyncio
 from io import BytesIO
 from typing import Generator
 
 sys.path.append("./model/GPT_SoVITS")
+# TTS_infer_pack.TTS 使用 cosyvoice.utils.file_utils 加载打包权重
+sys.path.append("./model")
 from model.GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
 from model.GPT_SoVITS.TTS_infer_pack.text_segmentation_method import get_method_names as get_cut_method_names
 
-from ..utils.cache import cache
-from ..utils.audio import wave_header_chunk, pack_audio
+from ..utils.cache import cache, audio_cache, AudioChunks
+from ..utils.audio import pack_audio, stream_encoder
+from ..utils.executor import get_executor, ExecutorBusy, CancelToken
+from ..utils.admission import get_admission, Ticket
+from ..utils.metrics import measure_rtf
+from ..utils.registry import register_model
 
 tts_config = TTS_Config(os.getenv("GPT_SoVITS", "model_pretrained/GPT_SoVITS/tts_infer.yaml"))
-tts_pipeline = TTS(tts_config)
-tts_pipeline.set_prompt_cache(
-    os.getenv("PROMPT_AUDIO", "model_pretrained/GPT_SoVITS/ssy.wav"),
-    os.getenv("PROMPT_TEXT", "的就是，你的能力表现会越接近的话，那你的那个大脑的活动，激活的模式，可能也会越相似。"),
-    "zh"
-)
+PROMPT_AUDIO = os.getenv("PROMPT_AUDIO", "model_pretrained/GPT_SoVITS/ssy.wav")
+PROMPT_TEXT = os.getenv("PROMPT_TEXT", "的就是，你的能力表现会越接近的话，那你的那个大脑的活动，激活的模式，可能也会越相似。")
+def load():
+    pipeline = TTS(tts_config)
+    pipeline.set_prompt_cache(PROMPT_AUDIO, PROMPT_TEXT, "zh")
+    return pipeline
+def warmup(pipeline: TTS):
+    req = TTS_Request(text = "你好。", text_lang = "zh")
+    for _ in pipeline.run(prepare(req.model_dump())):
+        pass
+tts_pipeline = register_model("sovits", load, warmup)
+executor = get_executor("sovits")
+admission = get_admission("sovits")
 
 def check_params(req:dict):
     text:str = req.get("text", "")
@@ -32,7 +46,7 @@ def check_params(req:dict):
         raise ValueError("text_lang is required")
     elif text_lang.lower() not in tts_config.languages:
         raise ValueError(f"text_lang: {text_lang} is not supported in version {tts_config.version}")
-    if media_type not in ["wav", "raw", "ogg", "aac"]:
+    if media_type not in ["wav", "raw", "ogg", "aac", "opus"]:
         raise ValueError(f"media_type: {media_type} is not supported")
     elif media_type == "ogg" and  not streaming_mode:
         raise ValueError("ogg format is not supported in non-streaming mode")
@@ -40,34 +54,94 @@ def check_params(req:dict):
         raise ValueError(f"text_split_method:{text_split_method} is not supported")
     return None
 
-async def tts_handle(req:dict):
+# 影响合成结果的参数, 作为音频缓存键的一部分
+CACHE_PARAMS = [
+    "text_lang", "ref_audio_path", "aux_ref_audio_paths", "prompt_lang", "prompt_text",
+    "top_k", "top_p", "temperature", "text_split_method", "batch_size", "batch_threshold",
+    "split_bucket", "speed_factor", "fragment_interval", "seed", "repetition_penalty",
+    "return_fragment",
+]
+
+def cache_key(req:dict):
+    params = {k: req.get(k) for k in CACHE_PARAMS}
+    return audio_cache.key(req["text"], engine = "gpt-sovits", model = tts_config.version,
+                           t2s = tts_config.t2s_weights_path, vits = tts_config.vits_weights_path,
+                           default_prompt = [PROMPT_AUDIO, PROMPT_TEXT], **params)
+
+def failed(sr:int, chunk):
+    # 合成失败时 TTS.run 返回 1 秒静音, 不能写入缓存
+    return chunk.shape[0] == sr and not chunk.any()
+
+def prepare(req:dict):
+    check_params(req)
+    if req.get("streaming_mode", False) or req.get("return_fragment", False):
+        req["return_fragment"] = True
+    return req
+
+def synthesize(req:dict, ticket:Ticket = None) -> AudioChunks:
+    """相同的文本、音色和采样参数直接从音频缓存中返回; req["stop_event"] 被取消的合成不写入缓存
+
+    seed 为 -1 (默认) 时每次随机采样, 不使用缓存, 否则会一直返回第一次的结果
+    """
+    def factory():
+        chunks = measure_rtf("sovits", tts_pipeline.get().run(req))
+        return chunks if ticket is None else ticket.measure(chunks, len(req["text"]))
+    if req.get("seed", -1) in [-1, "", None]:
+        return factory()
+    return audio_cache.cached(cache_key(req), factory, failed, req.get("stop_event"))
+
+async def tts_handle(req:dict, cancel:CancelToken = None):
+    """
+    :param cancel: 客户端断开时取消, TTS.run 在下一步 t2s 解码时停止
+    """
     streaming_mode = req.get("streaming_mode", False)
-    return_fragment = req.get("return_fragment", False)
     media_type = req.get("media_type", "wav")
 
-    check_params(req)
+    prepare(req)
+    cancel = CancelToken() if cancel is None else cancel
+    # TTS.run 只把它当作 threading.Event 检查, 不属于 CACHE_PARAMS
+    req["stop_event"] = cancel
+    # 按文本长度估计计算量, 降级时截短文本 (缓存键随之改变), 超出承受能力时 503
+    ticket = admission.admit(len(req["text"]))
+    if ticket.degraded:
+        req["text"] = "".join(ticket.limit([req["text"]]))
 
-    if streaming_mode or return_fragment:
-        req["return_fragment"] = True
-    
     try:
-        tts_generator=tts_pipeline.run(req)
+        tts_generator=synthesize(req, ticket)
         
         if streaming_mode:
             def streaming_generator(tts_generator:Generator, media_type:str):
-                if media_type == "wav":
-                    yield wave_header_chunk()
-                    media_type = "raw"
-                for sr, chunk in tts_generator:
-                    yield pack_audio(BytesIO(), chunk, sr, media_type).getvalue()
+                # 整个响应共用一个编码器, 容器头只写一次
+                encoder = None
+                try:
+                    for sr, chunk in tts_generator:
+                        if encoder is None:
+                            encoder = stream_encoder(media_type, sr)
+                        data = encoder.write(chunk)
+                        if len(data):
+                            yield data
+                    if encoder is not None:
+                        yield encoder.close()
+                finally:
+                    if encoder is not None:
+                        encoder.abort()
             # _media_type = f"audio/{media_type}" if not (streaming_mode and media_type in ["wav", "raw"]) else f"audio/x-{media_type}"
-            return streaming_generator(tts_generator, media_type)
+            return await executor.stream(streaming_generator(tts_generator, media_type), cancel, ticket)
     
         else:
-            sr, audio_data = next(tts_generator)
-            audio_data = pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
-            return audio_data
+            def generate(tts_generator:Generator, media_type:str):
+                # 需要读完生成器, 结果才会写入音频缓存
+                sr, audio_data = list(tts_generator)[0]
+                return pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
+            try:
+                return await executor.run(generate, tts_generator, media_type, ticket = ticket)
+            except asyncio.CancelledError:
+                cancel.cancel()
+                raise
+    except ExecutorBusy:
+        raise
     except Exception as e:
+        ticket.release()
         raise RuntimeError("tts failed")
 
 from pydantic import BaseModel
@@ -88,7 +162,7 @@ class TTS_Request(BaseModel):
     speed_factor:float = 1.0                   # float. control the speed of the synthesized audio.
     fragment_interval:float = 0.3              # float. to control the interval of the audio fragment.
     seed:int = -1                              # int. random seed for reproducibility.
-    media_type:str = "wav"                     # str. media type of the output audio, support "wav", "raw", "ogg", "aac".
+    media_type:str = "wav"                     # str. media type of the output audio, support "wav", "raw", "ogg", "aac", "opus".
     streaming_mode:bool = False                # bool. whether to return a streaming response.
     parallel_infer:bool = True                 # bool.(optional) whether to use parallel inference.
     repetition_penalty:float = 1.35            # float.(optional) repetition penalty for T2S model.          
@@ -1,13 +1,26 @@
 from __future__ import annotations
+import time
 import fastapi
+from typing import Literal
 
-from ..model.cosy import stream_io
+from ..model.cosy import stream_io, executor, admission
+from ..utils.audio import MEDIA_TYPES
+from ..utils.metrics import instrument_stream
+from ..utils.executor import CancelToken
 
 router = fastapi.APIRouter(prefix = "/api")
 
 @router.post("/tts/cosy")
-async def speech_zero_shot(tts_text: str = fastapi.Form()):
+async def speech_zero_shot(tts_text: str = fastapi.Form(),
+                           media_type: Literal["wav", "raw", "ogg", "aac", "opus"] = fastapi.Form("wav")):
+    start = time.perf_counter()
+    # 客户端断开时取消, 合成在下一个 token 停止
+    cancel = CancelToken()
+    # 按文本长度估计计算量, 超出时截短或者 503
+    ticket = admission.admit(len(tts_text))
     return fastapi.responses.StreamingResponse(
-        stream_io([tts_text]),
-        media_type = "audio/wav"
+        instrument_stream(await executor.stream(stream_io([tts_text], media_type = media_type, cancel = cancel, ticket = ticket),
+                                                cancel, ticket),
+                          "/api/tts/cosy", "cosy", start),
+        media_type = MEDIA_TYPES[media_type]
     )
@@ -1,10 +1,11 @@
+import time
 import fastapi
 from fastapi.responses import JSONResponse
 from typing import List
 from typing_extensions import Annotated
 
-from ..model.sensor import asr, asr_adv, Language
-from ..utils.cache import cache
+from ..model.sensor import decode, asr_async, asr_adv, Language, executor, decode_executor
+from ..utils.metrics import server_timing
 
 router = fastapi.APIRouter(prefix="/api")
 
@@ -13,10 +14,13 @@ async def sensor_voice_asr(files: Annotated[List[fastapi.UploadFile], fastapi.Fi
                            lang: Annotated[Language, fastapi.Form(description="language of audio content")] = "auto"):
     file = files[0]
     blob = await file.read()
-    res = asr(blob, lang)
+    start = time.perf_counter()
+    array, audio_fs = await decode_executor.run(decode, blob)
+    decoded = time.perf_counter()
+    res = await asr_async(array, audio_fs, lang)
     return JSONResponse({
         "result": res.model_dump()
-    })
+    }, headers = server_timing("/api/asr/v1", decoded - start, time.perf_counter() - decoded))
 
 
 @router.post("/asr/v2")
@@ -24,10 +28,11 @@ async def sensor_voice_asr2(files: Annotated[List[fastapi.UploadFile], fastapi.F
                             lang: Annotated[Language, fastapi.Form(description="language of audio content")] = "auto"):
     file = files[0]
     blob = await file.read()
-    file_path = cache.get_path(cache.save(blob))
-
-    res = asr_adv(file_path, lang)
+    start = time.perf_counter()
+    array, _ = await decode_executor.run(decode, blob)
+    decoded = time.perf_counter()
+    res = await executor.run(asr_adv, array, lang)
     
     return JSONResponse({
         "result": res.model_dump()
-    })
+    }, headers = server_timing("/api/asr/v2", decoded - start, time.perf_counter() - decoded))
@@ -2,10 +2,13 @@ import sys
 sys.path.append("./model/GPT_SoVITS")
 
 import json
+import time
 import fastapi
 
 from ..model.sovits import TTS_Request, tts_handle
 from ..utils.cache import cache
+from ..utils.audio import MEDIA_TYPES
+from ..utils.metrics import instrument_stream
 
 router = fastapi.APIRouter(prefix="/api")
 
@@ -17,10 +20,16 @@ async def gpt_sovits(request: TTS_Request):
 
 @router.get("/tts/vits")
 async def generate_audio(id: str):
-    config: dict = json.loads(cache.load(id))
+    config = cache.load(id)
+    if config is None:
+        # 不存在或者已经过期
+        return fastapi.responses.JSONResponse(status_code=404, content={"detail": "request %s not found" % id})
+    config: dict = json.loads(config)
+    start = time.perf_counter()
     resp = await tts_handle(config)
+    media_type = MEDIA_TYPES.get(config.get('media_type', 'wav'), "audio/wav")
     if isinstance(resp, bytes):
-        return fastapi.Response(resp, media_type=f"audio/{config.get('media_type', 'wav')}")
+        return fastapi.Response(resp, media_type=media_type)
     else:
-        return fastapi.responses.StreamingResponse(resp, media_type=f"audio/{config.get('media_type', 'wav')}")
+        return fastapi.responses.StreamingResponse(instrument_stream(resp, "/api/tts/vits", "sovits", start), media_type=media_type)
 
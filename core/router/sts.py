@@ -1,37 +1,65 @@
 from  __future__ import annotations
+import os
+import time
 import fastapi
-from typing import Annotated, List
+from typing import Annotated, List, Literal
 router = fastapi.APIRouter()
 
 """
 LLM聊天管理
 """
 from ..llm import ChatManager
-from ..llm.chatgpt import chat
+from ..llm.chatgpt import achat
+from ..utils.executor import iterate_async, CancelToken
+from ..utils.metrics import LLM_TTFT, instrument_stream
 cm = ChatManager()
-def generate_msg():
+# 1: LLM 的增量直接送入 CosyVoice2 的 bistream, 不再等待断句; 0: 按句子合成
+BISTREAM = os.getenv("COSY_BISTREAM", "0") == "1"
+async def generate_msg(delta: bool = False, route: str = "/api/tts"):
+    """
+    :param delta: 返回 LLM 的增量文本, 否则返回完整的句子
+    """
     if len(cm.cache) and cm.cache[-1].role == "assistant":
         yield cm.cache[-1].content
     else:
-        for resp in chat(cm.get_llm_message()):
-            if resp.type == "sentence":
+        start = time.perf_counter()
+        async for resp in achat(cm.get_llm_message()):
+            if start is not None:
+                LLM_TTFT.observe(time.perf_counter() - start, route = route)
+                start = None
+            if resp.type == ("char" if delta else "sentence"):
                 yield resp.content
         cm.add_chat(resp.content, "assistant")
 
-from ..model.cosy import stream_io
+from ..model.cosy import stream_io, executor as cosy_executor, admission as cosy_admission
+from ..utils.audio import MEDIA_TYPES
 @router.get("/api/tts")
-async def tts():
-    return fastapi.responses.StreamingResponse(stream_io(generate_msg()), media_type="audio/wav")
+async def tts(media_type: Literal["wav", "raw", "ogg", "aac", "opus"] = "wav"):
+    # LLM 在事件循环中异步请求, 合成在 cosy 的线程中进行
+    start = time.perf_counter()
+    # 客户端断开时同时停止 LLM 的请求与合成
+    cancel = CancelToken()
+    # 在请求 LLM 之前准入, 回复的长度事先未知, 按默认字数估计
+    ticket = cosy_admission.admit()
+    text = iterate_async(generate_msg(BISTREAM), cancel)
+    return fastapi.responses.StreamingResponse(
+        instrument_stream(await cosy_executor.stream(stream_io(text, BISTREAM, media_type, cancel, ticket), cancel, ticket),
+                          "/api/tts", "cosy", start),
+        media_type = MEDIA_TYPES[media_type]
+    )
 
-from ..model.sensor import asr as sensor
-from ..utils.audio import webm2wav
+from ..model.sensor import decode, asr_async, decode_executor
+from ..utils.metrics import server_timing
 @router.post("/api/asr")
 async def asr(files: Annotated[List[bytes], fastapi.File(description="wav or mp3 audios in 16KHz")],
               lang: Annotated[str, fastapi.Form(description="language of audio content")] = "auto"):
-    resp = sensor(webm2wav(files[0]), lang)
+    start = time.perf_counter()
+    array, audio_fs = await decode_executor.run(decode, files[0])
+    decoded = time.perf_counter()
+    resp = await asr_async(array, audio_fs, lang)
     if len(resp.text):
         cm.add_chat(resp.text, "user")
     return fastapi.responses.JSONResponse({
         "history": list(map(lambda x: x.model_dump(), cm.cache))
-    })
+    }, headers = server_timing("/api/asr", decoded - start, time.perf_counter() - decoded))
 
@@ -0,0 +1,47 @@
+"""
+服务状态, 无论 ENABLE 如何配置都会挂载
+"""
+import fastapi
+
+from ..utils.executor import executors
+from ..utils.batcher import batchers
+from ..utils.admission import admissions
+from ..utils.cache import cache, audio_cache
+from ..utils.registry import models
+from ..utils import metrics
+
+router = fastapi.APIRouter(prefix = "/api")
+
+@router.get("/status")
+async def status():
+    return fastapi.responses.JSONResponse({
+        "models": [m.stats().model_dump() for m in models.values()],
+        "executors": [e.stats().model_dump() for e in executors.values()],
+        "admissions": [a.stats().model_dump() for a in admissions.values()],
+        "batchers": [b.stats() for b in batchers.values()],
+        "cache": cache.stats().model_dump(),
+        "audio_cache": audio_cache.stats().model_dump()
+    })
+
+
+@router.get("/metrics")
+async def prometheus():
+    # Prometheus 文本格式
+    return fastapi.responses.PlainTextResponse(metrics.render(), media_type = "text/plain; version=0.0.4")
+
+
+@router.get("/health/live")
+async def live():
+    # 进程和事件循环正常即可, 不关心模型是否加载完成
+    return fastapi.responses.JSONResponse({ "status": "alive" })
+
+
+@router.get("/health/ready")
+async def ready():
+    # 所有已登记的模型都加载并预热完成后才接收流量, 否则 503
+    items = [m.stats().model_dump() for m in models.values()]
+    ok = all(m.ready for m in models.values())
+    return fastapi.responses.JSONResponse({
+        "status": "ready" if ok else "loading",
+        "models": items
+    }, status_code = 200 if ok else 503)
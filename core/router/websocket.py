@@ -1,3 +1,4 @@
+import time
 import base64
 import fastapi
 import asyncio
@@ -5,8 +6,13 @@ import numpy as np
 from pydantic import BaseModel
 from typing import Literal
 
-from ..model.sensor import vad_array, asr_array
-from .sts import cm
+import torch
+from ..model.sensor import vad_stream, vad_block, asr_async, executor, StreamingASR
+from ..model.cosy import stream_pcm, cosyvoice, executor as cosy_executor, admission as cosy_admission
+from ..utils.audio import RingBuffer, decode_frame, encode_frame
+from ..utils.executor import ExecutorBusy, CancelToken, iterate_async
+from ..utils.metrics import VAD, ASR, timed, instrument_stream
+from .sts import cm, generate_msg, BISTREAM
 
 router = fastapi.APIRouter()
 @router.websocket("/ws")
@@ -21,54 +27,164 @@ class WebsocketMessage(BaseModel):
 
 
 class WebsocketClient:
+    # 环形缓冲区保存的最长音频, VAD 单段最长 30s
+    BUFFER_SECONDS = 40
+    # 送入 ASR 的音频在 VAD 起点之前多保留一点, 避免切掉第一个字
+    SPEECH_PAD_MS = 100
+
     def __init__(self, ws: fastapi.WebSocket) -> None:
         self.ws = ws
         self.sampleRate: int = 0
-        self.chunk: bytes = b""
+        self.streaming: bool = False
+        self.binary: bool = False
+        self.duplex: bool = False
+        self.buffer: RingBuffer = None
+        self.speaking: asyncio.Task = None  # 正在推送的回复
+        self.speaking_cancel: CancelToken = None  # 这一轮回复的取消令牌, 打断时停止 LLM 与合成
 
         self._task_queue = asyncio.Queue()  # 任务队列
         self._running = True
 
-    def audio_array(self):
-        array = np.frombuffer(self.chunk, dtype=np.int16).astype(np.float32)
-        return array
-
-    async def valid(self):
-        # 验证音频是否存在声音，且停止讲话
-        array = self.audio_array()
-        audio_len = (array.shape[0] / self.sampleRate) * 1000 # ms
-        if audio_len < 500:
-            return False
-        [items, param] = vad_array(array, sampleRate = self.sampleRate)
-        if not len(items[0]["value"]) or \
-            (len(items[0]["value"]) == 1 and items[0]["value"][0][0] == 0):
-            # 没有有效的音频, 清空缓存
-            self.chunk = b""
-            return False
-        await self.ws.send_text("tts:stop")
-        if audio_len - items[0]["value"][-1][1] > 200:
-            # 超过200ms没有新的语音输入，意味着结束讲话
-            return True
-        return False
-
-    async def action(self, wm: WebsocketMessage):
-        if wm.action == "init":
+    def reset_vad(self):
+        # 流式 VAD 的状态, 返回的时间以 vad_offset 为起点
+        self.vad_cache = {}
+        self.vad_offset = self.buffer.total
+        self.vad_fed = self.buffer.total  # 已经送入 VAD 的位置
+        self.speech_start = -1
+        # 流式识别会话, 以及已经送入识别的位置
+        self.asr_session: StreamingASR = None
+        self.asr_fed = 0
+
+    def ms2sample(self, ms: int):
+        return self.vad_offset + int(ms * self.sampleRate / 1000)
+
+    def pad_start(self, start: int):
+        # 送入 ASR 的音频在 VAD 起点之前多保留一点
+        return max(start - int(self.SPEECH_PAD_MS * self.sampleRate / 1000), 0)
+
+    async def valid(self, is_final: bool = False):
+        """只把新增的音频送入流式 VAD, 返回本次完成的语音段 [(start, end), ...]
+
+        除 is_final 外只送入整块的音频, 不足一块的余数留在缓冲区中, 与下一段录音一起送入。
+        """
+        array = self.buffer.read(self.vad_fed)
+        if not is_final:
+            array = array[: len(array) - len(array) % vad_block(self.sampleRate)]
+            if not len(array):
+                return []
+        with timed(VAD, route = "/ws"):
+            segments = await executor.run(vad_stream, array, self.sampleRate, self.vad_cache, is_final)
+        self.vad_fed += len(array)
+        finished = []
+        for [beg, end] in segments:
+            if beg != -1:
+                # 开始讲话
+                self.speech_start = self.ms2sample(beg)
+                if self.streaming:
+                    self.asr_session = StreamingASR()
+                    self.asr_fed = self.pad_start(self.speech_start)
+                self.stop_speaking()
+                await self.ws.send_text("tts:stop")
+            if end != -1 and self.speech_start != -1:
+                finished.append((self.speech_start, self.ms2sample(end)))
+                self.speech_start, self.asr_session = -1, None
+        if is_final and self.speech_start != -1:
+            finished.append((self.speech_start, self.buffer.total))
+            self.speech_start, self.asr_session = -1, None
+        return finished
+
+    async def partial(self):
+        # 说话过程中, 把新增的音频送入流式识别, 返回部分结果
+        array = self.buffer.read(self.asr_fed)
+        self.asr_fed = self.buffer.total
+        resp = await executor.run(self.asr_session.accept, array, self.sampleRate)
+        if len(resp.clean_text):
+            await self.ws.send_text("asr:partial:%s" % resp.clean_text)
+
+    async def recognize(self, start: int, end: int):
+        # 说话完成, 分块识别只用于部分结果, 最终结果对整句音频识别
+        turn_start = time.perf_counter()
+        resp = await asr_async(torch.from_numpy(self.buffer.read(self.pad_start(start), end)), self.sampleRate)
+        ASR.observe(time.perf_counter() - turn_start, route = "/ws")
+        if len(resp.clean_text):
+            # 有字，代表识别正确
+            cm.add_chat(resp.clean_text, "user")
+            if self.duplex:
+                self.stop_speaking()
+                self.speaking_cancel = CancelToken()
+                self.speaking = asyncio.create_task(self.speak(turn_start, self.speaking_cancel))
+            else:
+                await self.ws.send_text("tts:start")
+
+    def stop_speaking(self):
+        # 先取消令牌, 引擎线程中正在进行的解码在下一步停止, 不必等到任务的取消传递过去
+        if self.speaking_cancel is not None:
+            self.speaking_cancel.cancel()
+            self.speaking_cancel = None
+        if self.speaking is not None:
+            self.speaking.cancel()
+            self.speaking = None
+
+    async def speak(self, turn_start: float, cancel: CancelToken):
+        """LLM -> TTS, 在同一连接上推送回复的音频
+
+        tts:begin:<sampleRate>, 之后是 int16 的二进制音频帧, 最后 tts:end;
+        第一帧发出后推送 tts:ttfa:<ms>, 即从检测到说话结束到第一帧音频的耗时。
+        用户开始说话时 stop_speaking 取消 cancel, LLM 的流、CosyVoice 的解码线程都会尽快停止。
+        """
+        try:
+            ticket = cosy_admission.admit()
+            text = iterate_async(generate_msg(BISTREAM, "/ws"), cancel)
+            frames = instrument_stream(await cosy_executor.stream(stream_pcm(text, BISTREAM, cancel, ticket), cancel, ticket),
+                                       "/ws", "cosy", turn_start)
+            ttfa = None
+            async for pcm in frames:
+                if ttfa is None:
+                    await self.ws.send_text("tts:begin:%d" % cosyvoice.get().sample_rate)
+                await self.ws.send_bytes(encode_frame(pcm))
+                if ttfa is None:
+                    ttfa = (time.perf_counter() - turn_start) * 1000
+                    await self.ws.send_text("tts:ttfa:%d" % ttfa)
+            await self.ws.send_text("tts:end")
+        except ExecutorBusy:
+            await self.ws.send_text("error:busy")
+        except Exception as e:
+            print(f"Error speaking: {e}")
+
+    async def record(self, array: np.ndarray):
+        self.buffer.write(array)
+        for segment in await self.valid():
+            await self.recognize(*segment)
+        if self.asr_session is not None:
+            await self.partial()
+
+    async def action(self, wm: WebsocketMessage | bytes):
+        if isinstance(wm, bytes):
+            # 二进制音频帧, 只有在 init 时协商过才接受
+            if self.sampleRate > 0 and self.binary:
+                await self.record(decode_frame(wm))
+        elif wm.action == "init":
             self.sampleRate = int(wm.param["sampleRate"])
+            # asr: offline 端点后整句识别; stream 说话过程中分块识别, 并推送部分结果
+            self.streaming = wm.param.get("asr", "offline") == "stream"
+            # tts: http 发送 tts:start, 由客户端请求 /api/tts; push 在本连接上直接推送合成的音频
+            self.duplex = wm.param.get("tts", "http") == "push"
+            # frame: json 录音以 base64 放在 record 消息中; binary 录音以二进制帧发送, 控制消息仍然是 json
+            self.binary = wm.param.get("frame", "json") == "binary"
+            self.buffer = RingBuffer(self.sampleRate * self.BUFFER_SECONDS)
+            self.reset_vad()
+            await self.ws.send_text("init:%s" % ("binary" if self.binary else "json"))
         elif self.sampleRate <= 0:
             # 还未初始化
             return
         elif wm.action == "record":
             blob = base64.b64decode(wm.param["audio"])
-            self.chunk += blob
-            if await self.valid():
-                # 说话完成
-                resp = asr_array(self.audio_array(), self.sampleRate)
-                self.chunk = b""
-                if len(resp.clean_text):
-                    # 有字，代表识别正确
-                    cm.add_chat(resp.clean_text, "user")
-                    await self.ws.send_text("tts:start")
-
+            await self.record(np.frombuffer(blob, dtype=np.int16).astype(np.float32))
+        elif wm.action == "finish":
+            # 录音结束, 冲刷 VAD 中剩余的音频
+            for segment in await self.valid(is_final = True):
+                await self.recognize(*segment)
+            self.reset_vad()
 
     async def _worker(self):
         """后台任务处理 worker"""
@@ -79,6 +195,9 @@ class WebsocketClient:
                 if wm is None:
                     break  # 收到终止信号
                 await self.action(wm)
+            except ExecutorBusy:
+                # 推理队列已满, 保留音频缓存, 下一段录音到达时重试
+                await self.ws.send_text("error:busy")
             except Exception as e:
                 print(f"Error processing action: {e}")
             finally:
@@ -91,9 +210,14 @@ class WebsocketClient:
 
         try:
             while True:
-                # 接收 WebSocket 消息
-                data = await self.ws.receive_json()
-                wm = WebsocketMessage.model_validate(data)
+                # 接收 WebSocket 消息, 文本为 json 控制消息, 二进制为音频帧
+                message = await self.ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise fastapi.WebSocketDisconnect(message.get("code", 1000))
+                if message.get("bytes") is not None:
+                    wm = message["bytes"]
+                else:
+                    wm = WebsocketMessage.model_validate_json(message["text"])
                 # 将任务放入队列，由后台 worker 处理
                 await self._task_queue.put(wm)
         except fastapi.WebSocketDisconnect:
@@ -101,6 +225,7 @@ class WebsocketClient:
         finally:
             # 清理资源
             self._running = False
+            self.stop_speaking()
             await self._task_queue.put(None)  # 发送终止信号
             await worker_task  # 等待 worker 完成
 
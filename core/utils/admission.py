@@ -0,0 +1,245 @@
+"""
+按估计的计算量做准入控制
+
+流式合成在整个过程中持续占用引擎: 实时率为 rtf 的流每产出 1 秒音频需要 rtf 秒计算,
+同一引擎上所有流的 rtf 之和超过工作线程数后, 每个流都会卡顿。准入时按文本长度估计音频时长和计算量:
+    load  已接纳的流的 rtf 之和, 不超过 workers * {NAME}_LOAD, 否则拒绝, 保证已接纳的流仍然实时
+    cost  已接纳但尚未完成的计算量 (秒), 不超过 {NAME}_BUDGET; 超出时截短文本 (降级),
+          截短后连 MIN_CHARS 个字都放不下时拒绝
+rtf 与每个字的音频时长从实际合成中测量 (指数滑动平均), 初始 rtf 为 {NAME}_RTF。
+拒绝时抛出 AdmissionRejected, 它是 ExecutorBusy 的子类, 路由层同样转换为 503。
+
+与只有队列上限时不同, 超出负载的请求不再排队等待, 而是立即 503。默认值下 (1 个工作线程, LOAD 0.9,
+初始 rtf 0.4) 测量之前可以同时接纳两个流; 测量到的 rtf 大于 0.45 后, 第二个并发流同样会被拒绝。
+"""
+from __future__ import annotations
+import os
+import time
+import threading
+from concurrent.futures import Future
+from typing import Generator, Iterable, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from .executor import ExecutorBusy, get_executor
+from .metrics import Gauge
+
+__all__ = ["AdmissionRejected", "AdmissionStats", "Ticket", "AdmissionController", "get_admission", "admissions"]
+
+# 事先不知道文本长度时 (例如 LLM 的回复) 按这个字数估计
+DEFAULT_CHARS = 100
+# 降级后至少要能合成的字数
+MIN_CHARS = 10
+
+AudioChunks = Generator[Tuple[int, np.ndarray], None, None]
+
+class AdmissionRejected(ExecutorBusy):
+    """估计的计算量超出引擎的承受能力, 拒绝新的请求"""
+    def __init__(self, name: str, active: int, reason: str) -> None:
+        Exception.__init__(self, "engine '%s' is overloaded (%s), %d streams running" % (name, reason, active))
+        self.name = name
+        self.depth = active
+        self.reason = reason
+
+
+class AdmissionStats(BaseModel):
+    name: str
+    workers: int
+    max_load: float
+    budget: float            # s
+    active: int              # 已接纳且未完成的请求数
+    load: float              # 已接纳的流的 rtf 之和
+    cost: float              # 已接纳的请求估计的计算量, s
+    rtf: float
+    seconds_per_char: float
+    admitted: int
+    degraded: int
+    rejected: int
+
+
+class Ticket:
+    """一次被接纳的请求, 完成后 release 归还预算"""
+    def __init__(self, controller: AdmissionController, cost: float, load: float, max_chars: int = None) -> None:
+        self.controller = controller
+        self.cost = cost
+        self.load = load
+        # 降级时文本最多保留的字数, None 为不限制
+        self.max_chars = max_chars
+
+        self.compute = 0.0       # 实际的计算耗时
+        self.seconds = 0.0       # 实际合成的音频时长
+        self.chars = 0           # 完整合成的文本字数
+        self.char_seconds = 0.0  # 以及它们的音频时长
+        self.released = False
+
+    @property
+    def degraded(self) -> bool:
+        return self.max_chars is not None
+
+    def limit(self, texts: Iterable[str]) -> Generator[str]:
+        """按 max_chars 截短文本, 每一项可以是句子也可以是 LLM 的增量; Future (见 iterate_async) 原样透传"""
+        if self.max_chars is None:
+            yield from texts
+            return
+        used = 0
+        for text in texts:
+            if isinstance(text, Future):
+                yield text
+                continue
+            if used + len(text) > self.max_chars:
+                if used < self.max_chars:
+                    yield text[:self.max_chars - used]
+                return
+            used += len(text)
+            yield text
+
+    def measure(self, chunks: AudioChunks, chars: int = None, rtf: bool = True) -> AudioChunks:
+        """透传合成结果并记录计算耗时, 只计算生成器内部的时间
+
+        :param chars: 这段文本的字数, 完整合成 (没有中途关闭) 时用来更新每个字的音频时长
+        :param rtf: 生成器内部的时间是否是完整的计算量; bistream 的语音 token 在 LLM 线程中解码, 不能用来更新 rtf
+        """
+        compute, seconds, complete = 0.0, 0.0, False
+        start = time.perf_counter()
+        try:
+            for item in chunks:
+                compute += time.perf_counter() - start
+                if not isinstance(item, Future):
+                    seconds += item[1].shape[-1] / item[0]
+                yield item
+                start = time.perf_counter()
+            complete = True
+        finally:
+            if rtf:
+                self.compute += compute
+                self.seconds += seconds
+            if complete and chars:
+                self.chars += chars
+                self.char_seconds += seconds
+
+    def release(self, *_):
+        """可以重复调用, 也可以作为 Future 的回调"""
+        self.controller.release(self)
+
+
+class AdmissionController:
+    def __init__(self, name: str, workers: int = 1, max_load: float = 0.9, budget: float = 60.0,
+                 rtf: float = 0.4, seconds_per_char: float = 0.25, alpha: float = 0.2) -> None:
+        """
+        :param max_load: 每个工作线程可以分给实时流的比例, 留一些余量给排队的短任务
+        :param budget: 已接纳但尚未完成的计算量上限 (秒)
+        :param rtf: 还没有测量结果时使用的实时率
+        :param seconds_per_char: 还没有测量结果时每个字的音频时长, 中文约为 0.25 秒
+        :param alpha: 滑动平均的权重
+        """
+        self.name = name
+        self.workers = workers
+        self.max_load = max_load
+        self.budget = budget
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        self._rtf = rtf
+        self._seconds_per_char = seconds_per_char
+        self._active = 0
+        self._load = 0.0
+        self._cost = 0.0
+        self._admitted = 0
+        self._degraded = 0
+        self._rejected = 0
+
+    def estimate(self, chars: int = None) -> Tuple[float, float]:
+        """返回估计的 (音频时长, 计算量), 单位秒"""
+        seconds = (DEFAULT_CHARS if chars is None else chars) * self._seconds_per_char
+        return seconds, seconds * self._rtf
+
+    def admit(self, chars: int = None) -> Ticket:
+        """接纳一个合成请求, 必要时降级, 超出承受能力时抛出 AdmissionRejected
+
+        :param chars: 要合成的文本字数, None 为事先未知
+        """
+        with self._lock:
+            rtf = self._rtf
+            _, cost = self.estimate(chars)
+            max_chars = None
+            # 空闲时总是接纳, 否则 rtf 大于 1 的引擎 (例如 CPU 上) 永远无法工作
+            if self._active:
+                if self._load + rtf > self.workers * self.max_load:
+                    self._rejected += 1
+                    raise AdmissionRejected(self.name, self._active, "load %.2f + %.2f" % (self._load, rtf))
+                remaining = self.budget - self._cost
+                if cost > remaining:
+                    max_chars = int(remaining / (self._seconds_per_char * rtf))
+                    if max_chars < MIN_CHARS:
+                        self._rejected += 1
+                        raise AdmissionRejected(self.name, self._active, "cost %.1fs over budget" % self._cost)
+                    cost = max_chars * self._seconds_per_char * rtf
+                    self._degraded += 1
+            self._active += 1
+            self._load += rtf
+            self._cost += cost
+            self._admitted += 1
+        return Ticket(self, cost, rtf, max_chars)
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active -= 1
+            self._load = max(self._load - ticket.load, 0.0)
+            self._cost = max(self._cost - ticket.cost, 0.0)
+            # 用实际的合成结果修正估计, 命中缓存或被取消的请求没有测量值
+            if ticket.seconds > 0:
+                self._rtf += self.alpha * (ticket.compute / ticket.seconds - self._rtf)
+            if ticket.chars > 0:
+                self._seconds_per_char += self.alpha * (ticket.char_seconds / ticket.chars - self._seconds_per_char)
+
+    def stats(self) -> AdmissionStats:
+        with self._lock:
+            return AdmissionStats(
+                name = self.name,
+                workers = self.workers,
+                max_load = self.max_load,
+                budget = self.budget,
+                active = self._active,
+                load = self._load,
+                cost = self._cost,
+                rtf = self._rtf,
+                seconds_per_char = self._seconds_per_char,
+                admitted = self._admitted,
+                degraded = self._degraded,
+                rejected = self._rejected,
+            )
+
+
+admissions: dict[str, AdmissionController] = {}
+_admissions_lock = threading.Lock()
+
+def get_admission(name: str) -> AdmissionController:
+    """获取引擎对应的准入控制, 不存在时按照环境变量创建, 工作线程数与执行器一致
+
+    负载上限: {NAME}_LOAD, 默认 0.9
+    计算量预算: {NAME}_BUDGET, 默认 60 秒
+    初始实时率: {NAME}_RTF, 默认 0.4, 使测量之前至少可以同时接纳两个流
+    """
+    workers = get_executor(name).workers
+    with _admissions_lock:
+        if name not in admissions:
+            admissions[name] = AdmissionController(
+                name,
+                workers = workers,
+                max_load = float(os.getenv("%s_LOAD" % name.upper(), 0.9)),
+                budget = float(os.getenv("%s_BUDGET" % name.upper(), 60)),
+                rtf = float(os.getenv("%s_RTF" % name.upper(), 0.4)),
+            )
+        return admissions[name]
+
+
+def _values(field: str):
+    return { (name,): getattr(a.stats(), field) for name, a in list(admissions.items()) }
+
+Gauge("speech_admission_load", "Sum of the real time factors of admitted streams", ["engine"], lambda: _values("load"))
+Gauge("speech_admission_cost_seconds", "Estimated compute of admitted but unfinished requests", ["engine"], lambda: _values("cost"))
+Gauge("speech_admission_rtf", "Measured real time factor used for admission", ["engine"], lambda: _values("rtf"))
@@ -1,4 +1,8 @@
+import os
 import wave
+import queue
+import struct
+import threading
 import subprocess
 import soundfile as sf
 import numpy as np
@@ -41,6 +45,9 @@ def pack_audio(io_buffer:BytesIO, data:np.ndarray, rate:int, media_type:str):
         io_buffer = pack_ogg(io_buffer, data, rate)
     elif media_type == "aac":
         io_buffer = pack_aac(io_buffer, data, rate)
+    elif media_type == "opus":
+        encoder = OpusEncoder(rate)
+        io_buffer.write(encoder.write(data) + encoder.close())
     elif media_type == "wav":
         io_buffer = pack_wav(io_buffer, data, rate)
     else:
@@ -48,6 +55,243 @@ def pack_audio(io_buffer:BytesIO, data:np.ndarray, rate:int, media_type:str):
     io_buffer.seek(0)
     return io_buffer
 
+class StreamEncoder:
+    """流式编码器, 整个响应共用一个实例
+
+    write 送入一段 PCM, 返回目前已经编码完成的字节 (可能为空); close 冲刷剩余的数据。
+    与 pack_audio 不同, 容器头只写一次, 输出是一个完整的文件。
+    """
+    def __init__(self, rate: int) -> None:
+        self.rate = rate
+
+    def write(self, data: np.ndarray) -> bytes:
+        return data.astype(np.int16, copy=False).tobytes()
+
+    def close(self) -> bytes:
+        return b""
+
+    def abort(self):
+        """响应中途结束时释放资源"""
+        pass
+
+
+class WavEncoder(StreamEncoder):
+    def __init__(self, rate: int) -> None:
+        super().__init__(rate)
+        self.header = wave_header_chunk(sample_rate = rate)
+
+    def write(self, data: np.ndarray) -> bytes:
+        header, self.header = self.header, b""
+        return header + super().write(data)
+
+    def close(self) -> bytes:
+        # 没有任何音频时也要返回头部
+        header, self.header = self.header, b""
+        return header
+
+
+class _Sink:
+    """只追加的文件对象, 供 soundfile 写入"""
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+        self.pos = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # ogg 只会在打开时查询位置, 不会回写
+        return self.pos
+
+    def read(self, n: int = -1) -> bytes:
+        return b""
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class OggEncoder(StreamEncoder):
+    """进程内的 ogg/vorbis 编码, 状态保存在同一个 SoundFile 中"""
+    def __init__(self, rate: int) -> None:
+        super().__init__(rate)
+        self.sink = _Sink()
+        self.file = sf.SoundFile(self.sink, mode='w', samplerate=rate, channels=1, format='ogg')
+
+    def write(self, data: np.ndarray) -> bytes:
+        self.file.write(data)
+        return self.sink.drain()
+
+    def close(self) -> bytes:
+        self.file.close()
+        return self.sink.drain()
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class FFmpegEncoder(StreamEncoder):
+    """整个响应共用一个 ffmpeg 进程, 后台线程读取编码结果"""
+    def __init__(self, rate: int, args: list[str]) -> None:
+        """
+        :param args: 编码器与输出格式的参数
+        """
+        super().__init__(rate)
+        self.process = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(rate), '-ac', '1', '-i', 'pipe:0',
+            '-vn', *args,
+            'pipe:1'
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        self.output: queue.SimpleQueue = queue.SimpleQueue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        while True:
+            data = self.process.stdout.read(4096)
+            if not data:
+                break
+            self.output.put(data)
+
+    def _drain(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.output.get_nowait())
+            except queue.Empty:
+                return b"".join(chunks)
+
+    def write(self, data: np.ndarray) -> bytes:
+        self.process.stdin.write(data.astype(np.int16, copy=False).tobytes())
+        return self._drain()
+
+    def close(self) -> bytes:
+        self.process.stdin.close()
+        self.reader.join()
+        self.process.wait()
+        return self._drain()
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+class AacEncoder(FFmpegEncoder):
+    def __init__(self, rate: int) -> None:
+        super().__init__(rate, [
+            '-c:a', 'aac', '-b:a', '192k',
+            '-flush_packets', '1',  # 编码完成的帧立即写出
+            '-f', 'adts'
+        ])
+
+
+class OpusEncoder(FFmpegEncoder):
+    """Ogg 封装的 Opus, 低带宽场景使用
+
+    opus 只支持 8/12/16/24/48 kHz, 其它采样率 (例如 GPT-SoVITS 的 32 kHz) 由 ffmpeg 重采样到 48 kHz。
+    """
+    RATES = (8000, 12000, 16000, 24000, 48000)
+
+    def __init__(self, rate: int,
+                 bitrate: str = os.getenv("OPUS_BITRATE", "32k"),
+                 frame: float = float(os.getenv("OPUS_FRAME", 20))) -> None:
+        """
+        :param bitrate: 目标码率, 例如 24k
+        :param frame: 帧长 (ms), 2.5 / 5 / 10 / 20 / 40 / 60
+        """
+        super().__init__(rate, [
+            *([] if rate in self.RATES else ['-ar', '48000']),
+            '-c:a', 'libopus', '-b:a', bitrate, '-frame_duration', str(frame),
+            '-application', 'voip',
+            '-page_duration', str(int(frame * 1000)),  # 每一帧都立即输出一个 ogg 页
+            '-flush_packets', '1',
+            '-f', 'ogg'
+        ])
+
+
+ENCODERS: dict[str, type[StreamEncoder]] = {
+    "raw": StreamEncoder,
+    "wav": WavEncoder,
+    "ogg": OggEncoder,
+    "aac": AacEncoder,
+    "opus": OpusEncoder,
+}
+
+MEDIA_TYPES = {
+    "raw": "audio/raw",
+    "wav": "audio/wav",
+    "ogg": "audio/ogg",
+    "aac": "audio/aac",
+    "opus": "audio/ogg; codecs=opus",
+}
+
+def stream_encoder(media_type: str, rate: int, **kwargs) -> StreamEncoder:
+    return ENCODERS.get(media_type, StreamEncoder)(rate, **kwargs)
+
+class RingBuffer:
+    """预分配的 float32 环形缓冲区
+
+    按写入的绝对样本位置读取, 追加新音频不会复制已有数据, 超出容量时覆盖最旧的部分。
+    """
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.total = 0 # 累计写入的样本数
+
+    def write(self, array: np.ndarray):
+        n = array.shape[0]
+        if n > self.capacity:
+            self.total += n - self.capacity
+            array = array[-self.capacity:]
+            n = self.capacity
+        pos = self.total % self.capacity
+        first = min(n, self.capacity - pos)
+        self.buffer[pos:pos + first] = array[:first]
+        self.buffer[:n - first] = array[first:]
+        self.total += n
+
+    def read(self, start: int, end: int = None) -> np.ndarray:
+        """读取 [start, end) 的样本, 已经被覆盖的部分会被截掉"""
+        end = self.total if end is None else min(end, self.total)
+        start = max(start, self.total - self.capacity, 0)
+        if start >= end:
+            return np.zeros(0, dtype=np.float32)
+        pos = start % self.capacity
+        n = end - start
+        if pos + n <= self.capacity:
+            return self.buffer[pos:pos + n].copy()
+        return np.concatenate((self.buffer[pos:], self.buffer[:n - (self.capacity - pos)]))
+
+# /ws 二进制音频帧: 头部为 版本(u8) 采样格式(u8) 保留(u16), 小端, 之后紧跟单声道 PCM
+FRAME_HEADER = struct.Struct("<BBH")
+FRAME_VERSION = 1
+FRAME_DTYPES = (np.dtype("<i2"), np.dtype("<f4"))  # 0: int16, 1: float32 (-1 ~ 1)
+
+def encode_frame(array: np.ndarray) -> bytes:
+    dtype = FRAME_DTYPES.index(array.dtype.newbyteorder("<"))
+    return FRAME_HEADER.pack(FRAME_VERSION, dtype, 0) + array.astype(FRAME_DTYPES[dtype], copy=False).tobytes()
+
+def decode_frame(data: bytes) -> np.ndarray:
+    """解析二进制音频帧, 返回 float32 样本, 取值范围与 int16 一致"""
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError("audio frame too short: %d bytes" % len(data))
+    version, dtype, _ = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION or dtype >= len(FRAME_DTYPES):
+        raise ValueError("unsupported audio frame: version %d, dtype %d" % (version, dtype))
+    array = np.frombuffer(data, dtype=FRAME_DTYPES[dtype], offset=FRAME_HEADER.size)
+    if dtype == 0:
+        return array.astype(np.float32)
+    return array * np.float32(32768)
+
 # from https://huggingface.co/spaces/coqui/voice-chat-with-mistral/blob/main/app.py
 def wave_header_chunk(frame_input=b"", channels=1, sample_width=2, sample_rate=32000):
     # This will create a wave header then append the frame input
@@ -62,14 +306,3 @@ def wave_header_chunk(frame_input=b"", channels=1, sample_width=2, sample_rate=3
 
     wav_buf.seek(0)
     return wav_buf.read()
-
-import ffmpeg
-def webm2wav(webm: bytes):
-    process = (
-        ffmpeg
-        .input('pipe:0')  # 通过管道输入
-        .output('pipe:1', format='wav')  # 通过管道输出为 WAV 格式
-        .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
-    )
-    stdout_data, _ = process.communicate(input=webm)
-    return stdout_data
@@ -0,0 +1,103 @@
+"""
+跨请求的微批处理
+
+在很短的时间窗口内收集并发请求, 合并成一个批次交给执行器运行, 再把结果分发回各个调用方。
+"""
+from __future__ import annotations
+import asyncio
+import threading
+from typing import Any, Callable, Hashable, List
+
+from .executor import InferenceExecutor
+
+__all__ = ["MicroBatcher", "batchers"]
+
+class MicroBatcher:
+    def __init__(self,
+                 name: str,
+                 executor: InferenceExecutor,
+                 batch_fn: Callable[..., List[Any]],
+                 max_batch: int = 8,
+                 max_wait: float = 0.01,
+                 size: Callable[[Any], int] = len) -> None:
+        """
+        :param executor: 批次在哪个执行器上运行
+        :param batch_fn: batch_fn(items, *group) -> 与 items 顺序一致的结果列表
+        :param max_batch: 单个批次的最大数量, 达到后立即发送
+        :param max_wait: 第一个请求到达后最多等待的时间 (秒)
+        :param size: 用于按长度排序, 减少 padding
+        """
+        self.name = name
+        self.executor = executor
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.size = size
+
+        # group -> [(item, future)], 只能在事件循环中访问
+        self._pending: dict[Hashable, list] = {}
+        self._timers: dict[Hashable, asyncio.TimerHandle] = {}
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._max_size = 0
+        batchers[name] = self
+
+    async def run(self, item: Any, *group: Hashable) -> Any:
+        """提交单个请求, group 相同的请求才会被合并到同一个批次"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(group, [])
+        pending.append((item, future))
+        if len(pending) >= self.max_batch:
+            self._flush(group)
+        elif len(pending) == 1:
+            self._timers[group] = loop.call_later(self.max_wait, self._flush, group)
+        return await future
+
+    def _flush(self, group: Hashable):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(group, [])
+        # 调用方可能已经取消
+        pending = [p for p in pending if not p[1].done()]
+        if not len(pending):
+            return
+        # 长度相近的放在一起, 降低 padding 的比例
+        pending.sort(key=lambda p: self.size(p[0]), reverse=True)
+        asyncio.ensure_future(self._dispatch(pending, group))
+
+    async def _dispatch(self, pending: list, group: tuple):
+        try:
+            results = await self.executor.run(self.batch_fn, [p[0] for p in pending], *group)
+        except BaseException as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        with self._lock:
+            self._batches += 1
+            self._items += len(pending)
+            self._max_size = max(self._max_size, len(pending))
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "max_batch": self.max_batch,
+                "max_wait": self.max_wait * 1000,
+                "batches": self._batches,
+                "items": self._items,
+                "batch_avg": self._items / max(self._batches, 1),
+                "batch_max": self._max_size,
+            }
+
+
+batchers: dict[str, MicroBatcher] = {}
@@ -1,43 +1,384 @@
+"""
+请求与中间产物的缓存
+
+Cache: 内存中的 LRU, 带过期时间和字节上限; 超出内存上限的条目可以写到磁盘 (spill), 磁盘部分同样有字节上限。
+过期时间从最后一次访问开始计算, 因此 LRU 最旧的条目也是最先过期的条目。
+
+AudioCache: 合成音频的磁盘缓存, 按内容寻址, 相同的文本、音色和采样参数直接返回之前合成的 PCM 片段。
+"""
+from __future__ import annotations
 import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Generator, Tuple
+from pydantic import BaseModel
 
 from .snowflake import generate_snowflake_id
 
+__all__ = ["Cache", "CacheStats", "cache", "AudioCache", "AudioCacheStats", "audio_cache"]
+
+class CacheStats(BaseModel):
+    items: int
+    bytes: int
+    disk_items: int
+    disk_bytes: int
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int     # 因为容量被移除 (不含写到磁盘)
+    expirations: int
+    spills: int
+
+
+class _Entry:
+    __slots__ = ("data", "size", "expire")
+
+    def __init__(self, data: str | bytes, expire: float) -> None:
+        self.data = data
+        self.size = len(data.encode("utf-8")) if isinstance(data, str) else len(data)
+        self.expire = expire
+
+
 class Cache():
     SAVE_PATH = "TEMP"
 
-    def __init__(self) -> None:
-        if not os.path.exists(self.SAVE_PATH):
-            os.mkdir(self.SAVE_PATH)
+    def __init__(self,
+                 max_bytes: int = 256 << 20,
+                 max_items: int = 10000,
+                 ttl: float = 3600,
+                 spill: bool = False,
+                 max_disk_bytes: int = 1 << 30) -> None:
+        """
+        :param max_bytes: 内存中数据的字节上限
+        :param max_items: 内存中的条目上限
+        :param ttl: 最后一次访问之后保留的时间 (秒)
+        :param spill: 超出内存上限时写到磁盘, 否则直接丢弃
+        :param max_disk_bytes: 磁盘上数据的字节上限
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.ttl = ttl
+        self.spill = spill
+        self.max_disk_bytes = max_disk_bytes
 
-    def save(self, data) -> int:
-        if not os.path.exists(self.SAVE_PATH):
-            os.mkdir(self.SAVE_PATH)
-        cache_id = generate_snowflake_id()
-        path = self.get_path(cache_id)
-        if isinstance(data, str):
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(data)
-        elif isinstance(data, bytes):
-            with open(path, "wb") as f:
-               f.write(data)
-        else:
+        self._lock = threading.Lock()
+        # id -> entry, 按访问顺序排列; 同一个条目可以同时在内存和磁盘中
+        self._memory: OrderedDict[int, _Entry] = OrderedDict()
+        self._disk: OrderedDict[int, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._spills = 0
+
+    def save(self, data: str | bytes) -> int:
+        if not isinstance(data, (str, bytes)):
             raise NotImplementedError()
+        cache_id = generate_snowflake_id()
+        with self._lock:
+            entry = _Entry(data, time.monotonic() + self.ttl)
+            self._memory[cache_id] = entry
+            self._bytes += entry.size
+            self._shrink()
         return cache_id
 
-    def load(self, cid: int, t: str = "str"):
-        path = self.get_path(cid)
-        if not os.path.exists(path):
-            return None
+    def load(self, cid: int | str, t: str = "str"):
+        with self._lock:
+            cid = self._key(cid)
+            entry = self._lookup(cid)
+            if entry is None:
+                self._misses += 1
+                return None
+            if cid in self._memory:
+                self._hits += 1
+                data = entry.data
+            else:
+                # 从磁盘读回, 重新放入内存
+                self._disk_hits += 1
+                with open(self.get_file(cid), "rb") as f:
+                    data = f.read()
+                entry.data = data
+                self._memory[cid] = entry
+                self._bytes += entry.size
+                self._shrink()
         if t == "str":
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
-        else:
-            with open(path, "rb") as f:
-                return f.read()
+            return data if isinstance(data, str) else data.decode("utf-8")
+        return data if isinstance(data, bytes) else data.encode("utf-8")
 
-    def get_path(self, cid: int):
+    def get_path(self, cid: int | str) -> str | None:
+        """返回条目在磁盘上的路径, 需要时写入磁盘; 条目不存在时返回 None"""
+        with self._lock:
+            cid = self._key(cid)
+            entry = self._lookup(cid)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            if cid not in self._disk:
+                self._write(cid, entry)
+                self._shrink()
+            return self.get_file(cid)
+
+    def get_file(self, cid: int):
         return os.path.join(self.SAVE_PATH, str(cid))
 
-cache = Cache()
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                items = len(self._memory),
+                bytes = self._bytes,
+                disk_items = len(self._disk),
+                disk_bytes = self._disk_bytes,
+                hits = self._hits,
+                disk_hits = self._disk_hits,
+                misses = self._misses,
+                evictions = self._evictions,
+                expirations = self._expirations,
+                spills = self._spills,
+            )
+
+    # 以下方法需要持有 self._lock
+
+    @staticmethod
+    def _key(cid: int | str) -> int:
+        try:
+            return int(cid)
+        except (TypeError, ValueError):
+            return -1
+
+    def _lookup(self, cid: int) -> _Entry | None:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._memory.get(cid) or self._disk.get(cid)
+        if entry is None:
+            return None
+        entry.expire = now + self.ttl
+        if cid in self._memory:
+            self._memory.move_to_end(cid)
+        if cid in self._disk:
+            self._disk.move_to_end(cid)
+        return entry
+
+    def _expire(self, now: float):
+        # 最旧的条目最先过期, 只需要检查开头
+        for store in (self._memory, self._disk):
+            while len(store):
+                cid, entry = next(iter(store.items()))
+                if entry.expire > now:
+                    break
+                self._expirations += 1
+                self._remove(cid)
+
+    def _remove(self, cid: int):
+        entry = self._memory.pop(cid, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        entry = self._disk.pop(cid, None)
+        if entry is not None:
+            self._disk_bytes -= entry.size
+            self._unlink(cid)
+
+    def _write(self, cid: int, entry: _Entry):
+        if not os.path.exists(self.SAVE_PATH):
+            os.mkdir(self.SAVE_PATH)
+        data = entry.data
+        with open(self.get_file(cid), "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        self._disk[cid] = entry
+        self._disk_bytes += entry.size
+
+    def _unlink(self, cid: int):
+        try:
+            os.remove(self.get_file(cid))
+        except FileNotFoundError:
+            pass
+
+    def _shrink(self):
+        while len(self._memory) and (self._bytes > self.max_bytes or len(self._memory) > self.max_items):
+            cid, entry = self._memory.popitem(last = False)
+            self._bytes -= entry.size
+            if cid in self._disk:
+                pass
+            elif self.spill:
+                self._write(cid, entry)
+                self._spills += 1
+            else:
+                self._evictions += 1
+            entry.data = None
+        while len(self._disk) and self._disk_bytes > self.max_disk_bytes:
+            cid, entry = self._disk.popitem(last = False)
+            self._disk_bytes -= entry.size
+            self._unlink(cid)
+            if cid not in self._memory:
+                self._evictions += 1
+
+
+cache = Cache(
+    max_bytes = int(os.getenv("CACHE_MAX_BYTES", 256 << 20)),
+    max_items = int(os.getenv("CACHE_MAX_ITEMS", 10000)),
+    ttl = float(os.getenv("CACHE_TTL", 3600)),
+    spill = os.getenv("CACHE_SPILL", "0") == "1",
+    max_disk_bytes = int(os.getenv("CACHE_DISK_BYTES", 1 << 30)),
+)
+
+
+class AudioCacheStats(BaseModel):
+    items: int
+    bytes: int
+    hits: int
+    misses: int
+    writes: int
+    evictions: int
+
+
+AudioChunks = Generator[Tuple[int, np.ndarray], None, None]
+
+class AudioCache():
+    """合成音频的磁盘缓存
+
+    每个条目保存为 <key>.pcm (int16 片段依次拼接) 和 <key>.json (采样率与各片段长度),
+    读取时按原来的片段返回, 流式接口不需要改变。磁盘占用超过上限时删除最久未使用的条目。
+    """
+    def __init__(self, path: str = "TEMP/audio", max_bytes: int = 2 << 30) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> 字节数, 按访问顺序排列
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+
+        if os.path.exists(path):
+            metas = [f for f in os.listdir(path) if f.endswith(".json")]
+            metas.sort(key = lambda f: os.path.getmtime(os.path.join(path, f)))
+            for meta in metas:
+                key = meta[:-len(".json")]
+                pcm = os.path.join(path, key + ".pcm")
+                if os.path.exists(pcm):
+                    self._index[key] = os.path.getsize(pcm)
+                    self._bytes += self._index[key]
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize("NFKC", text)
+        return re.sub(r"\s+", " ", text).strip()
+
+    @classmethod
+    def key(cls, text: str, **identity) -> str:
+        """
+        :param identity: 引擎、音色 (参考音频/提示词)、采样参数 (包括 seed) 等影响输出的所有内容
+        """
+        identity["text"] = cls.normalize(text)
+        blob = json.dumps(identity, sort_keys = True, ensure_ascii = False, default = str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def load(self, key: str) -> AudioChunks | None:
+        """命中时返回 (采样率, int16 片段) 的生成器, 否则返回 None"""
+        with self._lock:
+            if key not in self._index:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._index.move_to_end(key)
+        try:
+            with open(self._file(key, "json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            pcm = np.fromfile(self._file(key, "pcm"), dtype=np.int16)
+            os.utime(self._file(key, "json"))
+        except (OSError, ValueError):
+            # 文件被外部删除或者损坏
+            with self._lock:
+                self._drop(key)
+            return None
+
+        def chunks():
+            offset = 0
+            for n in meta["chunks"]:
+                yield meta["sample_rate"], pcm[offset: offset + n]
+                offset += n
+        return chunks()
+
+    def record(self, key: str, generator: AudioChunks,
+               reject: Callable[[int, np.ndarray], bool] = None, cancel: threading.Event = None) -> AudioChunks:
+        """透传合成结果, 完整结束后写入缓存; 中途关闭、cancel 已设置 (合成被提前停止)
+        或 reject 返回 True 的片段 (例如失败时的静音) 不会写入"""
+        sample_rate, chunks, valid = None, [], True
+        for sr, chunk in generator:
+            chunk = chunk.reshape(-1).astype(np.int16, copy=False)
+            if reject is not None and reject(sr, chunk):
+                valid = False
+            sample_rate = sr
+            chunks.append(chunk)
+            yield sr, chunk
+        if valid and len(chunks) and not (cancel is not None and cancel.is_set()):
+            self._save(key, sample_rate, chunks)
+
+    def cached(self, key: str, factory: Callable[[], AudioChunks],
+               reject: Callable[[int, np.ndarray], bool] = None, cancel: threading.Event = None) -> AudioChunks:
+        """命中时直接返回缓存, 否则调用 factory 合成并记录"""
+        chunks = self.load(key)
+        if chunks is None:
+            chunks = self.record(key, factory(), reject, cancel)
+        return chunks
+
+    def _save(self, key: str, sample_rate: int, chunks: list[np.ndarray]):
+        os.makedirs(self.path, exist_ok = True)
+        # 先写临时文件再重命名, json 最后写入, 作为条目完整的标记
+        tmp = self._file(key, "pcm") + ".%d.tmp" % threading.get_ident()
+        np.concatenate(chunks).tofile(tmp)
+        os.replace(tmp, self._file(key, "pcm"))
+        tmp = self._file(key, "json") + ".%d.tmp" % threading.get_ident()
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({ "sample_rate": sample_rate, "chunks": [c.shape[0] for c in chunks] }, f)
+        os.replace(tmp, self._file(key, "json"))
+
+        size = sum(c.nbytes for c in chunks)
+        with self._lock:
+            self._bytes += size - self._index.get(key, 0)
+            self._index[key] = size
+            self._index.move_to_end(key)
+            self._writes += 1
+            while len(self._index) > 1 and self._bytes > self.max_bytes:
+                self._drop(next(iter(self._index)))
+                self._evictions += 1
+
+    def _drop(self, key: str):
+        self._bytes -= self._index.pop(key, 0)
+        for ext in ("json", "pcm"):
+            try:
+                os.remove(self._file(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def _file(self, key: str, ext: str):
+        return os.path.join(self.path, "%s.%s" % (key, ext))
+
+    def stats(self) -> AudioCacheStats:
+        with self._lock:
+            return AudioCacheStats(
+                items = len(self._index),
+                bytes = self._bytes,
+                hits = self._hits,
+                misses = self._misses,
+                writes = self._writes,
+                evictions = self._evictions,
+            )
 
 
+audio_cache = AudioCache(
+    path = os.getenv("AUDIO_CACHE_PATH", os.path.join(Cache.SAVE_PATH, "audio")),
+    max_bytes = int(os.getenv("AUDIO_CACHE_BYTES", 2 << 30)),
+)
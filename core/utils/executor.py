@@ -0,0 +1,319 @@
+"""
+模型推理执行器
+
+每个引擎 (sensor / cosy / sovits) 拥有独立的工作线程和有界队列,
+异步路由通过 await 获取推理结果, 不再阻塞 uvicorn 的事件循环。
+"""
+from __future__ import annotations
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Generator
+
+from pydantic import BaseModel
+
+from .metrics import QUEUE_WAIT, CANCEL
+if TYPE_CHECKING:
+    from .admission import Ticket
+
+__all__ = ["ExecutorBusy", "ExecutorStats", "CancelToken", "InferenceExecutor", "get_executor", "executors", "iterate_async", "blocking"]
+
+class ExecutorBusy(Exception):
+    """等待队列已满, 拒绝新的请求 (路由层转换为 503)"""
+    def __init__(self, name: str, depth: int) -> None:
+        super().__init__("executor '%s' is busy, %d requests waiting" % (name, depth))
+        self.name = name
+        self.depth = depth
+
+
+class ExecutorStats(BaseModel):
+    name: str
+    workers: int
+    max_queue: int
+    depth: int         # 正在排队的任务数
+    running: int       # 正在执行的任务数
+    submitted: int
+    rejected: int
+    wait_last: float   # ms
+    wait_avg: float    # ms
+    wait_max: float    # ms
+
+
+class CancelToken(threading.Event):
+    """一次请求 (或一轮对话) 的取消令牌
+
+    由路由层创建, 一直传到模型: 模型侧只把它当作 threading.Event, 在每一步解码之间检查 is_set();
+    cancel() 额外执行登记的回调, 用来唤醒阻塞在别处的等待 (例如等待 LLM 文本的 CosyVoice2 LLM 线程)。
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._callbacks_lock = threading.Lock()
+        self._callbacks: list[Callable[[], Any]] = []
+        self.cancelled_at: float = None
+
+    def on_cancel(self, fn: Callable[[], Any]):
+        """登记回调, 已经取消时立即执行"""
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def cancel(self):
+        with self._callbacks_lock:
+            if self.is_set():
+                return
+            self.cancelled_at = time.perf_counter()
+            self.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                print("cancel callback failed: %s" % e)
+
+
+# 生成器结束的标记
+_END = object()
+
+class InferenceExecutor:
+    def __init__(self, name: str, workers: int = 1, max_queue: int = 16) -> None:
+        """
+        :param name: 引擎名称
+        :param workers: 工作线程数, 模型一般不是线程安全的, 默认 1
+        :param max_queue: 排队任务上限, 超过后新请求直接拒绝
+        """
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._running = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._wait_last = 0.0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._loop, name="%s-%d" % (name, i), daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _loop(self):
+        while True:
+            fn, args, kwargs, future, enqueued = self._queue.get()
+            wait = time.perf_counter() - enqueued
+            with self._lock:
+                self._depth -= 1
+                self._wait_last = wait
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            QUEUE_WAIT.observe(wait, engine = self.name)
+            if not future.set_running_or_notify_cancel():
+                # 调用方已经取消 (例如客户端断开), 直接丢弃
+                continue
+            with self._lock:
+                self._running += 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def submit(self, fn: Callable, *args, admit: bool = True, ticket: Ticket = None, **kwargs) -> Future:
+        """提交任务
+
+        :param admit: 是否进行准入检查; 流式任务的后续步骤已被接纳, 不应在中途被拒绝
+        :param ticket: 准入控制的凭证, 任务结束 (或被拒绝、取消) 时归还
+        """
+        with self._lock:
+            if admit and self._depth >= self.max_queue:
+                self._rejected += 1
+                if ticket is not None:
+                    ticket.release()
+                raise ExecutorBusy(self.name, self._depth)
+            self._depth += 1
+            self._submitted += 1
+        future = Future()
+        if ticket is not None:
+            future.add_done_callback(ticket.release)
+        self._queue.put((fn, args, kwargs, future, time.perf_counter()))
+        return future
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """在引擎线程中执行 fn, 并等待其结果"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    async def stream(self, generator: Generator, cancel: CancelToken = None, ticket: Ticket = None) -> AsyncGenerator:
+        """把同步生成器桥接为异步迭代器
+
+        每次 next() 都作为一个独立任务排队, 多个流可以在同一个引擎上交替推进。
+        第一步在返回之前执行, 因此队列已满时会在响应开始前抛出 ExecutorBusy。
+        生成器暂时没有可计算的内容时 (例如等待 LLM 的文本) yield 一个 concurrent.futures.Future,
+        在事件循环中等它完成后再提交下一步, 等待期间不占用工作线程, 这个 Future 不会交给消费方。
+
+        :param cancel: 生成器所用的取消令牌, 没有读完就关闭 (客户端断开、任务取消) 时先取消,
+                       正在引擎线程中运行的那一步可以尽快返回, 不必等到下一次 next()
+        :param ticket: 准入控制的凭证, 生成器关闭后归还
+        """
+        def close():
+            try:
+                generator.close()
+            finally:
+                if ticket is not None:
+                    ticket.release()
+            if cancel is not None and cancel.cancelled_at is not None:
+                # 从取消到模型侧释放完毕的耗时
+                CANCEL.observe(time.perf_counter() - cancel.cancelled_at, engine = self.name)
+
+        def close_after(future: Future):
+            # 上一次 next() 可能仍在另一个工作线程中运行 (取消时无法中断), 结束后再关闭,
+            # 否则 close() 抛出 "generator already executing", 生成器与模型侧的缓存都无法释放
+            future.add_done_callback(lambda _: self.submit(close, admit=False))
+
+        future = self.submit(next, generator, _END)
+        try:
+            first = await asyncio.wrap_future(future)
+        except BaseException:
+            if cancel is not None:
+                cancel.cancel()
+            close_after(future)
+            raise
+
+        async def iterator(item):
+            future = None
+            try:
+                while item is not _END:
+                    if isinstance(item, Future):
+                        # shield: 取消等待时不取消这个 Future, 生产方 (LLM 线程、事件循环) 之后仍会 set_result
+                        await asyncio.shield(asyncio.wrap_future(item))
+                    else:
+                        yield item
+                    future = self.submit(next, generator, _END, admit=False)
+                    item = await asyncio.wrap_future(future)
+            finally:
+                if item is not _END and cancel is not None:
+                    cancel.cancel()
+                # 客户端断开时也要在引擎线程中关闭生成器, 释放模型侧的缓存
+                if future is None:
+                    self.submit(close, admit=False)
+                else:
+                    close_after(future)
+        return iterator(first)
+
+    def stats(self) -> ExecutorStats:
+        with self._lock:
+            return ExecutorStats(
+                name = self.name,
+                workers = self.workers,
+                max_queue = self.max_queue,
+                depth = self._depth,
+                running = self._running,
+                submitted = self._submitted,
+                rejected = self._rejected,
+                wait_last = self._wait_last * 1000,
+                wait_avg = self._wait_total * 1000 / max(self._submitted - self._depth, 1),
+                wait_max = self._wait_max * 1000,
+            )
+
+
+executors: dict[str, InferenceExecutor] = {}
+_executors_lock = threading.Lock()
+
+def get_executor(name: str) -> InferenceExecutor:
+    """获取引擎对应的执行器, 不存在时按照环境变量创建
+
+    线程数: {NAME}_WORKERS, 默认 1
+    队列上限: {NAME}_QUEUE, 默认 16
+    """
+    with _executors_lock:
+        if name not in executors:
+            executors[name] = InferenceExecutor(
+                name,
+                workers = int(os.getenv("%s_WORKERS" % name.upper(), 1)),
+                max_queue = int(os.getenv("%s_QUEUE" % name.upper(), 16)),
+            )
+        return executors[name]
+
+
+def iterate_async(agen: AsyncGenerator, cancel: CancelToken = None) -> Generator:
+    """把异步生成器桥接为同步生成器, 与 InferenceExecutor.stream 相反
+
+    需要在事件循环中调用; 返回的生成器在引擎线程中消费, 异步生成器仍然由事件循环推进。
+    next() 不会阻塞: 还没有新的一项时 yield 一个 Future, 下一项到达 (或结束) 时完成,
+    交给 InferenceExecutor.stream 在事件循环中等待; 在模型自己的线程中消费时用 blocking 包装。
+    第一次 next() 时才开始推进, 生成器关闭时 (例如客户端断开) 取消异步生成器。
+    cancel 被取消时同样取消异步生成器 (关闭 LLM 的上游连接), 消费方立即得到结束。
+    """
+    loop = asyncio.get_running_loop()
+    items: queue.SimpleQueue = queue.SimpleQueue()
+    lock = threading.Lock()
+    waiter: list[Future] = []
+
+    def put(item, error = None):
+        with lock:
+            items.put((item, error))
+            while len(waiter):
+                waiter.pop().set_result(None)
+
+    async def pump():
+        error = None
+        try:
+            async for item in agen:
+                put(item)
+        except Exception as e:
+            error = e
+        finally:
+            # 被取消 (CancelledError, 例如事件循环关闭) 时同样结束, 否则消费方永远等不到下一项
+            put(_END, error)
+            await agen.aclose()
+
+    def iterator():
+        future = asyncio.run_coroutine_threadsafe(pump(), loop)
+        if cancel is not None:
+            def stop():
+                future.cancel()
+                put(_END)
+            cancel.on_cancel(stop)
+        try:
+            while True:
+                with lock:
+                    if items.empty():
+                        ready = Future()
+                        waiter.append(ready)
+                    else:
+                        ready = None
+                        item, error = items.get()
+                if ready is not None:
+                    yield ready
+                    continue
+                if error is not None:
+                    raise error
+                if item is _END:
+                    return
+                yield item
+        finally:
+            future.cancel()
+    return iterator()
+
+
+def blocking(generator: Generator) -> Generator:
+    """在当前线程中等待生成器 yield 的 Future, 只透传其余的项
+
+    用于在模型自己的线程中消费 iterate_async (例如 CosyVoice2 bistream 的 LLM 线程), 那里可以阻塞。
+    """
+    for item in generator:
+        if isinstance(item, Future):
+            item.result()
+            continue
+        yield item
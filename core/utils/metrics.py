@@ -0,0 +1,175 @@
+"""
+语音链路各阶段的延迟指标, 以 Prometheus 文本格式暴露 (/api/metrics)
+
+直方图按 route / engine 等标签区分, 可以直接用来设定 SLO; 内存等瞬时值在抓取时计算。
+"""
+from __future__ import annotations
+import os
+import time
+import bisect
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import AsyncGenerator, Callable, Generator, Iterable, Tuple
+
+import numpy as np
+
+__all__ = [
+    "Histogram", "Gauge", "render", "timed", "server_timing", "instrument_stream", "measure_rtf",
+    "QUEUE_WAIT", "DECODE", "VAD", "ASR", "LLM_TTFT", "TTS_TTFA", "RTF", "CHUNK_INTERVAL", "CANCEL",
+]
+
+# 秒, 覆盖几毫秒的排队到数秒的首包
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0)
+
+_metrics: list = []
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    items = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{%s}" % ",".join(items) if len(items) else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # 标签取值 -> [每个桶的计数 (不累加), 总和, 总数]
+        self._values: dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(k, "") for k in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][i] += 1
+            item[1] += value
+            item[2] += 1
+
+    def collect(self) -> list[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            values = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.labels, key, 'le="%s"' % le), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labels, key), repr(total)))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels, key), count))
+        return lines
+
+
+class Gauge:
+    """抓取时调用 fn 计算, fn 返回 {标签取值: 数值}"""
+    def __init__(self, name: str, help: str, labels: Iterable[str], fn: Callable[[], dict[tuple, float]]) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        _metrics.append(self)
+
+    def collect(self) -> list[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        try:
+            values = self.fn()
+        except Exception:
+            values = {}
+        for key, value in values.items():
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labels, key), repr(float(value))))
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+QUEUE_WAIT = Histogram("speech_queue_wait_seconds", "Time a task waits in an engine executor queue", ["engine"])
+DECODE = Histogram("speech_decode_seconds", "Upload decode and resample time", ["route"])
+VAD = Histogram("speech_vad_seconds", "Streaming VAD time per audio chunk, including queue wait", ["route"])
+ASR = Histogram("speech_asr_seconds", "Speech recognition time, including batching and queue wait", ["route"])
+LLM_TTFT = Histogram("speech_llm_ttft_seconds", "LLM time to first token", ["route"])
+TTS_TTFA = Histogram("speech_tts_ttfa_seconds", "Time from request (or end of speech) to the first audio chunk", ["route", "engine"])
+RTF = Histogram("speech_rtf", "Real time factor, compute time divided by audio duration", ["engine"], RTF_BUCKETS)
+CHUNK_INTERVAL = Histogram("speech_chunk_interval_seconds", "Inter-arrival time between audio chunks of one stream", ["route", "engine"])
+CANCEL = Histogram("speech_cancel_seconds", "Time from cancelling a stream to the engine releasing it", ["engine"])
+
+
+def _process_memory():
+    # 当前常驻内存, 读取失败时退回到峰值
+    try:
+        with open("/proc/self/statm") as f:
+            return { (): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") }
+    except (OSError, ValueError):
+        import resource
+        return { (): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 }
+
+def _gpu_memory(fn: str):
+    import torch
+    if not torch.cuda.is_available():
+        return {}
+    return { (str(i),): getattr(torch.cuda, fn)(i) for i in range(torch.cuda.device_count()) }
+
+Gauge("process_resident_memory_bytes", "Resident memory of the server process", [], _process_memory)
+Gauge("speech_gpu_memory_allocated_bytes", "Memory allocated by tensors on each GPU", ["device"], lambda: _gpu_memory("memory_allocated"))
+Gauge("speech_gpu_memory_reserved_bytes", "Memory reserved by the caching allocator on each GPU", ["device"], lambda: _gpu_memory("memory_reserved"))
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+
+def server_timing(route: str, decode: float, asr: float) -> dict:
+    """记录解码与识别的耗时 (秒), 并生成 Server-Timing 头 (ms)"""
+    DECODE.observe(decode, route = route)
+    ASR.observe(asr, route = route)
+    timing = { "decode": decode, "asr": asr }
+    return { "Server-Timing": ", ".join("%s;dur=%.1f" % (k, v * 1000) for k, v in timing.items()) }
+
+async def instrument_stream(stream: AsyncGenerator, route: str, engine: str, start: float = None) -> AsyncGenerator:
+    """记录流式响应的首包时间与片段间隔
+
+    :param start: 计算首包时间的起点, 默认为调用时
+    """
+    start = time.perf_counter() if start is None else start
+    last = None
+    async for item in stream:
+        now = time.perf_counter()
+        if last is None:
+            TTS_TTFA.observe(now - start, route = route, engine = engine)
+        else:
+            CHUNK_INTERVAL.observe(now - last, route = route, engine = engine)
+        last = now
+        yield item
+
+
+def measure_rtf(engine: str, chunks: Generator[Tuple[int, np.ndarray], None, None]) -> Generator[Tuple[int, np.ndarray], None, None]:
+    """统计合成的实时率, 只计算生成器内部的耗时, 不包括消费方的等待; Future (见 InferenceExecutor.stream) 原样透传"""
+    compute, seconds = 0.0, 0.0
+    start = time.perf_counter()
+    for item in chunks:
+        compute += time.perf_counter() - start
+        if not isinstance(item, Future):
+            seconds += item[1].shape[-1] / item[0]
+        yield item
+        start = time.perf_counter()
+    if seconds > 0:
+        RTF.observe(compute / seconds, engine = engine)
@@ -0,0 +1,116 @@
+"""
+模型注册表
+
+导入模型模块时只登记加载函数, 不加载权重; 服务启动时 load_models 在后台线程中同时加载所有已登记的模型,
+并各自做一次简短的推理预热 (kernel 选择、显存池等), 同名模型在所有路由之间只有一个实例。
+加载完成前调用 get 会阻塞 (在引擎线程中) 直到模型可用。
+"""
+from __future__ import annotations
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Generic, Literal, Optional, TypeVar
+
+from pydantic import BaseModel
+
+__all__ = ["ModelStats", "LazyModel", "register_model", "models", "load_models"]
+
+T = TypeVar("T")
+
+class ModelStats(BaseModel):
+    name: str
+    state: Literal["pending", "loading", "warming", "ready", "failed"]
+    load_time: float     # s
+    warmup_time: float   # s
+    error: Optional[str] = None
+
+
+class LazyModel(Generic[T]):
+    def __init__(self, name: str, loader: Callable[[], T], warmup: Callable[[T], Any] = None) -> None:
+        """
+        :param loader: 加载并返回模型实例
+        :param warmup: 对加载好的实例做一次推理, 失败时只打印, 不影响可用
+        """
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+
+        self._lock = threading.Lock()
+        self._future: Optional[Future] = None
+        self._state = "pending"
+        self._load_time = 0.0
+        self._warmup_time = 0.0
+        self._error: Optional[str] = None
+
+    def start(self) -> Future:
+        """在后台线程中开始加载, 重复调用返回同一个 Future"""
+        with self._lock:
+            if self._future is None:
+                self._future = Future()
+                threading.Thread(target=self._load, name="load-%s" % self.name, daemon=True).start()
+            return self._future
+
+    def _load(self):
+        future = self._future
+        self._state = "loading"
+        start = time.perf_counter()
+        try:
+            instance = self.loader()
+        except BaseException as e:
+            self._state = "failed"
+            self._error = "%s: %s" % (type(e).__name__, e)
+            print("model %s failed to load: %s" % (self.name, self._error))
+            future.set_exception(e)
+            return
+        self._load_time = time.perf_counter() - start
+
+        if self.warmup is not None and os.getenv("MODEL_WARMUP", "1") == "1":
+            self._state = "warming"
+            start = time.perf_counter()
+            try:
+                self.warmup(instance)
+            except Exception as e:
+                print("model %s warmup failed: %s" % (self.name, e))
+            self._warmup_time = time.perf_counter() - start
+        self._state = "ready"
+        print("model %s ready, load %.2fs, warmup %.2fs" % (self.name, self._load_time, self._warmup_time))
+        future.set_result(instance)
+
+    def get(self) -> T:
+        """返回模型实例, 尚未加载时阻塞等待; 不要在事件循环中调用"""
+        return self.start().result()
+
+    async def aget(self) -> T:
+        """get 的异步版本, 等待期间不阻塞事件循环"""
+        return await asyncio.wrap_future(self.start())
+
+    @property
+    def ready(self) -> bool:
+        return self._state == "ready"
+
+    def stats(self) -> ModelStats:
+        return ModelStats(
+            name = self.name,
+            state = self._state,
+            load_time = self._load_time,
+            warmup_time = self._warmup_time,
+            error = self._error,
+        )
+
+
+models: dict[str, LazyModel] = {}
+_models_lock = threading.Lock()
+
+def register_model(name: str, loader: Callable[[], T], warmup: Callable[[T], Any] = None) -> LazyModel[T]:
+    """登记模型, 同名只登记一次, 之后返回已有的实例"""
+    with _models_lock:
+        if name not in models:
+            models[name] = LazyModel(name, loader, warmup)
+        return models[name]
+
+def load_models():
+    """同时开始加载所有已登记的模型, 不等待完成"""
+    for model in list(models.values()):
+        model.start()
@@ -1,3 +1,4 @@
+import os
 import time
 import threading
 
@@ -79,5 +80,8 @@ class SnowflakeIDGenerator:
                  self.sequence
             return id
 
+# 整个进程共用一个生成器, 同一毫秒内的并发调用依靠序列号区分
+_generator = SnowflakeIDGenerator(int(os.getenv("MACHINE_ID", 0)))
+
 def generate_snowflake_id():
-    return SnowflakeIDGenerator(0).generate_id()
+    return _generator.generate_id()
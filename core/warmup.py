@@ -0,0 +1,42 @@
+"""
+部署时预先合成问题库并写入音频缓存, 访谈中的固定问题不再占用 GPU
+
+    python -m core.warmup --engine cosy
+    python -m core.warmup --engine sovits --lang zh --streaming --seed 0
+
+sovits 只缓存固定 seed 的合成, 请求需要使用与 --seed 相同的 seed 才能命中
+"""
+import json
+import time
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices = ["cosy", "sovits"], default = "cosy")
+    parser.add_argument("--questions", default = "data/config/questions.json")
+    parser.add_argument("--lang", default = "zh", help = "sovits 的 text_lang")
+    parser.add_argument("--streaming", action = "store_true", help = "sovits 按流式请求的参数合成")
+    parser.add_argument("--seed", type = int, default = 0, help = "sovits 的 seed, 为 -1 时不写入缓存")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions: list[str] = json.load(f)
+
+    if args.engine == "cosy":
+        from .model.cosy import synthesize
+        render = synthesize
+    else:
+        from .model.sovits import synthesize, prepare, TTS_Request
+        def render(text: str):
+            req = TTS_Request(text = text, text_lang = args.lang, streaming_mode = args.streaming, seed = args.seed)
+            return synthesize(prepare(req.model_dump()))
+    from .utils.cache import audio_cache
+
+    for i, text in enumerate(questions):
+        start = time.perf_counter()
+        seconds = sum(chunk.shape[0] / sr for sr, chunk in render(text))
+        print("[%d/%d] audio %.2fs, cost %.2fs: %s" % (i + 1, len(questions), seconds, time.perf_counter() - start, text))
+    print(audio_cache.stats())
+
+if __name__ == "__main__":
+    main()
@@ -668,7 +668,10 @@ class Text2SemanticDecoder(nn.Module):
         y_list = [None]*y.shape[0]
         batch_idx_map = list(range(y.shape[0]))
         idx_list = [None]*y.shape[0]
+        # threading.Event, 被设置后在当前这一步结束解码, 未完成的序列按提前停止处理
+        stop_event = kwargs.get("stop_event", None)
         for idx in tqdm(range(1500)):
+            early_stop = False
             if idx == 0:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask, False)
             else:
@@ -718,8 +721,13 @@ class Text2SemanticDecoder(nn.Module):
                         v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
                 
                 
+            if stop_event is not None and stop_event.is_set():
+                print("T2S Decoding stopped by stop_event")
+                early_stop = True
             if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx==1499:
                 print("use early stop num:", early_stop_num)
+                early_stop = True
+            if early_stop:
                 stop = True
                 for i, batch_index in enumerate(batch_idx_map):
                     batch_index = batch_idx_map[i]
@@ -842,6 +850,7 @@ class Text2SemanticDecoder(nn.Module):
                                                 .view(bsz, self.num_head, src_len, src_len)\
                                                 .to(device=x.device, dtype=torch.bool)
 
+        stop_event = kwargs.get("stop_event", None)
         for idx in tqdm(range(1500)):
             if xy_attn_mask is not None:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
@@ -866,6 +875,9 @@ class Text2SemanticDecoder(nn.Module):
             if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
                 print("use early stop num:", early_stop_num)
                 stop = True
+            if stop_event is not None and stop_event.is_set():
+                print("T2S Decoding stopped by stop_event")
+                stop = True
 
             if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
                 stop = True
@@ -26,6 +26,8 @@ from tools.my_utils import load_audio
 from module.mel_processing import spectrogram_torch
 from TTS_infer_pack.text_segmentation_method import splits
 from TTS_infer_pack.TextPreprocessor import TextPreprocessor
+# 优先读取 python -m core.convert 生成的打包权重, 与 CosyVoice 共用
+from cosyvoice.utils.file_utils import load_checkpoint
 language=os.environ.get("language","Auto")
 language=sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
 i18n = I18nAuto(language=language)
@@ -79,7 +81,7 @@ def set_seed(seed:int):
     except:
         pass
     return seed
-    
+
 class TTS_Config:
     default_configs={
         "default":{
@@ -304,7 +306,7 @@ class TTS:
     def init_vits_weights(self, weights_path: str):
         print(f"Loading VITS weights from {weights_path}")
         self.configs.vits_weights_path = weights_path
-        dict_s2 = torch.load(weights_path, map_location=self.configs.device)
+        dict_s2, packed = load_checkpoint(weights_path, self.configs.device)
         hps = dict_s2["config"]
         if dict_s2['weight']['enc_p.text_embedding.weight'].shape[0] == 322:
             self.configs.update_version("v1")
@@ -333,7 +335,7 @@ class TTS:
             
         vits_model = vits_model.to(self.configs.device)
         vits_model = vits_model.eval()
-        vits_model.load_state_dict(dict_s2["weight"], strict=False)
+        vits_model.load_state_dict(dict_s2["weight"], strict=False, assign=packed and str(self.configs.device) == "cpu")
         self.vits_model = vits_model
         if self.configs.is_half and str(self.configs.device)!="cpu":
             self.vits_model = self.vits_model.half()
@@ -344,7 +346,8 @@ class TTS:
         self.configs.t2s_weights_path = weights_path
         self.configs.save_configs()
         self.configs.hz = 50
-        dict_s1 = torch.load(weights_path, map_location=self.configs.device)
+        # T2SBlock 在构造时保存了各层权重的引用, 不能用 assign 替换参数, 只能复制进去
+        dict_s1, _ = load_checkpoint(weights_path, self.configs.device)
         config = dict_s1["config"]
         self.configs.max_sec = config["data"]["max_sec"]
         t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
@@ -676,7 +679,8 @@ class TTS:
                     "fragment_interval":0.3,      # float. to control the interval of the audio fragment.
                     "seed": -1,                   # int. random seed for reproducibility.
                     "parallel_infer": True,       # bool. whether to use parallel inference.
-                    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+                    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+                    "stop_event": None,           # threading.Event.(optional) set to stop this request within one T2S decode step.
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
@@ -704,6 +708,9 @@ class TTS:
         actual_seed = set_seed(seed)
         parallel_infer = inputs.get("parallel_infer", True)
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
+        stop_event = inputs.get("stop_event", None)
+        # stop() 停止所有请求, stop_event 只停止本次请求
+        stopped = lambda: self.stop_flag or (stop_event is not None and stop_event.is_set())
 
         if parallel_infer:
             print(i18n("并行推理模式已开启"))
@@ -877,10 +884,17 @@ class TTS:
                     early_stop_num=self.configs.hz * self.configs.max_sec,
                     max_len=max_len,
                     repetition_penalty=repetition_penalty,
+                    stop_event=stop_event,
                 )
                 t4 = ttime()
                 t_34 += t4 - t3
 
+                if stopped():
+                    # 已经停止, 不再进行 vits 解码
+                    yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+                                                            dtype=np.int16)
+                    return
+
                 refer_audio_spec:torch.Tensor = [item.to(dtype=self.precision, device=self.configs.device) for item in self.prompt_cache["refer_spec"]]
                                                     
 
@@ -938,7 +952,7 @@ class TTS:
                 else:
                     audio.append(batch_audio_fragment)
 
-                if self.stop_flag:
+                if stopped():
                     yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
                                                             dtype=np.int16)
                     return
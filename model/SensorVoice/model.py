@@ -137,6 +137,35 @@ class MultiHeadedAttentionSANM(nn.Module):
             x = x * mask
         return x
 
+    def forward_fsmn_chunk(self, inputs, cache, chunk_size):
+        """FSMN memory for streaming, the left context of the block is kept in cache["fsmn"].
+
+        Args:
+            inputs (torch.Tensor): Value tensor of current chunk (#batch, time, size),
+                the last chunk_size[2] frames are lookahead and will be fed again with the next chunk.
+            cache (dict): Cache of this layer.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time, size).
+
+        """
+        t = inputs.size(1)
+        left = self.pad_fn.padding[0]
+        if "fsmn" in cache:
+            x = torch.cat((cache["fsmn"], inputs), dim=1)
+        else:
+            x = inputs
+        if left > 0:
+            stride = x[:, : x.size(1) - chunk_size[2], :]
+            cache["fsmn"] = stride[:, -left:, :]
+
+        x = self.pad_fn(x.transpose(1, 2))
+        x = self.fsmn_block(x)
+        x = x.transpose(1, 2)[:, -t:, :]
+        x = x + inputs
+        x = self.dropout(x)
+        return x
+
     def forward_qkv(self, x):
         """Transform query, key and value.
 
@@ -242,8 +271,8 @@ class MultiHeadedAttentionSANM(nn.Module):
         q_h, k_h, v_h, v = self.forward_qkv(x)
         if chunk_size is not None and look_back > 0 or look_back == -1:
             if cache is not None:
-                k_h_stride = k_h[:, :, : -(chunk_size[2]), :]
-                v_h_stride = v_h[:, :, : -(chunk_size[2]), :]
+                k_h_stride = k_h[:, :, : k_h.size(2) - chunk_size[2], :]
+                v_h_stride = v_h[:, :, : v_h.size(2) - chunk_size[2], :]
                 k_h = torch.cat((cache["k"], k_h), dim=2)
                 v_h = torch.cat((cache["v"], v_h), dim=2)
 
@@ -254,11 +283,14 @@ class MultiHeadedAttentionSANM(nn.Module):
                     cache["v"] = cache["v"][:, :, -(look_back * chunk_size[1]) :, :]
             else:
                 cache_tmp = {
-                    "k": k_h[:, :, : -(chunk_size[2]), :],
-                    "v": v_h[:, :, : -(chunk_size[2]), :],
+                    "k": k_h[:, :, : k_h.size(2) - chunk_size[2], :],
+                    "v": v_h[:, :, : v_h.size(2) - chunk_size[2], :],
                 }
                 cache = cache_tmp
-        fsmn_memory = self.forward_fsmn(v, None)
+        if chunk_size is not None and cache is not None:
+            fsmn_memory = self.forward_fsmn_chunk(v, cache, chunk_size)
+        else:
+            fsmn_memory = self.forward_fsmn(v, None)
         q_h = q_h * self.d_k ** (-0.5)
         scores = torch.matmul(q_h, k_h.transpose(-2, -1))
         att_outs = self.forward_attention(v_h, scores, None)
@@ -576,6 +608,45 @@ class SenseVoiceEncoderSmall(nn.Module):
         xs_pad = self.tp_norm(xs_pad)
         return xs_pad, olens
 
+    def forward_chunk(
+        self,
+        xs_pad: torch.Tensor,
+        cache: dict,
+        chunk_size: tuple,
+        look_back: int = -1,
+    ):
+        """Encode one chunk for streaming.
+
+        Args:
+            xs_pad (torch.Tensor): Input of current chunk (1, time, size),
+                the last chunk_size[2] frames are lookahead.
+            cache (dict): Attention/FSMN cache of every layer and the position offset, updated in place.
+            chunk_size (tuple): (left, stride, lookahead) in frames.
+            look_back (int): Number of history chunks to attend, -1 for all.
+
+        Returns:
+            torch.Tensor: Output tensor (1, time, size).
+
+        """
+        offset = cache.get("offset", 0)
+        xs_pad = xs_pad * self.output_size() ** 0.5
+        positions = torch.arange(offset + 1, offset + xs_pad.size(1) + 1, device=xs_pad.device)[None, :]
+        xs_pad = xs_pad + self.embed.encode(positions, xs_pad.size(2), xs_pad.dtype).to(xs_pad.device)
+        cache["offset"] = offset + xs_pad.size(1) - chunk_size[2]
+
+        for layer_idx, encoder_layer in enumerate(list(self.encoders0) + list(self.encoders)):
+            key = "layer%d" % layer_idx
+            xs_pad, cache[key] = encoder_layer.forward_chunk(xs_pad, cache.get(key), chunk_size, look_back)
+
+        xs_pad = self.after_norm(xs_pad)
+
+        for layer_idx, encoder_layer in enumerate(self.tp_encoders):
+            key = "tp_layer%d" % layer_idx
+            xs_pad, cache[key] = encoder_layer.forward_chunk(xs_pad, cache.get(key), chunk_size, look_back)
+
+        xs_pad = self.tp_norm(xs_pad)
+        return xs_pad
+
 
 @tables.register("model_classes", "SenseVoiceSmall")
 class SenseVoiceSmall(nn.Module):
@@ -886,3 +957,72 @@ class SenseVoiceSmall(nn.Module):
                 ibest_writer["text"][key[i]] = text
 
         return results, meta_data
+
+    @torch.no_grad()
+    def inference_chunk(
+        self,
+        speech: torch.Tensor,
+        cache: dict,
+        chunk_size: tuple = (0, 10, 5),
+        look_back: int = -1,
+        is_final: bool = False,
+        tokenizer=None,
+        frontend=None,
+        **kwargs,
+    ):
+        """Streaming inference, encode the features chunk by chunk and decode the CTC hypothesis so far.
+
+        Args:
+            speech (torch.Tensor): New LFR/CMVN features (time, size), may be empty.
+            cache (dict): Session state, an empty dict for a new utterance.
+            chunk_size (tuple): (left, stride, lookahead) in LFR frames.
+            is_final (bool): Flush the remaining features, including lookahead.
+
+        Returns:
+            str: Partial (or final when is_final) text.
+
+        """
+        device = kwargs["device"]
+        if len(cache) == 0:
+            language = kwargs.get("language", "auto")
+            use_itn = kwargs.get("use_itn", False)
+            textnorm = kwargs.get("text_norm", None)
+            if textnorm is None:
+                textnorm = "withitn" if use_itn else "woitn"
+            # same order as inference: language, event, emotion, textnorm
+            query = torch.LongTensor(
+                [[self.lid_dict[language] if language in self.lid_dict else 0, 1, 2, self.textnorm_dict[textnorm]]]
+            ).to(device)
+            cache["query"] = self.embed(query)
+            cache["feats"] = torch.zeros(0, speech.size(-1))
+            cache["encoder"] = {}
+            cache["yseq"] = []
+
+        stride, lookahead = chunk_size[1], chunk_size[2]
+        feats = torch.cat((cache["feats"], speech.cpu()), dim=0)
+        while feats.size(0) >= stride + lookahead or (is_final and feats.size(0) > 0):
+            if feats.size(0) >= stride + lookahead:
+                x, this_chunk_size = feats[: stride + lookahead], chunk_size
+                feats = feats[stride:]
+            else:
+                x, this_chunk_size = feats, (chunk_size[0], feats.size(0), 0)
+                feats = feats[:0]
+            x = x[None, :, :].to(device)
+            if cache["query"] is not None:
+                x = torch.cat((cache["query"], x), dim=1)
+                this_chunk_size = (this_chunk_size[0], this_chunk_size[1] + cache["query"].size(1), this_chunk_size[2])
+                cache["query"] = None
+
+            encoder_out = self.encoder.forward_chunk(x, cache["encoder"], this_chunk_size, look_back)
+            encoder_out = encoder_out[:, : encoder_out.size(1) - this_chunk_size[2], :]
+            ctc_logits = self.ctc.log_softmax(encoder_out)
+            if kwargs.get("ban_emo_unk", False):
+                ctc_logits[:, :, self.emo_dict["unk"]] = -float("inf")
+            cache["yseq"].extend(ctc_logits[0].argmax(dim=-1).tolist())
+        cache["feats"] = feats
+
+        if not len(cache["yseq"]):
+            return ""
+        yseq = torch.unique_consecutive(torch.tensor(cache["yseq"]), dim=-1)
+        token_int = yseq[yseq != self.blank_id].tolist()
+        return tokenizer.decode(token_int)
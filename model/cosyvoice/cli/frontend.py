@@ -14,6 +14,8 @@
 from functools import partial
 from typing import Generator
 import json
+import hashlib
+import threading
 import onnxruntime
 import torch
 import numpy as np
@@ -55,10 +57,13 @@ class CosyVoiceFrontEnd:
         self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
                                                                      providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
                                                                                 "CPUExecutionProvider"])
+        self.spk2info_path = spk2info
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
+        # guards spk2info when zero shot speakers are added from several threads
+        self.spk2info_lock = threading.Lock()
         self.allowed_special = allowed_special
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
@@ -154,8 +159,7 @@ class CosyVoiceFrontEnd:
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
         return model_input
 
-    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate):
-        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+    def _extract_prompt(self, prompt_text, prompt_speech_16k, resample_rate):
         prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
         prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
         speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
@@ -166,16 +170,61 @@ class CosyVoiceFrontEnd:
             speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
             speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
         embedding = self._extract_spk_embedding(prompt_speech_16k)
-        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
-                       'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        return {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                'llm_embedding': embedding, 'flow_embedding': embedding}
+
+    @staticmethod
+    def prompt_hash(prompt_text, prompt_speech_16k, resample_rate):
+        speech = prompt_speech_16k.detach().cpu().contiguous().float().numpy()
+        return hashlib.sha256('{}|{}|{}|'.format(resample_rate, prompt_text, speech.shape).encode('utf-8') + speech.tobytes()).hexdigest()
+
+    def add_zero_shot_spk(self, prompt_text, prompt_speech_16k, resample_rate, zero_shot_spk_id=''):
+        """Extract the prompt features once and keep them in spk2info, so later calls only pass the id.
+
+        The features are identified by a hash of the prompt text and audio: when zero_shot_spk_id
+        is empty the hash is used as the id, and an existing entry with the same content is reused.
+        Returns the id and whether a new entry was added.
+        """
+        digest = self.prompt_hash(prompt_text, prompt_speech_16k, resample_rate)
+        zero_shot_spk_id = zero_shot_spk_id or digest
+        with self.spk2info_lock:
+            if self.spk2info.get(zero_shot_spk_id, {}).get('prompt_hash') == digest:
+                return zero_shot_spk_id, False
+        model_input = self._extract_prompt(prompt_text, prompt_speech_16k, resample_rate)
+        model_input['prompt_hash'] = digest
+        with self.spk2info_lock:
+            self.spk2info[zero_shot_spk_id] = model_input
+        return zero_shot_spk_id, True
+
+    def save_spk2info(self):
+        with self.spk2info_lock:
+            spk2info = dict(self.spk2info)
+        # write then rename, a crash while saving must not corrupt the file shipped with the model
+        torch.save(spk2info, self.spk2info_path + '.tmp')
+        os.replace(self.spk2info_path + '.tmp', self.spk2info_path)
+
+    def _zero_shot_spk(self, zero_shot_spk_id):
+        model_input = dict(self.spk2info[zero_shot_spk_id])
+        model_input.pop('prompt_hash', None)
         return model_input
 
-    def frontend_cross_lingual(self, tts_text, prompt_speech_16k, resample_rate):
-        model_input = self.frontend_zero_shot(tts_text, '', prompt_speech_16k, resample_rate)
+    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, resample_rate, zero_shot_spk_id=''):
+        tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+        if zero_shot_spk_id == '':
+            model_input = self._extract_prompt(prompt_text, prompt_speech_16k, resample_rate)
+        else:
+            model_input = self._zero_shot_spk(zero_shot_spk_id)
+            # a given prompt text (e.g. the instruct text) replaces the one added with the speaker
+            if prompt_text != '':
+                model_input['prompt_text'], model_input['prompt_text_len'] = self._extract_text_token(prompt_text)
+        model_input['text'], model_input['text_len'] = tts_text_token, tts_text_token_len
+        return model_input
+
+    def frontend_cross_lingual(self, tts_text, prompt_speech_16k, resample_rate, zero_shot_spk_id=''):
+        model_input = self.frontend_zero_shot(tts_text, '', prompt_speech_16k, resample_rate, zero_shot_spk_id)
         # in cross lingual mode, we remove prompt in llm
         del model_input['prompt_text']
         del model_input['prompt_text_len']
@@ -192,17 +241,23 @@ class CosyVoiceFrontEnd:
         model_input['prompt_text_len'] = instruct_text_token_len
         return model_input
 
-    def frontend_instruct2(self, tts_text, instruct_text, prompt_speech_16k, resample_rate):
-        model_input = self.frontend_zero_shot(tts_text, instruct_text + '<|endofprompt|>', prompt_speech_16k, resample_rate)
+    def frontend_instruct2(self, tts_text, instruct_text, prompt_speech_16k, resample_rate, zero_shot_spk_id=''):
+        model_input = self.frontend_zero_shot(tts_text, instruct_text + '<|endofprompt|>', prompt_speech_16k, resample_rate, zero_shot_spk_id)
         del model_input['llm_prompt_speech_token']
         del model_input['llm_prompt_speech_token_len']
         return model_input
 
-    def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+    def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate, zero_shot_spk_id=''):
+        if zero_shot_spk_id == '':
+            prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
+            prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+            prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
+            embedding = self._extract_spk_embedding(prompt_speech_16k)
+        else:
+            spk = self.spk2info[zero_shot_spk_id]
+            prompt_speech_token, prompt_speech_token_len = spk['flow_prompt_speech_token'], spk['flow_prompt_speech_token_len']
+            prompt_speech_feat, prompt_speech_feat_len = spk['prompt_speech_feat'], spk['prompt_speech_feat_len']
+            embedding = spk['flow_embedding']
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
@@ -237,3 +237,78 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        prompt_token,
+                        prompt_feat,
+                        embedding,
+                        cache,
+                        finalize,
+                        encoder_context=-1,
+                        decoder_context=0):
+        """Incremental inference for streaming.
+
+        token only contains the new tokens of this chunk, followed by pre_lookahead_len
+        lookahead tokens if finalize is False. The encoder attends to the cached states of
+        earlier tokens, the decoder only solves the new frames, conditioned on the prompt and
+        the last decoder_context generated frames (used as cond, like prompt_feat), so the cost
+        of a chunk does not grow with the utterance length.
+
+        cache is an empty dict for the first chunk and is updated in place.
+        Returns the mel of the new tokens, like inference(...)[:, :, token_offset * token_mel_ratio:].
+        """
+        if self.fp16 is True:
+            prompt_feat = prompt_feat.half()
+            embedding = embedding.half()
+
+        assert token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # the first chunk also encodes the prompt
+        first = 'encoder' not in cache
+        if first:
+            token = torch.concat([prompt_token, token], dim=1)
+            cache.update(encoder={}, offset=0)
+        token = self.input_embedding(torch.clamp(token, min=0))
+
+        # text encode
+        h = self.encoder.forward_chunk(token, cache['encoder'], finalize,
+                                       keep=prompt_token.shape[1], context=encoder_context)
+        if finalize is False:
+            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
+        h = self.encoder_proj(h).transpose(1, 2)
+        mel_len1 = prompt_feat.shape[1]
+        if first:
+            cache['prompt_mu'], h = h[:, :, :mel_len1], h[:, :, mel_len1:]
+            cache['context_mu'] = cache['context_mel'] = h[:, :, :0]
+        mel_len2, offset = h.shape[2], cache['offset']
+        if mel_len2 == 0:
+            return h.new_zeros(1, self.output_size, 0).float()
+
+        # decode the window: prompt + generated context + new frames
+        mu = torch.concat([cache['prompt_mu'], cache['context_mu'], h], dim=2)
+        conds = torch.concat([prompt_feat.transpose(1, 2).to(h.dtype), cache['context_mel'], torch.zeros_like(h)], dim=2)
+        context_len = cache['context_mu'].shape[2]
+        # the same noise as inference on the whole utterance
+        index = torch.concat([torch.arange(mel_len1),
+                              torch.arange(mel_len1 + offset - context_len, mel_len1 + offset + mel_len2)])
+        mask = torch.ones(1, 1, mu.shape[2], device=h.device, dtype=h.dtype)
+        feat, _ = self.decoder(
+            mu=mu.contiguous(),
+            mask=mask,
+            spks=embedding,
+            cond=conds,
+            n_timesteps=10,
+            index=index
+        )
+        feat = feat[:, :, -mel_len2:]
+
+        context_start = max(context_len + mel_len2 - decoder_context, 0)
+        cache['context_mu'] = torch.concat([cache['context_mu'], h], dim=2)[:, :, context_start:]
+        cache['context_mel'] = torch.concat([cache['context_mel'], feat.to(h.dtype)], dim=2)[:, :, context_start:]
+        cache['offset'] = offset + mel_len2
+        return feat.float()
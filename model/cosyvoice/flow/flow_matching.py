@@ -190,7 +190,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, index=None):
         """Forward diffusion
 
         Args:
@@ -203,13 +203,21 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            index (torch.Tensor, optional): positions of the frames in the utterance, so that
+                incremental inference on a window uses the same noise as the whole utterance.
+                Defaults to None, the frames are 0 ~ mel_timesteps - 1.
+                shape: (mel_timesteps,)
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        if index is None:
+            z = self.rand_noise[:, :, :mu.size(2)]
+        else:
+            z = self.rand_noise[:, :, index.cpu() % self.rand_noise.size(2)]
+        z = z.to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
@@ -11,6 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import threading
+from collections import OrderedDict
 from typing import Dict, Optional, Callable, List, Generator
 import torch
 from torch import nn
@@ -229,11 +231,13 @@ class Qwen2Encoder(torch.nn.Module):
         super().__init__()
         self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
 
-    def forward_one_step(self, xs, masks, cache=None):
+    def forward_one_step(self, xs, masks, cache=None, position_ids=None):
+        # position_ids is needed for a left padded batch, see DecodeScheduler
         input_masks = masks[:, -1, :]
         outs = self.model(
             inputs_embeds=xs,
             attention_mask=input_masks,
+            position_ids=position_ids,
             output_hidden_states=True,
             return_dict=True,
             use_cache=True,
@@ -244,6 +248,48 @@ class Qwen2Encoder(torch.nn.Module):
         return xs, new_cache
 
 
+class PrefixCache:
+    """LRU cache of the past_key_values of prompt prefixes, evicted under a memory budget.
+
+    The cached tensors are never modified: the llm concatenates new keys/values into new tensors,
+    so every session can start decoding from the same entry without copying it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, cache):
+        # newer transformers return a Cache object, keep the tensors only
+        if hasattr(cache, 'to_legacy_cache'):
+            cache = cache.to_legacy_cache()
+        size = sum(t.numel() * t.element_size() for layer in cache for t in layer)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (cache, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+
+
 class Qwen2LM(TransformerLM):
     def __init__(
             self,
@@ -283,23 +329,25 @@ class Qwen2LM(TransformerLM):
         self.sampling = sampling
         self.mix_ratio = mix_ratio
 
+        # 5. [Optional] PrefixCache of [sos, prompt_text], see enable_prefix_cache
+        self.prefix_cache = None
+
+    def enable_prefix_cache(self, max_bytes: int):
+        """Reuse the past_key_values of [sos, prompt_text] across calls of inference.
+
+        prompt_text is the instruct text in instruct2 mode and the prompt text in zero shot mode,
+        it is the same for every sentence of a voice, so prefill only runs on the new text
+        (and the prompt speech tokens, which come after the text and attend to it).
+        """
+        self.prefix_cache = PrefixCache(max_bytes) if max_bytes > 0 else None
+
     @torch.inference_mode()
-    def inference(
-            self,
-            text: torch.Tensor,
-            text_len: torch.Tensor,
-            prompt_text: torch.Tensor,
-            prompt_text_len: torch.Tensor,
-            prompt_speech_token: torch.Tensor,
-            prompt_speech_token_len: torch.Tensor,
-            embedding: torch.Tensor,
-            sampling: int = 25,
-            max_token_text_ratio: float = 20,
-            min_token_text_ratio: float = 2,
-    ) -> Generator[torch.Tensor, None, None]:
+    def prepare_input(self, text, text_len, prompt_text, prompt_text_len, prompt_speech_token, prompt_speech_token_len,
+                      max_token_text_ratio=20, min_token_text_ratio=2):
+        """Returns lm_input [sos, prompt_text + text, task_id, prompt_speech_token] and min/max decode length"""
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
-        text_len += prompt_text_len
+        text_len = text_len + prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
 
         # 3. concat llm_input
@@ -314,13 +362,58 @@ class Qwen2LM(TransformerLM):
         # 4. cal min/max_length
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        return lm_input, min_len, max_len
+
+    def prefill(self, lm_input, prompt_text):
+        """Returns the log probabilities of the first speech token and the cache of lm_input"""
+        cache = None
+        if self.prefix_cache is not None:
+            cache, lm_input = self.prefill_prefix(lm_input, prompt_text)
+        seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+        y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                  masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                  cache=cache)
+        return self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1), cache
+
+    def prefill_prefix(self, lm_input, prompt_text):
+        """Returns the cache of lm_input[:, :1 + prompt_text_len] and the rest of lm_input"""
+        prefix_len = 1 + prompt_text.shape[1]
+        key = (str(lm_input.dtype), tuple(prompt_text.flatten().tolist()))
+        cache = self.prefix_cache.get(key)
+        if cache is None:
+            _, cache = self.llm.forward_one_step(lm_input[:, :prefix_len],
+                                                 masks=torch.tril(torch.ones((1, prefix_len, prefix_len), device=lm_input.device)).to(torch.bool),
+                                                 cache=None)
+            self.prefix_cache.put(key, cache)
+        return cache, lm_input[:, prefix_len:]
+
+    @torch.inference_mode()
+    def inference(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+    ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_input(text, text_len, prompt_text, prompt_text_len,
+                                                        prompt_speech_token, prompt_speech_token_len,
+                                                        max_token_text_ratio, min_token_text_ratio)
 
         # 5. step by step decode
         out_tokens = []
         cache = None
+        if self.prefix_cache is not None:
+            cache, lm_input = self.prefill_prefix(lm_input, prompt_text)
         for i in range(max_len):
+            seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
             y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
@@ -0,0 +1,238 @@
+"""Continuous batching decode scheduler for Qwen2LM.
+
+Every Qwen2LM.inference call runs its own batch-1 token loop, so N concurrent sessions run N
+interleaved tiny forwards. DecodeScheduler owns the llm in one thread instead: new sessions are
+prefilled and admitted into the running batch between steps, all active sequences are decoded
+with one forward per step, and a sequence leaves the batch on eos, max length or stop.
+
+The KV cache of the batch is left padded: row i holds its real positions on the right and
+attention_mask marks them, position_ids keep the positions of each sequence as if it ran alone.
+When the llm samples with ras_sampling, a step samples all rows at once with RasSampler and reads
+the tokens back with one copy, instead of a sampling call and .item() per row. A lone sequence is
+sampled with ras_sampling itself, which is cheaper for one row.
+"""
+import threading
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+from cosyvoice.utils.common import RasSampler, ras_sampling
+from cosyvoice.utils.file_utils import logging
+
+
+class DecodeSession:
+    def __init__(self,
+                 lm_input: torch.Tensor,
+                 prompt_text: torch.Tensor,
+                 min_len: int,
+                 max_len: int,
+                 on_token: Callable[[int], None],
+                 stop_events: Sequence[threading.Event] = (),
+                 sampling: int = 25,
+                 sampling_kwargs: Optional[dict] = None):
+        self.lm_input = lm_input
+        self.prompt_text = prompt_text
+        self.min_len = min_len
+        self.max_len = max_len
+        self.on_token = on_token
+        self.stop_events = stop_events
+        self.sampling = sampling
+        # overrides the keyword arguments of ras_sampling (top_p, top_k, win_size, tau_r) for this session
+        self.sampling_kwargs = sampling_kwargs or {}
+        self.out_tokens: List[int] = []
+        # number of sampled tokens, including the fill tokens which are not yielded
+        self.step = 0
+        # input embedding of the next step
+        self.next_input = lm_input[0, -1]
+        self.error = None
+        self.done = threading.Event()
+
+    def stopped(self) -> bool:
+        return any(e.is_set() for e in self.stop_events)
+
+    def wait(self):
+        """block until the session leaves the scheduler, raise the error of the llm if any"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class DecodeScheduler:
+    def __init__(self, llm: torch.nn.Module, max_batch: int = 8, context=None):
+        """
+        Args:
+            llm: Qwen2LM
+            max_batch: maximum number of sequences decoded together, others wait to be admitted
+            context: entered by the scheduler thread, e.g. the cuda stream of the llm
+        """
+        self.llm = llm
+        self.max_batch = max_batch
+        self.context = context if context is not None else nullcontext()
+        self.cond = threading.Condition()
+        self.pending: List[DecodeSession] = []
+        self.thread = None
+        # the running batch, row i of cache/mask belongs to active[i]
+        self.active: List[DecodeSession] = []
+        self.cache = None  # per layer (key, value), (batch, head, time, d_k)
+        self.mask = None   # (batch, time), 1 for real positions
+        # rows of the batch sampler follow active too, None when the llm does not use ras_sampling
+        sampling = llm.sampling
+        if getattr(sampling, 'func', sampling) is ras_sampling:
+            self.sampling_kwargs = dict(getattr(sampling, 'keywords', {}))
+            self.sampler = RasSampler(llm.speech_token_size, next(llm.parameters()).device)
+        else:
+            self.sampling_kwargs, self.sampler = None, None
+        # set while a lone sequence is sampled without the batch sampler, its windows are rebuilt before use
+        self.sampler_stale = False
+        # statistics
+        self.steps = 0
+        self.tokens = 0
+
+    def submit(self, session: DecodeSession) -> DecodeSession:
+        with self.cond:
+            self.pending.append(session)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='llm-scheduler', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return session
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.active)
+                # sessions stopped while waiting for a slot leave at once, their llm_job must not wait for the batch
+                stopped = [s.stopped() for s in self.pending]
+                cancelled = [s for s, stop in zip(self.pending, stopped) if stop]
+                self.pending = [s for s, stop in zip(self.pending, stopped) if not stop]
+                admitted = self.pending[:self.max_batch - len(self.active)]
+                del self.pending[:len(admitted)]
+            for session in cancelled:
+                session.done.set()
+            with self.context, torch.inference_mode():
+                for session in admitted:
+                    try:
+                        self.admit(session)
+                    except Exception as e:
+                        logging.error('llm scheduler failed to admit a session: {}'.format(e))
+                        session.error = e
+                        session.done.set()
+                self.retire([s for s in self.active if s.stopped()])
+                if not self.active:
+                    continue
+                try:
+                    self.step()
+                except Exception as e:
+                    # the batch cache is lost, fail every active session
+                    logging.error('llm scheduler failed: {}'.format(e))
+                    for session in self.active:
+                        session.error = e
+                        session.done.set()
+                    self.active, self.cache, self.mask = [], None, None
+                    if self.sampler is not None:
+                        self.sampler.select(torch.zeros(0, dtype=torch.long))
+
+    def admit(self, session: DecodeSession):
+        if session.stopped() or session.max_len <= 0:
+            session.done.set()
+            return
+        logp, cache = self.llm.prefill(session.lm_input, session.prompt_text)
+        if not self.sample(session, logp[0]):
+            session.done.set()
+            return
+        if hasattr(cache, 'to_legacy_cache'):
+            cache = cache.to_legacy_cache()
+        length = cache[0][0].size(2)
+        mask = torch.ones(1, length, dtype=torch.long, device=session.lm_input.device)
+        if self.cache is None:
+            self.cache, self.mask = cache, mask
+        else:
+            # left pad the shorter side to the same time
+            time = max(length, self.mask.size(1))
+            self.cache = tuple((torch.concat([self._pad(bk, time), self._pad(k, time)], dim=0),
+                                torch.concat([self._pad(bv, time), self._pad(v, time)], dim=0))
+                               for (bk, bv), (k, v) in zip(self.cache, cache))
+            self.mask = torch.concat([F.pad(self.mask, (time - self.mask.size(1), 0)), F.pad(mask, (time - length, 0))], dim=0)
+        if self.sampler is not None:
+            self.sampler.add(session.out_tokens, **{**self.sampling_kwargs, **session.sampling_kwargs})
+        self.active.append(session)
+
+    @staticmethod
+    def _pad(x: torch.Tensor, time: int) -> torch.Tensor:
+        return F.pad(x, (0, 0, time - x.size(2), 0))
+
+    def step(self):
+        inputs = torch.stack([s.next_input for s in self.active]).unsqueeze(1)
+        position_ids = self.mask.sum(dim=1, keepdim=True)
+        self.mask = F.pad(self.mask, (0, 1), value=1)
+        y_pred, cache = self.llm.llm.forward_one_step(inputs, masks=self.mask.unsqueeze(1).to(torch.bool),
+                                                      cache=self.cache, position_ids=position_ids)
+        self.cache = cache.to_legacy_cache() if hasattr(cache, 'to_legacy_cache') else cache
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        self.steps += 1
+        if self.sampler is not None and len(self.active) > 1:
+            if self.sampler_stale:
+                self.reset_sampler()
+            ignore_eos = torch.tensor([s.step < s.min_len for s in self.active], device=logp.device)
+            tokens = self.sampler.sample(logp, ignore_eos).tolist()
+            self.retire([s for s, top_ids in zip(self.active, tokens) if not self.accept(s, top_ids)])
+        else:
+            self.sampler_stale = self.sampler is not None
+            self.retire([s for s, row in zip(self.active, logp) if not self.sample(s, row)])
+
+    def reset_sampler(self):
+        """rebuild the rows of the batch sampler from the decoded tokens of the active sessions"""
+        self.sampler = RasSampler(self.llm.speech_token_size, self.sampler.device)
+        for session in self.active:
+            self.sampler.add(session.out_tokens, **{**self.sampling_kwargs, **session.sampling_kwargs})
+        self.sampler_stale = False
+
+    def sample(self, session: DecodeSession, logp: torch.Tensor) -> bool:
+        """sample the next token of session alone, returns False when the session ends"""
+        if self.sampler is None or not session.sampling_kwargs:
+            top_ids = self.llm.sampling_ids(logp, session.out_tokens, session.sampling,
+                                            ignore_eos=True if session.step < session.min_len else False).item()
+        else:
+            sampler = RasSampler(self.llm.speech_token_size, logp.device)
+            sampler.add(session.out_tokens, **{**self.sampling_kwargs, **session.sampling_kwargs})
+            top_ids = sampler.sample(logp.unsqueeze(0), torch.tensor([session.step < session.min_len], device=logp.device)).item()
+        return self.accept(session, top_ids)
+
+    def accept(self, session: DecodeSession, top_ids: int) -> bool:
+        """append the sampled token to session, returns False when the session ends"""
+        session.step += 1
+        if top_ids == self.llm.speech_token_size:
+            return False
+        # same as Qwen2LM.inference, other special tokens are skipped and the previous input is fed again
+        if top_ids < self.llm.speech_token_size:
+            session.on_token(top_ids)
+            session.out_tokens.append(top_ids)
+            session.next_input = self.llm.speech_embedding.weight[top_ids]
+            self.tokens += 1
+        return session.step < session.max_len and not session.stopped()
+
+    def retire(self, sessions: List[DecodeSession]):
+        if not sessions:
+            return
+        keep = [i for i, s in enumerate(self.active) if s not in sessions]
+        self.active = [self.active[i] for i in keep]
+        index = torch.tensor(keep, dtype=torch.long, device=self.mask.device)
+        if self.sampler is not None:
+            self.sampler.select(index)
+        if not keep:
+            self.cache, self.mask = None, None
+        else:
+            mask = self.mask.index_select(0, index)
+            # drop the columns that are padding for every remaining row
+            start = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+            self.mask = mask[:, start:]
+            self.cache = tuple((k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in self.cache)
+        # the batch no longer refers to them when their waiters wake up
+        for session in sessions:
+            session.done.set()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {'active': len(self.active), 'pending': len(self.pending), 'steps': self.steps, 'tokens': self.tokens}
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 import torch
 from torch import nn
@@ -303,6 +303,90 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        cache: Dict[str, Any],
+        finalize: bool = False,
+        keep: int = 0,
+        context: int = -1,
+    ) -> torch.Tensor:
+        """Encode one streaming chunk, reusing the states of previous chunks.
+
+        Unlike forward, which re-encodes the whole token prefix for every chunk,
+        only the new tokens are encoded here. The attention layers attend to the
+        cached keys/values of earlier tokens, the pre-lookahead conv and the
+        upsample conv keep the few frames they need on the left.
+
+        Args:
+            xs: token embedding (1, T, D). If finalize is False, the last
+                pre_lookahead_len tokens are lookahead only: they are encoded
+                (with zero lookahead, same as forward on the prefix) so that
+                the other tokens can attend to them, but they are not committed
+                to the cache and will be encoded again in the next chunk.
+            cache: states of previous chunks, an empty dict for the first chunk,
+                updated in place.
+            keep: number of leading tokens (the prompt) always kept in the
+                attention caches.
+            context: number of recent tokens kept in the attention caches after
+                the leading ones, <0 keeps everything.
+        Returns:
+            encoder output (1, T * stride, D), including the frames of the
+            lookahead tokens, the caller drops them as in forward.
+        NOTE: the attention in a chunk covers the cache and the whole chunk, so the
+            chunk boundaries are the streaming ones instead of static_chunk_size.
+            The conv module of conformer layers is not cached, the flow encoder of
+            CosyVoice2 does not use it.
+        """
+        assert xs.size(0) == 1
+        lookahead = self.pre_lookahead_layer.pre_lookahead_len
+        commit = xs.size(1) if finalize else xs.size(1) - lookahead
+        fake_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, fake_mask)
+
+        # lookahead, conv1 only looks right so only conv2 needs the committed frames on the left
+        outputs = F.pad(xs.transpose(1, 2), (0, lookahead), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.pre_lookahead_layer.conv1(outputs))
+        left = cache.get('lookahead', outputs.new_zeros(1, outputs.size(1), 2))
+        cache['lookahead'] = torch.concat([left, outputs[:, :, :commit]], dim=2)[:, :, -2:]
+        outputs = self.pre_lookahead_layer.conv2(torch.concat([left, outputs], dim=2))
+        xs = outputs.transpose(1, 2) + xs
+        xs = self.forward_layers_chunk(xs, self.encoders, self.embed.pos_enc, cache, 'encoders', commit, keep, context)
+
+        # upsample, the conv looks stride * 2 frames left
+        stride = self.up_layer.stride
+        outputs = F.interpolate(xs.transpose(1, 2), scale_factor=float(stride), mode="nearest")
+        left = cache.get('up', outputs.new_zeros(1, outputs.size(1), stride * 2))
+        cache['up'] = torch.concat([left, outputs[:, :, :commit * stride]], dim=2)[:, :, -stride * 2:]
+        xs = self.up_layer.conv(torch.concat([left, outputs], dim=2)).transpose(1, 2)
+        xs, _, _ = self.up_embed(xs, fake_mask)
+        xs = self.forward_layers_chunk(xs, self.up_encoders, self.up_embed.pos_enc, cache, 'up_encoders',
+                                       commit * stride, keep * stride, context * stride if context >= 0 else -1)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
+    def forward_layers_chunk(self, xs: torch.Tensor, layers: torch.nn.ModuleList,
+                             pos_enc: torch.nn.Module, cache: Dict[str, Any], name: str,
+                             commit: int, keep: int, context: int) -> torch.Tensor:
+        att_caches = cache.get(name, [torch.zeros((0, 0, 0, 0), device=xs.device)] * len(layers))
+        new_att_caches = []
+        fake_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=xs.device)
+        for layer, att_cache in zip(layers, att_caches):
+            # rel_shift needs the positional encoding of the key length, queries are the last frames
+            pos_emb = pos_enc.position_encoding(offset=0, size=att_cache.size(2) + xs.size(1))
+            xs, _, new_att_cache, _ = layer(xs, fake_mask, pos_emb, fake_mask, att_cache)
+            new_att_cache = new_att_cache[:, :, :att_cache.size(2) + commit]
+            if context >= 0 and new_att_cache.size(2) > keep + context:
+                new_att_cache = torch.concat([new_att_cache[:, :, :keep], new_att_cache[:, :, -context:]], dim=2) \
+                    if context > 0 else new_att_cache[:, :, :keep]
+            new_att_caches.append(new_att_cache)
+        cache[name] = new_att_caches
+        return xs
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -20,6 +20,7 @@ from typing import List
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 IGNORE_ID = -1
 
@@ -108,35 +109,120 @@ def init_weights(m, mean=0.0, std=0.01):
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    # decoded_tokens is a python list, count on the host instead of building a tensor from it
+    rep_num = decoded_tokens[-win_size:].count(top_ids.item()) if win_size > 0 else 0
     if rep_num >= win_size * tau_r:
         top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
     return top_ids
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+    # sampling both top-p and numbers.
+    prob, indices = weighted_scores.softmax(dim=-1).topk(min(top_k, weighted_scores.size(-1)))
+    # keep a token while the cumulative probability before it is below top_p, the first one is always kept
+    prob = prob.masked_fill(prob.cumsum(dim=-1) - prob >= top_p, 0)
+    top_ids = indices.gather(-1, prob.multinomial(1, replacement=True))
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    top_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True)
     return top_ids
 
 
+class RasSampler:
+    """Batched ras_sampling for sequences decoded together (see cosyvoice.llm.scheduler).
+
+    Each row has its own top_p, top_k, win_size and tau_r. The last decoded tokens of each row are
+    kept on device in a ring buffer, so one step samples the whole batch without a host round trip.
+    Tokens >= eos are special: eos ends the row and is masked while ignore_eos, tokens above eos
+    are sampled but not recorded, like decoded_tokens of Qwen2LM.inference.
+    """
+
+    def __init__(self, eos: int, device: torch.device = torch.device('cpu')):
+        self.eos = eos
+        self.device = device
+        self.top_p = torch.zeros(0, 1, device=device)
+        self.top_k = torch.zeros(0, 1, dtype=torch.long, device=device)
+        self.win_size = torch.zeros(0, dtype=torch.long, device=device)
+        self.threshold = torch.zeros(0, device=device)
+        # (batch, max win_size) ring buffers of the decoded tokens, -1 for empty slots
+        self.window = torch.zeros(0, 0, dtype=torch.long, device=device)
+        # number of tokens recorded by each row
+        self.count = torch.zeros(0, dtype=torch.long, device=device)
+        # width of topk, kept on the host, rows with a smaller top_k mask the rest
+        self.max_top_k = 1
+
+    def __len__(self):
+        return self.count.size(0)
+
+    def add(self, decoded_tokens: List[int] = (), top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+        """append a row, decoded_tokens are the tokens of the sequence sampled before it joins"""
+        width = max(self.window.size(1), win_size, 1)
+        window = torch.full((1, width), -1, dtype=torch.long)
+        recent = list(decoded_tokens)[-win_size:] if win_size > 0 else []
+        count = len(decoded_tokens)
+        for i, token in enumerate(recent):
+            window[0, (count - len(recent) + i) % win_size] = token
+        self.window = torch.concat([F.pad(self.window, (0, width - self.window.size(1)), value=-1),
+                                    window.to(self.device)], dim=0)
+        self.top_p = torch.concat([self.top_p, torch.tensor([[top_p]], device=self.device)])
+        self.top_k = torch.concat([self.top_k, torch.tensor([[top_k]], device=self.device)])
+        self.win_size = torch.concat([self.win_size, torch.tensor([win_size], device=self.device)])
+        self.threshold = torch.concat([self.threshold, torch.tensor([win_size * tau_r], device=self.device)])
+        self.count = torch.concat([self.count, torch.tensor([count], device=self.device)])
+        self.max_top_k = max(self.max_top_k, top_k)
+
+    def select(self, index: torch.Tensor):
+        """keep the rows in index, in that order"""
+        index = index.to(self.device)
+        self.top_p, self.top_k = self.top_p.index_select(0, index), self.top_k.index_select(0, index)
+        self.win_size, self.threshold = self.win_size.index_select(0, index), self.threshold.index_select(0, index)
+        self.window, self.count = self.window.index_select(0, index), self.count.index_select(0, index)
+
+    def sample(self, logp: torch.Tensor, ignore_eos: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            logp: (batch, vocab) log probabilities
+            ignore_eos: (batch,) bool, eos is never sampled for these rows
+        Returns:
+            (batch,) sampled tokens, recorded in the windows
+        """
+        prob = logp.softmax(dim=-1)
+        top_k = min(self.max_top_k, prob.size(1))
+        top_prob, indices = prob.topk(top_k)
+        # nucleus_sampling: top-k of every row and the tokens before the cumulative probability reaches top-p
+        ranks = torch.arange(top_k, device=prob.device)
+        cum_prob = top_prob.cumsum(dim=-1) - top_prob
+        top_prob = top_prob.masked_fill((ranks >= self.top_k) | (cum_prob >= self.top_p), 0)
+        # sampling_ids resamples until the token is not eos, the same as sampling without it
+        top_prob = top_prob.masked_fill(ignore_eos.unsqueeze(1) & (indices == self.eos), 0)
+        if self.eos < prob.size(1):
+            prob[:, self.eos] = prob[:, self.eos].masked_fill(ignore_eos, 0)
+        # rows left with an empty nucleus (only eos) take the full distribution
+        empty = top_prob.sum(dim=1) == 0
+        top_prob[:, 0].masked_fill_(empty, 1)
+        tokens = indices.gather(1, self._multinomial(top_prob).unsqueeze(1)).squeeze(1)
+        # repetition aware: tokens repeated too often in the window are resampled from the full distribution,
+        # drawn for every row so the step needs no sync, which multinomial makes too slow on cpu
+        repeated = ((self.window == tokens.unsqueeze(1)).sum(dim=1) >= self.threshold) | empty
+        tokens = torch.where(repeated, self._multinomial(prob), tokens)
+        # record the speech tokens in the ring buffers
+        record = (tokens < self.eos) & (self.win_size > 0)
+        slot = (self.count % self.win_size.clamp(min=1)).unsqueeze(1)
+        self.window.scatter_(1, slot, torch.where(record, tokens, self.window.gather(1, slot).squeeze(1)).unsqueeze(1))
+        self.count += record.long()
+        return tokens
+
+    @staticmethod
+    def _multinomial(prob: torch.Tensor) -> torch.Tensor:
+        """one index per row of prob (rows need not sum to 1), inverse transform of the cumulative sum"""
+        cdf = prob.cumsum(dim=-1)
+        value = torch.rand(cdf.size(0), 1, dtype=cdf.dtype, device=cdf.device) * cdf[:, -1:]
+        # right=True skips the zero probability tokens, clamp guards value == cdf[-1] from rounding
+        return torch.searchsorted(cdf, value, right=True).squeeze(1).clamp_(max=prob.size(1) - 1)
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
     device = fade_in_mel.device
     fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
@@ -13,7 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import json
+import torch
 import torchaudio
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
@@ -47,6 +49,23 @@ def load_wav(wav, target_sr):
     return speech
 
 
+def packed_checkpoint_path(path):
+    return os.path.splitext(path)[0] + '.mmap.pt'
+
+
+def load_checkpoint(path, device):
+    """Load a state dict, preferring the packed copy written by `python -m core.convert`.
+
+    The packed file is memory-mapped instead of read into private memory, so worker
+    processes loading the same model share its pages. Returns (state_dict, packed);
+    packed CPU tensors can be used with load_state_dict(assign=True) without a copy.
+    """
+    packed = packed_checkpoint_path(path)
+    if os.path.exists(packed):
+        return torch.load(packed, map_location=device, mmap=True, weights_only=True), True
+    return torch.load(path, map_location=device), False
+
+
 def convert_onnx_to_trt(trt_model, onnx_model, fp16):
     import tensorrt as trt
     _min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2,), (2, 80), (2, 80, 4)]
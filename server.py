@@ -19,20 +19,45 @@ for m in ENABLE:
     module = __import__("core.router.{}".format(m), globals(), locals(), ["router"], 0)
     app.include_router(module.router)
 
+from core.router import system
+from core.utils.executor import ExecutorBusy
+from core.utils.registry import load_models
+app.include_router(system.router)
+
+@app.on_event("startup")
+async def start_loading_models():
+    # 路由导入时只登记了模型, 在这里同时开始加载, 不阻塞启动; 完成情况见 /api/health/ready
+    load_models()
+
+@app.exception_handler(ExecutorBusy)
+async def executor_busy(request: fastapi.Request, exc: ExecutorBusy):
+    # 推理队列已满, 让客户端稍后重试, 而不是无限排队
+    return fastapi.responses.JSONResponse(
+        status_code = 503,
+        content = {"detail": str(exc)},
+        headers = {"Retry-After": "1"}
+    )
+
 app.mount("/", StaticFiles(directory="ui/dist"), name = "static")
 if __name__ == "__main__":
-    import time
-    import threading
+    import asyncio
 
     from core.router.sts import cm
-    from core.llm.chatgpt import chat
-    def timeHandler():
+    from core.llm.chatgpt import achat
+    async def timeHandler():
         # 定时任务
         while True:
-            cm.check_llm_message(chat)
-            time.sleep(30) # 30s 执行一次
-    thread = threading.Thread(target=timeHandler, daemon=True)
-    thread.start()
+            try:
+                await cm.acheck_llm_message(achat)
+            except Exception as e:
+                print(f"Error summarizing chat: {e}")
+            await asyncio.sleep(30) # 30s 执行一次
+
+    tasks = set()
+    @app.on_event("startup")
+    async def startTimeHandler():
+        task = asyncio.create_task(timeHandler())
+        tasks.add(task)
 
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
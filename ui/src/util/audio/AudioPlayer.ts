@@ -2,6 +2,9 @@ import { AudioBase } from ".";
 
 export class AudioPlayer extends AudioBase {
     private audioElement: HTMLAudioElement;
+    private audioContext: AudioContext;
+    private sources: AudioBufferSourceNode[] = [];
+    private playTime = 0;
     constructor(options?: Partial<AnalyserOptions>) {
         super(options);
         // 创建音频
@@ -21,6 +24,32 @@ export class AudioPlayer extends AudioBase {
 
         // 结束初始化
         this.audioElement = audioElement;
+        this.audioContext = audioContext;
+    }
+
+    /**
+     * 播放 websocket 推送的 int16 PCM 片段, 按到达顺序无缝衔接
+     */
+    feed(pcm: Int16Array, sampleRate: number) {
+        const buffer = this.audioContext.createBuffer(1, pcm.length, sampleRate);
+        const data = buffer.getChannelData(0);
+        for (let i = 0; i < pcm.length; i++) data[i] = pcm[i] / 0x8000;
+
+        const source = this.audioContext.createBufferSource();
+        source.buffer = buffer;
+        source.connect(this.audioContext.destination);
+        if (this.analyser) source.connect(this.analyser);
+        source.onended = () => {
+            if (!this.sources.includes(source)) return;
+            this.sources = this.sources.filter(s => s != source);
+            if (!this.sources.length) this.dispatchEvent("stop");
+        }
+        if (!this.sources.length) this.dispatchEvent("start");
+        this.sources.push(source);
+
+        this.playTime = Math.max(this.playTime, this.audioContext.currentTime);
+        source.start(this.playTime);
+        this.playTime += buffer.duration;
     }
 
     load(url: string) {
@@ -35,6 +64,10 @@ export class AudioPlayer extends AudioBase {
     }
     stop() {
         this.audioElement?.pause();
+        const sources = this.sources;
+        this.sources = [];
+        sources.forEach(s => s.stop());
+        this.playTime = 0;
         this.dispatchEvent("stop");
     }
 }